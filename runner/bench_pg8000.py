@@ -0,0 +1,354 @@
+"""Micro-benchmarks for the bundled pg8000 client.
+
+   Replays a stream of backend messages from a local socket into a pg8000
+   connection and reports how many messages per second the client gets
+   through. The stream is either synthesized (uservisits-like rows) or read
+   from a file containing raw backend messages captured from a real server:
+   a RowDescription followed by the DataRows of one result set.
+
+   Run with the bundled pg8000 on the path, eg.
+
+     PYTHONPATH=./deps python bench_pg8000.py --rows 100000
+
+   The decode benchmark compares text and binary result formats, eg. over a
+   1M-row stream:
+
+     PYTHONPATH=./deps python bench_pg8000.py -b decode -n 1000000 -r 1
+"""
+
+import datetime
+import socket
+import struct
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from pg8000 import protocol, types
+
+# uservisits schema, as loaded into Redshift by prepare_benchmark.py
+USERVISITS_COLUMNS = [
+  ("sourceip", 1043), ("destinationurl", 1043), ("visitdate", 1082),
+  ("adrevenue", 701), ("useragent", 1043), ("ccode", 1042), ("lcode", 1042),
+  ("searchword", 1043), ("duration", 23)]
+
+def message(code, body):
+  return code + struct.pack("!i", len(body) + 4) + body
+
+def split_messages(stream):
+  msgs = []
+  pos = 0
+  while pos < len(stream):
+    length = struct.unpack_from("!i", stream, pos + 1)[0]
+    msgs.append((stream[pos], stream[pos + 5:pos + 1 + length]))
+    pos += 1 + length
+  return msgs
+
+# Columns of the aggregate query results, for comparing text and binary
+# result formats.
+AGGREGATE_COLUMNS = [
+  ("sourceip", 1043), ("adrevenue", 701), ("pagerank", 23), ("duration", 23),
+  ("visitdate", 1082), ("avgpagerank", 1700)]
+
+def row_description(columns, binary=True):
+  """RowDescription with the format codes pg8000 asks for in Bind."""
+  body = struct.pack("!h", len(columns))
+  for name, type_oid in columns:
+    format = types.py_type_info({"type_oid": type_oid}, binary)
+    body += name + "\x00" + struct.pack("!ihihih", 0, 0, type_oid, -1, -1,
+                                        format)
+  return message("T", body)
+
+def column_value(type_oid, i, binary=True):
+  if type_oid == 23:
+    return struct.pack("!i", i % 100) if binary else str(i % 100)
+  if type_oid == 701:
+    return struct.pack("!d", i * 0.25) if binary else repr(i * 0.25)
+  if type_oid == 1082:
+    days = i % 10000
+    if binary:
+      return struct.pack("!i", days)
+    return (datetime.date(2000, 1, 1) +
+            datetime.timedelta(days=days)).isoformat()
+  if type_oid == 1700:
+    # i / 100, eg. an average with two decimal places
+    if binary:
+      return struct.pack("!hhhhhh", 2, 0, 0, 2, i // 100 % 10000,
+                         i % 100 * 100)
+    return "%d.%02d" % (i // 100 % 10000, i % 100)
+  if type_oid == 1042:
+    return "USA"
+  return "http://example.com/%d" % i
+
+def data_row(values):
+  body = struct.pack("!h", len(values))
+  for v in values:
+    body += struct.pack("!i", len(v)) + v
+  return message("D", body)
+
+def synthetic_stream(num_rows, columns=USERVISITS_COLUMNS, binary=True):
+  """A RowDescription plus num_rows DataRows."""
+  rows = [data_row([column_value(oid, i, binary) for _, oid in columns])
+          for i in xrange(num_rows)]
+  return row_description(columns, binary) + "".join(rows)
+
+def load_stream(filename):
+  return open(filename, "rb").read()
+
+class ReplayServer(threading.Thread):
+  """Accepts one connection and writes the batch to it `repeat` times."""
+
+  def __init__(self, batch, repeat):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.batch = batch
+    self.repeat = repeat
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(1)
+    self.port = self.listener.getsockname()[1]
+    self.start()
+
+  def run(self):
+    sock, _ = self.listener.accept()
+    for i in range(self.repeat):
+      sock.sendall(self.batch)
+    # Drain whatever the client sends (Execute/Flush) until it hangs up.
+    while sock.recv(65536):
+      pass
+    sock.close()
+
+class LinearMessageReader(protocol.MessageReader):
+  """The original MessageReader: an isinstance scan over every registered
+     handler for each message."""
+
+  def __init__(self, connection):
+    protocol.MessageReader.__init__(self, connection)
+    self._msgs = []
+
+  def add_message(self, msg_class, handler, *args, **kwargs):
+    self._msgs.append((msg_class, handler, args, kwargs))
+
+  def handle_messages(self):
+    exc = None
+    while 1:
+      msg = self._conn._read_message()
+      msg_handled = False
+      for (msg_class, handler, args, kwargs) in self._msgs:
+        if isinstance(msg, msg_class):
+          msg_handled = True
+          retval = handler(msg, *args, **kwargs)
+          if retval:
+            if exc != None:
+              raise exc
+            return retval
+          elif hasattr(self, "_retval"):
+            if exc != None:
+              raise exc
+            return self._retval
+      if msg_handled:
+        continue
+      elif isinstance(msg, protocol.ErrorResponse):
+        exc = msg.createException()
+        if not self.delay_raising_exception:
+          raise exc
+      elif isinstance(msg, protocol.NoticeResponse):
+        self._conn.handleNoticeResponse(msg)
+      elif isinstance(msg, protocol.ParameterStatus):
+        self._conn.handleParameterStatus(msg)
+      elif isinstance(msg, protocol.NotificationResponse):
+        self._conn.handleNotificationResponse(msg)
+      elif not self.ignore_unhandled_messages:
+        raise protocol.InternalError("Unexpected response msg %r" % (msg))
+
+def replay(batch, repeat, consume):
+  """Replays batch `repeat` times into a new connection, calling
+     consume(conn) once per batch. Returns the elapsed time in seconds."""
+  server = ReplayServer(batch, repeat)
+  conn = protocol.Connection(host="127.0.0.1", port=server.port)
+  conn._state = "ready"
+  t0 = time.time()
+  for i in range(repeat):
+    consume(conn)
+  elapsed = time.time() - t0
+  conn._sock.close()
+  return elapsed
+
+def ignore(msg):
+  pass
+
+def bench_dispatch(row_desc, datarows, repeat):
+  """Message dispatch only: DataRows are decoded into messages but their
+     fields aren't converted."""
+  batch = "".join(datarows) + message("s", "")
+
+  def new_reader(reader_class, conn):
+    # Registered in the same order as Connection.fetch_rows used to.
+    reader = reader_class(conn)
+    reader.add_message(protocol.DataRow, ignore)
+    reader.add_message(protocol.PortalSuspended, lambda msg: 1)
+    reader.add_message(protocol.CommandComplete, lambda msg: 2)
+    return reader
+
+  def run(reader_class):
+    def consume(conn):
+      conn._sock_lock.acquire()
+      try:
+        new_reader(reader_class, conn).handle_messages()
+      finally:
+        conn._sock_lock.release()
+    return replay(batch, repeat, consume)
+
+  def run_datarow_loop():
+    # The loop Connection.fetch_rows runs, with one reader per connection.
+    readers = {}
+    def consume(conn):
+      conn._sock_lock.acquire()
+      try:
+        if conn not in readers:
+          readers[conn] = new_reader(protocol.MessageReader, conn)
+        read = conn._read_raw_message
+        create_datarow = protocol.DataRow.createFromData
+        while 1:
+          code, data = read()
+          if code != "D":
+            readers[conn].handle_messages(code, data)
+            break
+          ignore(create_datarow(data))
+      finally:
+        conn._sock_lock.release()
+    return replay(batch, repeat, consume)
+
+  return [("linear isinstance dispatch", run(LinearMessageReader)),
+          ("table dispatch", run(protocol.MessageReader)),
+          ("table dispatch + DataRow loop", run_datarow_loop())]
+
+def bench_fetch_rows(row_desc, datarows, repeat):
+  """Connection.fetch_rows end to end, including field conversion."""
+  batch = "".join(datarows) + message("s", "")
+  def consume(conn):
+    conn.fetch_rows("portal", 0, row_desc)
+  return [("fetch_rows", replay(batch, repeat, consume))]
+
+def bench_fetch_columns(row_desc, datarows, repeat):
+  """Connection.fetch_columns against fetch_rows, over aggregate query
+     results in binary format."""
+  stream = synthetic_stream(len(datarows), AGGREGATE_COLUMNS)
+  msgs = split_messages(stream)
+  desc = protocol.RowDescription.createFromData(msgs[0][1])
+  batch = stream[len(message(*msgs[0])):] + message("s", "")
+  def fetch_rows(conn):
+    conn.fetch_rows("portal", 0, desc)
+  def fetch_columns(conn):
+    columns = conn.column_builder(desc)
+    conn.fetch_columns("portal", columns)
+    columns.columns()
+  return [("fetch_rows (tuples)", replay(batch, repeat, fetch_rows)),
+          ("fetch_columns", replay(batch, repeat, fetch_columns))]
+
+def bench_decode(row_desc, datarows, repeat):
+  """fetch_rows over aggregate query results sent in text and in binary
+     format. Uses as many rows as the replayed stream has."""
+  results = []
+  for binary in (False, True):
+    stream = synthetic_stream(len(datarows), AGGREGATE_COLUMNS, binary)
+    msgs = split_messages(stream)
+    desc = protocol.RowDescription.createFromData(msgs[0][1])
+    batch = stream[len(message(*msgs[0])):] + message("s", "")
+    def consume(conn):
+      conn.fetch_rows("portal", 0, desc)
+    label = "%s results" % ("binary" if binary else "text")
+    results.append((label, replay(batch, repeat, consume)))
+  return results
+
+def bench_serialize(row_desc, datarows, repeat):
+  """Serializing the Bind/Execute pairs of a pipelined executemany, one per
+     DataRow: strings joined per batch against packing into the reusable
+     send buffer."""
+  binds = [protocol.Bind("", "pg8000_statement_1", (1,), (i, i * 0.25, None),
+                         (1,))
+           for i in xrange(len(datarows))]
+  execute, sync = protocol.Execute("", 0), protocol.Sync()
+
+  def join_strings():
+    t0 = time.time()
+    for i in range(repeat):
+      data = []
+      for bind in binds:
+        data.append(bind.serialize())
+        data.append(execute.serialize())
+      data.append(sync.serialize())
+      "".join(data)
+    return time.time() - t0
+
+  def send_buffer():
+    out = protocol.SendBuffer()
+    t0 = time.time()
+    for i in range(repeat):
+      for bind in binds:
+        bind.serialize_into(out)
+        execute.serialize_into(out)
+      sync.serialize_into(out)
+      buffer(out.buf, 0, out.end)
+      out.clear()
+    return time.time() - t0
+
+  return [("serialize + join", join_strings()),
+          ("serialize_into send buffer", send_buffer())]
+
+BENCHMARKS = {
+  "decode": bench_decode,
+  "dispatch": bench_dispatch,
+  "fetch_columns": bench_fetch_columns,
+  "fetch_rows": bench_fetch_rows,
+  "serialize": bench_serialize,
+}
+
+def parse_args():
+  parser = OptionParser(usage="bench_pg8000.py [options]")
+  parser.add_option("-b", "--benchmark", action="append",
+      help="Benchmark to run (%s); may be repeated, defaults to all" %
+           ", ".join(sorted(BENCHMARKS)))
+  parser.add_option("-n", "--rows", type="int", default=10000,
+      help="Number of rows in the synthetic stream")
+  parser.add_option("-f", "--stream-file",
+      help="Replay raw backend messages from this file instead of a "
+           "synthetic stream")
+  parser.add_option("-r", "--repeat", type="int", default=10,
+      help="Number of times to replay the stream")
+
+  (opts, args) = parser.parse_args()
+
+  for name in opts.benchmark or []:
+    if name not in BENCHMARKS:
+      print >> sys.stderr, "Unknown benchmark: %s" % name
+      sys.exit(1)
+  return opts
+
+def main():
+  opts = parse_args()
+  if opts.stream_file:
+    stream = load_stream(opts.stream_file)
+  else:
+    stream = synthetic_stream(opts.rows)
+
+  row_desc, datarows = None, []
+  for code, body in split_messages(stream):
+    if code == "T":
+      row_desc = protocol.RowDescription.createFromData(body)
+    elif code == "D":
+      datarows.append(message(code, body))
+  if row_desc is None:
+    print >> sys.stderr, "Stream has no RowDescription"
+    sys.exit(1)
+
+  num_msgs = (len(datarows) + 1) * opts.repeat
+  print "Replaying %s DataRows x %s (%s bytes per replay)" % (
+      len(datarows), opts.repeat, sum(map(len, datarows)))
+  for name in opts.benchmark or sorted(BENCHMARKS):
+    for label, elapsed in BENCHMARKS[name](row_desc, datarows, opts.repeat):
+      print "%-30s %8.3fs %12.0f msgs/s" % (label, elapsed,
+                                            num_msgs / elapsed)
+
+if __name__ == "__main__":
+  main()
@@ -34,4 +34,5 @@ pg8000_dbapi = DBAPI
 
 from interface import *
 from types import Bytea
+from pool import ConnectionPool
 
@@ -30,6 +30,7 @@
 __author__ = "Mathieu Fenniak"
 
 import datetime
+import re
 import time
 import interface
 import types
@@ -59,182 +60,155 @@ threadsafety = 3
 # and pyformat).
 paramstyle = 'format' # paramstyle can be changed to any DB-API paramstyle
 
-def convert_paramstyle(src_style, query, args):
-    # I don't see any way to avoid scanning the query string char by char,
-    # so we might as well take that careful approach and create a
-    # state-based scanner.  We'll use int variables for the state.
-    #  0 -- outside quoted string
-    #  1 -- inside single-quote string '...'
-    #  2 -- inside quoted identifier   "..."
-    #  3 -- inside escaped single-quote string, E'...'
-    state = 0
-    output_query = ""
-    output_args = []
+# Tokens that convert_paramstyle looks at: quoted strings and identifiers,
+# whose contents are copied through, and the parameter markers of each
+# paramstyle.  Anything in between is copied through unchanged.
+_quoted_pattern = r"""E'(?:[^\\']|\\'?)*'?|'(?:[^']|'')*'?|"[^"]*"?"""
+_param_patterns = {
+    "qmark": r"\?",
+    "numeric": r":\d?",
+    "named": r":\w*",
+    "format": r"%.?",
+    "pyformat": r"%(?:\([^)]*\)?)?.?",
+}
+# Keyed by (paramstyle, whether the query is unicode).  Names and numbers in
+# a byte string query are ASCII, as str.isalnum() and isdigit() have it.
+_paramstyle_tokenizers = dict(
+        ((style, is_unicode), re.compile("(?P<quoted>%s)|(?P<param>%s)" % (_quoted_pattern, pattern), re.DOTALL | (re.UNICODE if is_unicode else 0)))
+        for style, pattern in _param_patterns.items()
+        for is_unicode in (False, True))
+
+# Inside quotes, format and pyformat queries may only contain %%.
+_quoted_percent = re.compile("%(.?)", re.DOTALL)
+
+def _unescape_quoted_percent(match):
+    if match.group(1) not in ("%", ""):
+        raise QueryParameterParseError("'%" + match.group(1) + "' not supported in quoted string")
+    return "%"
+
+def _compile_paramstyle(src_style, query):
+    # Returns the query with $n parameters, the keys to take from args for
+    # each $n in turn (None to pass args through unchanged), and the number
+    # of positional args required.
+    output_query = []
+    arg_keys = []
+    mapping_to_idx = {}
+    pos = 0
+    tokenizer = _paramstyle_tokenizers[(src_style, isinstance(query, unicode))]
+    for match in tokenizer.finditer(query):
+        output_query.append(query[pos:match.start()])
+        pos = match.end()
+        token = match.group()
+        if match.lastgroup == "quoted":
+            if src_style in ("pyformat", "format"):
+                token = _quoted_percent.sub(_unescape_quoted_percent, token)
+            output_query.append(token)
+            continue
+        key = None
+        if src_style == "qmark":
+            key = len(arg_keys)
+        elif src_style == "numeric":
+            if len(token) == 1:
+                raise QueryParameterParseError("numeric parameter : does not have numeric arg")
+            output_query.append("$" + token[1])
+            continue
+        elif src_style == "named":
+            key = token[1:]
+            if key == "":
+                raise QueryParameterParseError("empty name of named parameter")
+        elif src_style == "pyformat" and token[1:2] == "(":
+            if not token.endswith(")s") and ")" not in token:
+                raise QueryParameterParseError("began pyformat dict read, but couldn't find end of name")
+            if not token.endswith(")s"):
+                raise QueryParameterParseError("format not specified or not supported (only %(...)s supported)")
+            key = token[2:-2]
+        elif token == "%%":
+            output_query.append("%")
+            continue
+        elif src_style == "pyformat" and token == "%":
+            continue
+        elif token == "%s":
+            # a %s in a pyformat query string switches the rest of the query
+            # to format
+            src_style = "format"
+            key = len(arg_keys)
+        elif token == "%":
+            raise QueryParameterParseError("format parameter % does not have format code")
+        elif src_style == "pyformat":
+            raise QueryParameterParseError("Only %(name)s, %s and %% are supported")
+        else:
+            raise QueryParameterParseError("Only %s and %% are supported")
+        idx = mapping_to_idx.get(key)
+        if idx == None:
+            arg_keys.append(key)
+            idx = len(arg_keys)
+            if not isinstance(key, int):
+                mapping_to_idx[key] = idx
+        output_query.append("$" + str(idx))
+    output_query.append(query[pos:])
     if src_style == "numeric":
-        output_args = args
-    elif src_style in ("pyformat", "named"):
-        mapping_to_idx = {}
-    i = 0
-    while 1:
-        if i == len(query):
-            break
-        c = query[i]
-        # print "begin loop", repr(i), repr(c), repr(state)
-        if state == 0:
-            if c == "'":
-                i += 1
-                output_query += c
-                state = 1
-            elif c == '"':
-                i += 1
-                output_query += c
-                state = 2
-            elif c == 'E':
-                # check for escaped single-quote string
-                i += 1
-                if i < len(query) and i > 1 and query[i] == "'":
-                    i += 1
-                    output_query += "E'"
-                    state = 3
-                else:
-                    output_query += c
-            elif src_style == "qmark" and c == "?":
-                i += 1
-                param_idx = len(output_args)
-                if param_idx == len(args):
-                    raise QueryParameterIndexError("too many parameter fields, not enough parameters")
-                output_args.append(args[param_idx])
-                output_query += "$" + str(param_idx + 1)
-            elif src_style == "numeric" and c == ":":
-                i += 1
-                if i < len(query) and i > 1 and query[i].isdigit():
-                    output_query += "$" + query[i]
-                    i += 1
-                else:
-                    raise QueryParameterParseError("numeric parameter : does not have numeric arg")
-            elif src_style == "named" and c == ":":
-                name = ""
-                while 1:
-                    i += 1
-                    if i == len(query):
-                        break
-                    c = query[i]
-                    if c.isalnum() or c == '_':
-                        name += c
-                    else:
-                        break
-                if name == "":
-                    raise QueryParameterParseError("empty name of named parameter")
-                idx = mapping_to_idx.get(name)
-                if idx == None:
-                    idx = len(output_args)
-                    output_args.append(args[name])
-                    idx += 1
-                    mapping_to_idx[name] = idx
-                output_query += "$" + str(idx)
-            elif src_style == "format" and c == "%":
-                i += 1
-                if i < len(query) and i > 1:
-                    if query[i] == "s":
-                        param_idx = len(output_args)
-                        if param_idx == len(args):
-                            raise QueryParameterIndexError("too many parameter fields, not enough parameters")
-                        output_args.append(args[param_idx])
-                        output_query += "$" + str(param_idx + 1)
-                    elif query[i] == "%":
-                        output_query += "%"
-                    else:
-                        raise QueryParameterParseError("Only %s and %% are supported")
-                    i += 1
-                else:
-                    raise QueryParameterParseError("format parameter % does not have format code")
-            elif src_style == "pyformat" and c == "%":
-                i += 1
-                if i < len(query) and i > 1:
-                    if query[i] == "(":
-                        i += 1
-                        # begin mapping name
-                        end_idx = query.find(')', i)
-                        if end_idx == -1:
-                            raise QueryParameterParseError("began pyformat dict read, but couldn't find end of name")
-                        else:
-                            name = query[i:end_idx]
-                            i = end_idx + 1
-                            if i < len(query) and query[i] == "s":
-                                i += 1
-                                idx = mapping_to_idx.get(name)
-                                if idx == None:
-                                    idx = len(output_args)
-                                    output_args.append(args[name])
-                                    idx += 1
-                                    mapping_to_idx[name] = idx
-                                output_query += "$" + str(idx)
-                            else:
-                                raise QueryParameterParseError("format not specified or not supported (only %(...)s supported)")
-                    elif query[i] == "%":
-                        output_query += "%"
-                    elif query[i] == "s":
-                        # we have a %s in a pyformat query string.  Assume
-                        # support for format instead.
-                        i -= 1
-                        src_style = "format"
-                    else:
-                        raise QueryParameterParseError("Only %(name)s, %s and %% are supported")
-            else:
-                i += 1
-                output_query += c
-        elif state == 1:
-            output_query += c
-            i += 1
-            if c == "'":
-                # Could be a double ''
-                if i < len(query) and query[i] == "'":
-                    # is a double quote.
-                    output_query += query[i]
-                    i += 1
-                else:
-                    state = 0
-            elif src_style in ("pyformat","format") and c == "%":
-                # hm... we're only going to support an escaped percent sign
-                if i < len(query):
-                    if query[i] == "%":
-                        # good.  We already output the first percent sign.
-                        i += 1
-                    else:
-                        raise QueryParameterParseError("'%" + query[i] + "' not supported in quoted string")
-        elif state == 2:
-            output_query += c
-            i += 1
-            if c == '"':
-                state = 0
-            elif src_style in ("pyformat","format") and c == "%":
-                # hm... we're only going to support an escaped percent sign
-                if i < len(query):
-                    if query[i] == "%":
-                        # good.  We already output the first percent sign.
-                        i += 1
-                    else:
-                        raise QueryParameterParseError("'%" + query[i] + "' not supported in quoted string")
-        elif state == 3:
-            output_query += c
-            i += 1
-            if c == "\\":
-                # check for escaped single-quote
-                if i < len(query) and query[i] == "'":
-                    output_query += "'"
-                    i += 1
-            elif c == "'":
-                state = 0
-            elif src_style in ("pyformat","format") and c == "%":
-                # hm... we're only going to support an escaped percent sign
-                if i < len(query):
-                    if query[i] == "%":
-                        # good.  We already output the first percent sign.
-                        i += 1
-                    else:
-                        raise QueryParameterParseError("'%" + query[i] + "' not supported in quoted string")
-
-    return output_query, tuple(output_args)
+        arg_keys = None
+    positional = [key + 1 for key in arg_keys or () if isinstance(key, int)]
+    return "".join(output_query), arg_keys, max(positional or [0])
+
+# (paramstyle, query) -> compiled query, see _compile_paramstyle.
+_paramstyle_cache = {}
+_paramstyle_cache_size = 1000
+
+def convert_paramstyle(src_style, query, args):
+    # Queries are tokenized once per paramstyle; later executions of the
+    # same query only pick out the args.
+    compiled = _paramstyle_cache.get((src_style, query))
+    if compiled == None:
+        compiled = _compile_paramstyle(src_style, query)
+        if len(_paramstyle_cache) >= _paramstyle_cache_size:
+            _paramstyle_cache.clear()
+        _paramstyle_cache[(src_style, query)] = compiled
+    output_query, arg_keys, positional = compiled
+    if arg_keys == None:
+        return output_query, tuple(args)
+    if positional > len(args):
+        raise QueryParameterIndexError("too many parameter fields, not enough parameters")
+    return output_query, tuple([args[key] for key in arg_keys])
+
+def _copy_value(value, sep, null):
+    if value == None:
+        return null
+    if isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, basestring):
+        value = str(value)
+    value = value.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    if sep != "\t":
+        value = value.replace(sep, "\\" + sep)
+    return value
+
+##
+# Turn the source of a COPY FROM STDIN into a generator of data blocks of
+# about block_size bytes.  The source is a file-like object, or an iterable
+# whose items are either byte strings, passed through as they are, or rows
+# (tuples or lists), which are written out in COPY's text format with the
+# given column separator and NULL string.
+def _copy_blocks(source, sep, null, block_size):
+    if hasattr(source, "read"):
+        while True:
+            data = source.read(block_size)
+            if not data:
+                return
+            yield data
+    if null == None:
+        null = "\\N"
+    buf, size = [], 0
+    for item in source:
+        if isinstance(item, (tuple, list)):
+            item = sep.join([_copy_value(v, sep, null) for v in item]) + "\n"
+        buf.append(item)
+        size += len(item)
+        if size >= block_size:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
 
 def require_open_cursor(fn):
     def _fn(self, *args, **kwargs):
@@ -246,8 +220,9 @@ def require_open_cursor(fn):
 ##
 # The class of object returned by the {@link #ConnectionWrapper.cursor cursor method}.
 class CursorWrapper(object):
-    def __init__(self, conn, connection):
+    def __init__(self, conn, connection, streaming=False):
         self.cursor = interface.Cursor(conn)
+        self.cursor.streaming = streaming
         self.arraysize = 1
         self._connection = connection
         self._override_rowcount = None
@@ -305,18 +280,22 @@ class CursorWrapper(object):
     # Executes a database operation.  Parameters may be provided as a sequence
     # or mapping and will be bound to variables in the operation.
     # <p>
+    # If timeout is given, the operation is cancelled if it hasn't returned
+    # after that many seconds, and QueryTimeoutError is raised.  The timeout
+    # argument is an extension to the DBAPI 2.0 specification.
+    # <p>
     # Stability: Part of the DBAPI 2.0 specification.
     @require_open_cursor
-    def execute(self, operation, args=()):
+    def execute(self, operation, args=(), timeout=None):
         if not self._connection.in_transaction:
             self._connection.begin()
         self._override_rowcount = None
-        self._execute(operation, args)
+        self._execute(operation, args, timeout)
 
-    def _execute(self, operation, args=()):
+    def _execute(self, operation, args=(), timeout=None):
         new_query, new_args = convert_paramstyle(paramstyle, operation, args)
         try:
-            self.cursor.execute(new_query, *new_args)
+            self.cursor.execute(new_query, timeout=timeout, *new_args)
         except ConnectionClosedError:
             # can't rollback in this case
             raise
@@ -325,14 +304,23 @@ class CursorWrapper(object):
             self._connection.rollback()
             raise
 
-    def copy_from(self, fileobj, table=None, sep='\t', null=None, query=None):
+    ##
+    # Copy data into a table with COPY FROM STDIN.  fileobj is either a
+    # file-like object, or an iterable of rows (tuples or lists, written out
+    # in COPY's text format using sep and null) and/or byte strings (sent as
+    # they are).  An iterable is consumed as the data is sent, so a generator
+    # can stream any amount of data with bounded memory.  Data is sent in
+    # CopyData messages of about block_size bytes.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    def copy_from(self, fileobj, table=None, sep='\t', null=None, query=None, block_size=8192):
         if query == None:
             if table == None:
                 raise CopyQueryOrTableRequiredError()
             query = "COPY %s FROM stdout DELIMITER '%s'" % (table, sep)
             if null is not None:
                 query += " NULL '%s'" % (null,)
-        self.copy_execute(fileobj, query)
+        self.copy_execute(_copy_blocks(fileobj, sep, null, block_size), query)
 
     def copy_to(self, fileobj, table=None, sep='\t', null=None, query=None):
         if query == None:
@@ -358,7 +346,9 @@ class CursorWrapper(object):
 
     ##
     # Prepare a database operation and then execute it against all parameter
-    # sequences or mappings provided.
+    # sequences or mappings provided.  Operations that don't return rows are
+    # pipelined: every execution is sent before any result is read, with a
+    # single Sync at the end.
     # <p>
     # Stability: Part of the DBAPI 2.0 specification.
     @require_open_cursor
@@ -366,12 +356,21 @@ class CursorWrapper(object):
         if not self._connection.in_transaction:
             self._connection.begin()
         self._override_rowcount = 0
+        new_query, new_arg_sets = None, []
         for parameters in parameter_sets:
-            self._execute(operation, parameters)
-            if self.cursor.row_count == -1 or self._override_rowcount == -1:
-                self._override_rowcount = -1
-            else:
-                self._override_rowcount += self.cursor.row_count
+            new_query, new_args = convert_paramstyle(paramstyle, operation, parameters)
+            new_arg_sets.append(new_args)
+        if new_query == None:
+            return
+        try:
+            self._override_rowcount = self.cursor.execute_many(new_query, new_arg_sets)
+        except ConnectionClosedError:
+            # can't rollback in this case
+            raise
+        except:
+            # any error will rollback the transaction to-date
+            self._connection.rollback()
+            raise
 
     ##
     # Fetch the next row of a query result set, returning a single sequence, or
@@ -390,16 +389,11 @@ class CursorWrapper(object):
     # Stability: Part of the DBAPI 2.0 specification.
     # @param size   The number of rows to fetch when called.  If not provided,
     #               the arraysize property value is used instead.
+    @require_open_cursor
     def fetchmany(self, size=None):
         if size == None:
             size = self.arraysize
-        rows = []
-        for i in range(size):
-            value = self.fetchone()
-            if value == None:
-                break
-            rows.append(value)
-        return rows
+        return self.cursor.read_tuples(size)
 
     ##
     # Fetch all remaining rows of a query result, returning them as a sequence
@@ -408,7 +402,30 @@ class CursorWrapper(object):
     # Stability: Part of the DBAPI 2.0 specification.
     @require_open_cursor
     def fetchall(self):
-        return tuple(self.cursor.iterate_tuple())
+        return tuple(self.cursor.read_tuples())
+
+    ##
+    # Fetch all remaining rows of a query result, returning them as a list of
+    # columns in the order of the description attribute.  Binary integer and
+    # float columns are returned as array.array instances, or as NumPy arrays
+    # if use_numpy is true; other columns, or any column containing a NULL,
+    # are returned as lists.  Uses far less memory than fetchall for large
+    # results, since no per-row tuples are created.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    @require_open_cursor
+    def fetch_columns(self, use_numpy=False):
+        return self.cursor.read_columns(use_numpy)
+
+    ##
+    # Ask the server to cancel the operation running on this cursor's
+    # connection.  May be called from another thread; the running operation
+    # then raises an error.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    @require_open_cursor
+    def cancel(self):
+        self.cursor.cancel()
 
     ##
     # Close the cursor.
@@ -476,6 +493,25 @@ class ConnectionWrapper(object):
              return self.conn.in_transaction
         return False
 
+    ##
+    # The number of cursor executions that reused a statement from the
+    # connection's statement cache, and the number that had to parse a new
+    # one.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    statement_cache_hits = property(lambda self: self.conn.statement_cache_hits)
+    statement_cache_misses = property(lambda self: self.conn.statement_cache_misses)
+
+    ##
+    # The {@link trace.Tracer trace.Tracer} collecting statistics for this
+    # connection, or None.  Can be set to start or stop tracing.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    tracer = property(
+            lambda self: self.conn.tracer,
+            lambda self, value: setattr(self.conn, "tracer", value)
+    )
+
     def __init__(self, **kwargs):
         self.conn = interface.Connection(**kwargs)
         self.notifies = []
@@ -498,10 +534,17 @@ class ConnectionWrapper(object):
     # Creates a {@link #CursorWrapper CursorWrapper} object bound to this
     # connection.
     # <p>
-    # Stability: Part of the DBAPI 2.0 specification.
+    # If streaming is true, result sets are read from the server in batches
+    # of a bounded size as rows are fetched, instead of all at once when
+    # rowcount is read or fetchall is called, so that a huge result set can
+    # be processed with fetchone, fetchmany or iteration in bounded memory.
+    # rowcount is -1 until the last row has been fetched.
+    # <p>
+    # Stability: Part of the DBAPI 2.0 specification.  The streaming argument
+    # is an extension.
     @require_open_connection
-    def cursor(self):
-        return CursorWrapper(self.conn, self)
+    def cursor(self, streaming=False):
+        return CursorWrapper(self.conn, self, streaming)
 
     ##
     # Commits the current database transaction.
@@ -528,6 +571,16 @@ class ConnectionWrapper(object):
         # see bug description in commit.
         self.conn.rollback()
 
+    ##
+    # Ask the server to cancel the operation running on this connection.  May
+    # be called from another thread; the running operation then raises an
+    # error.
+    # <p>
+    # Stability: Extension to the DBAPI 2.0 specification.
+    @require_open_connection
+    def cancel(self):
+        self.conn.cancel()
+
     ##
     # Closes the database connection.
     # <p>
@@ -574,11 +627,25 @@ class ConnectionWrapper(object):
 #
 # @keyparam ssl     Use SSL encryption for TCP/IP socket.  Defaults to False.
 #
+# @keyparam binary_results  Ask the server to send result columns in binary
+# format for every type that pg8000 can decode from binary.  If False, columns
+# are requested as text wherever a text conversion exists.  Defaults to True.
+#
+# @keyparam statement_cache_size  The number of executed statements kept parsed
+# on the server for reuse by later executions of the same query.  The least
+# recently used statement is closed when the cache is full.  0 disables the
+# cache.  Defaults to 100.
+#
+# @keyparam tracer  A {@link trace.Tracer trace.Tracer} to collect message
+# counts and timings for the connection.
+#
 # @return An instance of {@link #ConnectionWrapper ConnectionWrapper}.
-def connect(user, host=None, unix_sock=None, port=5432, database=None, password=None, socket_timeout=60, ssl=False):
+def connect(user, host=None, unix_sock=None, port=5432, database=None, password=None, socket_timeout=60, ssl=False, binary_results=True, statement_cache_size=100, tracer=None):
     return ConnectionWrapper(user=user, host=host,
             unix_sock=unix_sock, port=port, database=database,
-            password=password, socket_timeout=socket_timeout, ssl=ssl)
+            password=password, socket_timeout=socket_timeout, ssl=ssl,
+            binary_results=binary_results,
+            statement_cache_size=statement_cache_size, tracer=tracer)
 
 def Date(year, month, day):
     return datetime.date(year, month, day)
@@ -113,3 +113,11 @@ class QueryParameterIndexError(ProgrammingError):
 class QueryParameterParseError(ProgrammingError):
     pass
 
+
+# A statement was cancelled because it ran for longer than its timeout.
+class QueryTimeoutError(OperationalError):
+    pass
+
+# No pooled connection became available within the checkout timeout.
+class PoolTimeoutError(OperationalError):
+    pass
@@ -32,6 +32,8 @@ __author__ = "Mathieu Fenniak"
 import socket
 import protocol
 import threading
+import types
+from collections import deque, OrderedDict
 from errors import *
 
 class DataIterator(object):
@@ -51,6 +53,46 @@ class DataIterator(object):
 statement_number_lock = threading.Lock()
 statement_number = 0
 
+##
+# Cancels the statement running on a connection if it is still running after
+# timeout seconds.
+# <p>
+# Stability: This is an internal class.  No stability guarantee is made.
+class StatementTimer(object):
+    def __init__(self, connection, timeout):
+        self._connection = connection
+        self._lock = threading.Lock()
+        self._running = True
+        self._fired = False
+        self._timer = threading.Timer(timeout, self._fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self):
+        self._lock.acquire()
+        try:
+            if not self._running:
+                return
+            self._fired = True
+            try:
+                self._connection.cancel()
+            except (Error, socket.error):
+                pass
+        finally:
+            self._lock.release()
+
+    ##
+    # Stop the timer once the statement has returned.  Returns True if the
+    # statement was cancelled.
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self._running = False
+            self._timer.cancel()
+            return self._fired
+        finally:
+            self._lock.release()
+
 ##
 # This class represents a prepared statement.  A prepared statement is
 # pre-parsed on the server, which reduces the need to parse the query every
@@ -88,6 +130,17 @@ class PreparedStatement(object):
     # parameter to be ignored.
     row_cache_size = 100
 
+    ##
+    # When a statement is executed with streaming=True, rows are read from
+    # the database server in batches of about this many bytes of row data,
+    # rather than row_cache_size rows.  The number of rows in each batch is
+    # worked out from the average row width of the previous batch, and is at
+    # most stream_max_rows.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    stream_batch_bytes = 1024 * 1024
+    stream_max_rows = 100000
+
     def __init__(self, connection, statement, *types, **kwargs):
         global statement_number
         if connection == None or connection.c == None:
@@ -102,14 +155,21 @@ class PreparedStatement(object):
         self._portal_name = None
         self._statement_name = kwargs.get("statement_name", "pg8000_statement_%s" % self._statement_number)
         self._row_desc = None
-        self._cached_rows = []
+        self._cached_rows = deque()
         self._ongoing_row_count = 0
         self._command_complete = True
-        self._parse_row_desc = self.c.parse(self._statement_name, statement, types)
+        self._streaming = False
+        self._batch_size = self.row_cache_size
+        # A statement from the connection's statement cache is parsed once,
+        # and closed by the cache when it is evicted.
+        self._cached = kwargs.get("cached", False)
+        self._parse_row_desc = kwargs.get("parse_data")
+        if self._parse_row_desc == None:
+            self._parse_row_desc = self.c.parse(self._statement_name, statement, types)
         self._lock = threading.RLock()
 
     def close(self):
-        if self._statement_name != "": # don't close unnamed statement
+        if self._statement_name != "" and not self._cached: # don't close unnamed statement
             self.c.close_statement(self._statement_name)
         if self._portal_name != None:
             self.c.close_portal(self._portal_name)
@@ -124,14 +184,22 @@ class PreparedStatement(object):
     ##
     # Run the SQL prepared statement with the given parameters.
     # <p>
-    # Stability: Added in v1.00, stability guaranteed for v1.xx.
+    # If the streaming keyword argument is true, the result set is read in
+    # batches of about stream_batch_bytes as it is consumed, and at most one
+    # batch is held in memory.  row_count is then -1 until the last row has
+    # been read, and reading all rows with read_tuples reads them batch by
+    # batch.
+    # <p>
+    # Stability: Added in v1.00, stability guaranteed for v1.xx.  The
+    # streaming argument is an extension, no stability guarantee is made.
     def execute(self, *args, **kwargs):
         self._lock.acquire()
         try:
-            if not self._command_complete:
-                # cleanup last execute
-                self._cached_rows = []
-                self._ongoing_row_count = 0
+            # cleanup last execute
+            self._cached_rows = deque()
+            self._ongoing_row_count = 0
+            self._streaming = kwargs.get("streaming", False)
+            self._batch_size = self.row_cache_size
             if self._portal_name != None:
                 self.c.close_portal(self._portal_name)
             self._command_complete = False
@@ -152,13 +220,54 @@ class PreparedStatement(object):
         finally:
             self._lock.release()
 
+    ##
+    # Run the SQL prepared statement once for each sequence of parameters in
+    # param_sets.  If the statement doesn't return rows, all of the
+    # executions are sent to the server before any of the results are read,
+    # rather than waiting a round trip for each.  Returns the total row count,
+    # or -1 if it isn't known.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def execute_many(self, param_sets):
+        self._lock.acquire()
+        try:
+            if self._parse_row_desc[0] != None:
+                row_count = 0
+                for args in param_sets:
+                    self.execute(*args)
+                    if row_count != -1 and self.row_count != -1:
+                        row_count += self.row_count
+                    else:
+                        row_count = -1
+                return row_count
+            self._cached_rows = deque()
+            if self._portal_name != None:
+                self.c.close_portal(self._portal_name)
+                self._portal_name = None
+            self._row_desc = None
+            self._command_complete = True
+            self._ongoing_row_count = self.c.execute_many(self._statement_name, param_sets, self._parse_row_desc)
+            return self._ongoing_row_count
+        finally:
+            self._lock.release()
+
     def _fill_cache(self):
         self._lock.acquire()
         try:
             if self._cached_rows:
                 raise InternalError("attempt to fill cache that isn't empty")
-            end_of_data, rows = self.c.fetch_rows(self._portal_name, self.row_cache_size, self._row_desc)
-            self._cached_rows = rows
+            if not self._streaming:
+                end_of_data, rows = self.c.fetch_rows(self._portal_name, self.row_cache_size, self._row_desc)
+            else:
+                # Size the next batch from the width of the rows in this one,
+                # so that a batch of wide rows doesn't use much more memory
+                # than one of narrow rows.
+                start = self.c.bytes_read()
+                end_of_data, rows = self.c.fetch_rows(self._portal_name, self._batch_size, self._row_desc)
+                if rows:
+                    row_width = max((self.c.bytes_read() - start) // len(rows), 1)
+                    self._batch_size = max(min(self.stream_batch_bytes // row_width, self.stream_max_rows), 1)
+            self._cached_rows = deque(rows)
             if end_of_data:
                 self._command_complete = True
         finally:
@@ -178,9 +287,43 @@ class PreparedStatement(object):
                     # no rows after filling our cache.  This is a special case when
                     # a query returns no rows.
                     return None
-            row = self._cached_rows.pop(0)
+            row = self._cached_rows.popleft()
             self._ongoing_row_count += 1
-            return tuple(row)
+            return row
+        finally:
+            self._lock.release()
+
+    # Return up to size rows, or all remaining rows if size is None, as a list
+    # of tuples.  The lock is taken once for the whole batch and cached rows
+    # are handed over a batch at a time.
+    def _fetch_many(self, size=None):
+        if not self._row_desc:
+            raise ProgrammingError("no result set")
+        self._lock.acquire()
+        try:
+            rows = []
+            while size == None or len(rows) < size:
+                if not self._cached_rows:
+                    if self._command_complete:
+                        break
+                    if size == None and not self._streaming:
+                        # Everything is wanted, so read it in one go.
+                        end_of_data, batch = self.c.fetch_rows(self._portal_name, 0, self._row_desc)
+                        self._command_complete = True
+                        rows.extend(batch)
+                        break
+                    self._fill_cache()
+                    continue
+                cached = self._cached_rows
+                wanted = len(cached) if size == None else size - len(rows)
+                if wanted >= len(cached):
+                    rows.extend(cached)
+                    cached.clear()
+                else:
+                    popleft = cached.popleft
+                    rows.extend([popleft() for i in xrange(wanted)])
+            self._ongoing_row_count += len(rows)
+            return rows
         finally:
             self._lock.release()
 
@@ -195,7 +338,9 @@ class PreparedStatement(object):
     # accessing this property requires reading the entire result-set into
     # memory, as reading the data to completion is the only way to determine
     # the total number of rows.  Avoid using this property in with
-    # result-set queries, as it may cause unexpected memory usage.
+    # result-set queries, as it may cause unexpected memory usage.  A
+    # streaming result set isn't read; the row count is -1 until its last row
+    # has been read.
     # <p>
     # Stability: Added in v1.03, stability guaranteed for v1.xx.
     row_count = property(lambda self: self._get_row_count())
@@ -203,8 +348,10 @@ class PreparedStatement(object):
         self._lock.acquire()
         try:
             if not self._command_complete:
+                if self._streaming:
+                    return -1
                 end_of_data, rows = self.c.fetch_rows(self._portal_name, 0, self._row_desc)
-                self._cached_rows += rows
+                self._cached_rows.extend(rows)
                 if end_of_data:
                     self._command_complete = True
                 else:
@@ -239,6 +386,39 @@ class PreparedStatement(object):
     def read_tuple(self):
         return self._fetch()
 
+    ##
+    # Read up to size rows from the database server, and return them as a list
+    # of tuples.  If size is omitted, all remaining rows are read.  Returns an
+    # empty list after the last row.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def read_tuples(self, size=None):
+        return self._fetch_many(size)
+
+    ##
+    # Read all remaining rows from the database server, and return them as a
+    # list of columns in row description order.  Binary integer and float
+    # columns are returned as array.array instances, or as NumPy arrays if
+    # use_numpy is true; other columns, or any column containing a NULL, are
+    # returned as lists.  No per-row tuples are created.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def read_columns(self, use_numpy=False):
+        if not self._row_desc:
+            raise ProgrammingError("no result set")
+        self._lock.acquire()
+        try:
+            columns = self.c.column_builder(self._row_desc, use_numpy)
+            while self._cached_rows:
+                columns.add_decoded_row(self._cached_rows.popleft())
+            if not self._command_complete:
+                self.c.fetch_columns(self._portal_name, columns)
+                self._command_complete = True
+            self._ongoing_row_count += columns.row_count
+            return columns.columns()
+        finally:
+            self._lock.release()
+
     ##
     # Return an iterator for the output of this statement.  The iterator will
     # return a tuple for each row, in the same manner as {@link
@@ -271,6 +451,14 @@ class PreparedStatement(object):
 #
 # @param connection     An instance of {@link Connection Connection}.
 class Cursor(object):
+
+    ##
+    # If true, statements run with execute stream their result sets, as for
+    # PreparedStatement.execute called with streaming=True.  Defaults to False.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    streaming = False
+
     def __init__(self, connection):
         self.connection = connection
         self._stmt = None
@@ -295,13 +483,75 @@ class Cursor(object):
     # <p>
     # Stability: Added in v1.00, stability guaranteed for v1.xx.
     # @param query      The SQL statement to execute.
+    # @keyparam timeout  If given, the statement is cancelled if execute
+    # hasn't returned after this many seconds, and QueryTimeoutError is
+    # raised.  execute returns once the first rows of a result are read.
     def execute(self, query, *args, **kwargs):
+        if self.connection.is_closed:
+            raise ConnectionClosedError()
+        timeout = kwargs.pop("timeout", None)
+        kwargs.setdefault("streaming", self.streaming)
+        self.connection._unnamed_prepared_statement_lock.acquire()
+        try:
+            self._stmt = self.connection._prepare(query, [{"type": type(x), "value": x} for x in args])
+            if timeout == None:
+                self._stmt.execute(*args, **kwargs)
+            else:
+                timer = StatementTimer(self.connection, timeout)
+                try:
+                    self._stmt.execute(*args, **kwargs)
+                except ProgrammingError:
+                    if timer.stop():
+                        raise QueryTimeoutError("statement cancelled after %ss" % timeout)
+                    raise
+                finally:
+                    timer.stop()
+        finally:
+            self.connection._unnamed_prepared_statement_lock.release()
+
+    ##
+    # Ask the server to cancel the statement running on this cursor's
+    # connection.  May be called from another thread.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def cancel(self):
+        self.connection.cancel()
+
+    ##
+    # Run an SQL statement once for each sequence of parameters in
+    # param_sets, in the same manner as {@link
+    # #PreparedStatement.execute_many PreparedStatement.execute_many}.
+    # Consecutive parameter sets with the same parameter types share a
+    # prepared statement.  Returns the total row count, or -1 if it isn't
+    # known.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    # @param query      The SQL statement to execute.
+    def execute_many(self, query, param_sets):
         if self.connection.is_closed:
             raise ConnectionClosedError()
         self.connection._unnamed_prepared_statement_lock.acquire()
         try:
-            self._stmt = PreparedStatement(self.connection, query, statement_name="", *[{"type": type(x), "value": x} for x in args])
-            self._stmt.execute(*args, **kwargs)
+            row_count = 0
+            batch, batch_types = [], None
+            for args in list(param_sets) + [None]:
+                if args != None:
+                    param_types = [{"type": type(x), "value": x} for x in args]
+                    type_info = [types.pg_type_info(x) for x in param_types]
+                    if type_info == batch_types or not batch:
+                        batch.append(args)
+                        batch_types = type_info
+                        continue
+                if batch:
+                    self._stmt = self.connection._prepare(query, [{"type": type(x), "value": x} for x in batch[0]])
+                    count = self._stmt.execute_many(batch)
+                    if row_count != -1 and count != -1:
+                        row_count += count
+                    else:
+                        row_count = -1
+                if args != None:
+                    batch, batch_types = [args], type_info
+            return row_count
         finally:
             self.connection._unnamed_prepared_statement_lock.release()
 
@@ -338,6 +588,26 @@ class Cursor(object):
     def read_tuple(self):
         return self._stmt.read_tuple()
 
+    ##
+    # Read up to size rows from the database server, and return them as a list
+    # of tuples.  If size is omitted, all remaining rows are read.  Returns an
+    # empty list after the last row.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    @require_stmt
+    def read_tuples(self, size=None):
+        return self._stmt.read_tuples(size)
+
+    ##
+    # Read all remaining rows from the database server, and return them as a
+    # list of columns, in the same manner as {@link
+    # #PreparedStatement.read_columns read_columns}.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    @require_stmt
+    def read_columns(self, use_numpy=False):
+        return self._stmt.read_columns(use_numpy)
+
     ##
     # Return an iterator for the output of this statement.  The iterator will
     # return a tuple for each row, in the same manner as {@link
@@ -425,11 +695,25 @@ class Cursor(object):
 # Defaults to 60 seconds.
 #
 # @keyparam ssl     Use SSL encryption for TCP/IP socket.  Defaults to False.
+#
+# @keyparam binary_results  Ask the server to send result columns in binary
+# format for every type that pg8000 can decode from binary.  If False, columns
+# are requested as text wherever a text conversion exists.  Defaults to True.
+#
+# @keyparam statement_cache_size  The number of statements run through {@link
+# #Cursor.execute Cursor.execute} that are kept parsed on the server, so that
+# running the same query again skips the Parse and Describe round trip.  The
+# least recently used statement is closed when the cache is full.  0 disables
+# the cache.  Defaults to 100.
+#
+# @keyparam tracer  A {@link trace.Tracer trace.Tracer} to collect message
+# counts and timings for this connection, including authentication.  Can also
+# be set later through the tracer attribute.
 class Connection(Cursor):
-    def __init__(self, user, host=None, unix_sock=None, port=5432, database=None, password=None, socket_timeout=60, ssl=False):
+    def __init__(self, user, host=None, unix_sock=None, port=5432, database=None, password=None, socket_timeout=60, ssl=False, binary_results=True, statement_cache_size=100, tracer=None):
         self._row_desc = None
         try:
-            self.c = protocol.Connection(unix_sock=unix_sock, host=host, port=port, socket_timeout=socket_timeout, ssl=ssl)
+            self.c = protocol.Connection(unix_sock=unix_sock, host=host, port=port, socket_timeout=socket_timeout, ssl=ssl, binary_results=binary_results, tracer=tracer)
             self.c.authenticate(user, password=password, database=database)
         except socket.error, e:
             raise InterfaceError("communication error", e)
@@ -439,6 +723,35 @@ class Connection(Cursor):
         self._rollback = PreparedStatement(self, "ROLLBACK TRANSACTION")
         self._unnamed_prepared_statement_lock = threading.RLock()
         self.in_transaction = False
+        # (query, parameter type info) -> (statement name, parse data), in
+        # least recently used order.
+        self._statement_cache = OrderedDict()
+        self.statement_cache_size = statement_cache_size
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+
+    ##
+    # Return a PreparedStatement for query, taking the parsed statement from
+    # the statement cache where possible.  Called with the unnamed prepared
+    # statement lock held.
+    def _prepare(self, query, param_types):
+        if self.statement_cache_size <= 0:
+            return PreparedStatement(self, query, statement_name="", *param_types)
+        key = (query, tuple([types.pg_type_info(x) for x in param_types]))
+        parse_data = self._statement_cache.pop(key, None)
+        if parse_data != None:
+            self.statement_cache_hits += 1
+            stmt = PreparedStatement(self, query, statement_name=parse_data[0],
+                    parse_data=parse_data[1], cached=True, *param_types)
+        else:
+            self.statement_cache_misses += 1
+            stmt = PreparedStatement(self, query, cached=True, *param_types)
+            while len(self._statement_cache) >= self.statement_cache_size:
+                statement_name, _ = self._statement_cache.popitem(last=False)[1]
+                self.c.close_statement(statement_name)
+            parse_data = (stmt._statement_name, stmt._parse_row_desc)
+        self._statement_cache[key] = parse_data
+        return stmt
 
     ##
     # An event handler that is fired when NOTIFY occurs for a notification that
@@ -484,6 +797,16 @@ class Connection(Cursor):
             lambda self, value: setattr(self.c, "ParameterStatusReceived", value)
     )
 
+    ##
+    # The {@link trace.Tracer trace.Tracer} collecting statistics for this
+    # connection, or None.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    tracer = property(
+            lambda self: getattr(self.c, "tracer"),
+            lambda self, value: setattr(self.c, "tracer", value)
+    )
+
     ##
     # Begins a new transaction.
     # <p>
@@ -522,9 +845,22 @@ class Connection(Cursor):
             raise ConnectionClosedError()
         self.c.close()
         self.c = None
+        self._statement_cache.clear()
 
     is_closed = property(lambda self: self.c == None)
 
+    ##
+    # Ask the server to cancel the statement running on this connection, if
+    # any.  The request is sent on a separate socket, so this may be called
+    # from another thread while a statement is running; the statement then
+    # fails with an error.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def cancel(self):
+        if self.is_closed:
+            raise ConnectionClosedError()
+        self.c.cancel()
+
     ##
     # Return the fileno of the underlying socket for this connection.
     # <p>
@@ -542,3 +878,12 @@ class Connection(Cursor):
     def isready(self):
         return self.c.isready()
 
+    ##
+    # Check that the server still answers, waiting up to timeout seconds for
+    # it.  Raises socket.timeout if it doesn't, or InterfaceError if the
+    # connection has been closed.
+    # <p>
+    # Stability: Extension to v1.xx, no stability guarantee is made.
+    def ping(self, timeout):
+        self.c.ping(timeout)
+
@@ -0,0 +1,412 @@
+# vim: sw=4:expandtab:foldmethod=marker
+#
+# This module was added to the copy of pg8000 bundled with the benchmark
+# runner; it isn't part of pg8000 as released by Mathieu Fenniak.  It is
+# distributed under the same BSD license terms as the rest of the
+# package.
+
+import errno
+import select
+import socket
+import struct
+from collections import deque
+import protocol
+import types
+from errors import *
+
+# The protocol layer is blocking, and asyncio isn't available to this
+# package, so this module provides a small select-based event loop instead.
+# Many connections can be driven from one thread: a session is written as a
+# generator that yields the futures returned by AsyncConnection.execute and
+# fetch, and is resumed with their results, eg.
+# <pre>
+# def session(conn):
+#     rows = yield conn.fetch("SELECT * FROM rankings WHERE pageRank > $1", 10)
+#     yield conn.execute("DROP TABLE tmp")
+#
+# loop = EventLoop()
+# conns = [AsyncConnection(loop, user="x", host="db") for i in range(100)]
+# loop.run_until_complete(gather([loop.spawn(session(c)) for c in conns]))
+# </pre>
+# Parameters use the same $1, $2, ... placeholders as interface.Cursor.
+
+##
+# The result of an operation that may not have completed yet.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+class Future(object):
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    ##
+    # Return the result, or raise the exception, of a completed operation.
+    def result(self):
+        if not self._done:
+            raise InterfaceError("operation has not completed")
+        if self._exception != None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    ##
+    # Call fn with this future once it completes, or right away if it already
+    # has.
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            raise InternalError("future completed twice")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+##
+# Return a future for the list of results of futures, which fails with the
+# first exception raised by any of them.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+def gather(futures):
+    futures = list(futures)
+    retval = Future()
+    pending = [len(futures)]
+    def done(f):
+        if retval.done():
+            return
+        if f.exception() != None:
+            retval.set_exception(f.exception())
+            return
+        pending[0] -= 1
+        if pending[0] == 0:
+            retval.set_result([f.result() for f in futures])
+    if not futures:
+        retval.set_result([])
+    for f in futures:
+        f.add_done_callback(done)
+    return retval
+
+##
+# Runs tasks and the I/O of AsyncConnections on the calling thread.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+class EventLoop(object):
+    def __init__(self):
+        self._conns = set()
+        self._ready = deque()
+
+    ##
+    # Run a generator as a task.  Each value it yields must be a Future (or a
+    # list of them, which is gathered); the generator is resumed with the
+    # future's result, or has its exception thrown into it.  Returns a future
+    # that completes when the generator finishes.
+    def spawn(self, gen):
+        task = Future()
+        self._ready.append((self._step, (gen, task, None, None)))
+        return task
+
+    def _step(self, gen, task, value, exc):
+        try:
+            if exc != None:
+                future = gen.throw(exc)
+            else:
+                future = gen.send(value)
+        except StopIteration:
+            task.set_result(None)
+            return
+        except Exception, e:
+            task.set_exception(e)
+            return
+        if isinstance(future, list):
+            future = gather(future)
+        if not isinstance(future, Future):
+            self._ready.append((self._step, (gen, task, None,
+                    ProgrammingError("task yielded %r, not a Future" % (future,)))))
+            return
+        # resumed from the loop rather than the callback, so that a long
+        # chain of completed futures doesn't recurse
+        future.add_done_callback(lambda f: self._ready.append(
+                (self._step, (gen, task, f._result, f._exception))))
+
+    ##
+    # Run the loop until future completes, and return its result.
+    def run_until_complete(self, future):
+        while not future.done():
+            while self._ready and not future.done():
+                fn, args = self._ready.popleft()
+                fn(*args)
+            if future.done():
+                break
+            if not self._poll():
+                raise InterfaceError("nothing left to run, but the future hasn't completed")
+        return future.result()
+
+    # Wait for I/O on the connections that have something to send or are
+    # waiting for a response, and process it.  Returns False if there are no
+    # such connections.
+    def _poll(self):
+        readers = [c for c in self._conns if c._ops]
+        writers = [c for c in self._conns if c._send_buf]
+        if not readers and not writers:
+            return False
+        try:
+            readable, writable, _ = select.select(readers, writers, [])
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return True
+            raise
+        for conn in writable:
+            conn._handle_write()
+        for conn in readable:
+            conn._handle_read()
+        return True
+
+##
+# A connection to a PostgreSQL database driven by an {@link #EventLoop
+# EventLoop}.  Connecting and authenticating block; after that, queries are
+# sent without waiting for the server, and their results are delivered
+# through futures.  Queries on one connection are pipelined and answered in
+# the order they were sent.  Each query runs in its own implicit
+# transaction.
+# <p>
+# Statements are parsed once per connection and kept for reuse, so running
+# the same query again takes a single round trip.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+#
+# @param loop   The {@link #EventLoop EventLoop} running this connection.
+#
+# The other parameters are those of {@link interface.Connection
+# interface.Connection}, except for ssl, which isn't supported.
+class AsyncConnection(object):
+    _recv_size = 128 * 1024
+
+    def __init__(self, loop, user, host=None, unix_sock=None, port=5432, database=None, password=None, socket_timeout=60, binary_results=True):
+        c = protocol.Connection(unix_sock=unix_sock, host=host, port=port, socket_timeout=socket_timeout, binary_results=binary_results)
+        try:
+            c.authenticate(user, password=password, database=database)
+        except socket.error, e:
+            raise InterfaceError("communication error", e)
+        self._loop = loop
+        self._sock = c._sock
+        self._sock.setblocking(0)
+        self._binary_results = binary_results
+        self._client_encoding = c._client_encoding
+        self._integer_datetimes = c._integer_datetimes
+        self._backend_key_data = c._backend_key_data
+        self._recv_buf = bytearray(c._sock_buf[c._sock_buf_pos:c._sock_buf_end])
+        self._send_buf = []
+        # operations awaiting a response, in the order they were sent
+        self._ops = deque()
+        # (query, parameter type info) -> future of (statement name,
+        # row description, parameter format codes)
+        self._statements = {}
+        self._statement_number = 0
+        self._closed = False
+        loop._conns.add(self)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    ##
+    # Run query with the given parameters, discarding any rows.  Returns a
+    # future of the command tag, eg. "INSERT 0 1".
+    def execute(self, query, *args):
+        return self._run(query, args, False)
+
+    ##
+    # Run query with the given parameters.  Returns a future of the list of
+    # rows, each a tuple.
+    def fetch(self, query, *args):
+        return self._run(query, args, True)
+
+    ##
+    # Close the connection.  Operations still waiting for a response fail.
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self._sock.setblocking(1)
+            self._sock.sendall("".join(self._send_buf) + protocol.Terminate().serialize())
+        except socket.error:
+            pass
+        self._fail(ConnectionClosedError())
+
+    def _run(self, query, args, want_rows):
+        if self._closed:
+            raise ConnectionClosedError()
+        if isinstance(query, unicode):
+            query = query.encode(self._client_encoding)
+        param_types = [{"type": type(x), "value": x} for x in args]
+        key = (query, tuple([types.pg_type_info(x) for x in param_types]))
+        statement = self._statements.get(key)
+        if statement == None:
+            statement = self._statements[key] = self._parse(query, param_types)
+        retval = Future()
+        def parsed(f):
+            if f.exception() != None:
+                # every waiter on the parse gets here; only the first
+                # removes it, and not a newer parse of the same query
+                if self._statements.get(key) is statement:
+                    del self._statements[key]
+                retval.set_exception(f.exception())
+            elif not self._closed:
+                # this runs in the event loop, so an error (eg. a result
+                # column of a type that can't be read) has to go to the
+                # caller rather than out of the loop
+                try:
+                    self._bind_execute(f.result(), args, want_rows, retval)
+                except Exception, e:
+                    retval.set_exception(e)
+            else:
+                retval.set_exception(ConnectionClosedError())
+        statement.add_done_callback(parsed)
+        return retval
+
+    def _parse(self, query, param_types):
+        name = "pg8000_async_%s" % self._statement_number
+        self._statement_number += 1
+        type_info = [types.pg_type_info(x) for x in param_types]
+        param_oids = [x[0] for x in type_info]
+        param_fc = [x[1] for x in type_info]
+        future = Future()
+        state = {"row_desc": None}
+        def handle(code, data):
+            if code == "T":
+                state["row_desc"] = protocol.RowDescription.createFromData(data)
+            elif code == "Z":
+                return (name, state["row_desc"], param_fc)
+        self._send([protocol.Parse(name, query, param_oids),
+                protocol.DescribePreparedStatement(name), protocol.Sync()],
+                handle, future)
+        return future
+
+    def _bind_execute(self, statement, args, want_rows, future):
+        name, row_desc, param_fc = statement
+        output_fc = ()
+        state = {"rows": [], "command": None}
+        if row_desc != None:
+            output_fc = [types.py_type_info(f, self._binary_results) for f in row_desc.fields]
+            decode = None
+            if want_rows:
+                fields = [dict(f, format=fc) for f, fc in zip(row_desc.fields, output_fc)]
+                decode = types.py_row_decoder(fields,
+                        client_encoding=self._client_encoding,
+                        integer_datetimes=self._integer_datetimes)
+        create_datarow = protocol.DataRow.createFromData
+        def handle(code, data):
+            if code == "D":
+                if want_rows:
+                    state["rows"].append(decode(create_datarow(data).fields))
+            elif code == "C":
+                state["command"] = data[:-1]
+            elif code == "Z":
+                if want_rows:
+                    return state["rows"]
+                return state["command"]
+        self._send([protocol.Bind("", name, param_fc, args, output_fc,
+                    client_encoding=self._client_encoding,
+                    integer_datetimes=self._integer_datetimes),
+                protocol.Execute("", 0), protocol.Sync()], handle, future)
+
+    # Queue msgs for sending.  handle(code, data) is called with every
+    # response message up to the ReadyForQuery that ends it; its return value
+    # for the ReadyForQuery is the result of future.
+    def _send(self, msgs, handle, future):
+        for msg in msgs:
+            self._send_buf.append(msg.serialize())
+        self._ops.append([handle, future, None])
+
+    def _handle_write(self):
+        data = "".join(self._send_buf)
+        try:
+            sent = self._sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._fail(InterfaceError("network error on write", e))
+            return
+        if sent < len(data):
+            self._send_buf = [data[sent:]]
+        else:
+            self._send_buf = []
+
+    def _handle_read(self):
+        try:
+            data = self._sock.recv(self._recv_size)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._fail(InterfaceError("network error on read", e))
+            return
+        if not data:
+            self._fail(InterfaceError("network error on read"))
+            return
+        buf = self._recv_buf
+        buf.extend(data)
+        pos = 0
+        while len(buf) - pos >= 5 and not self._closed:
+            length = struct.unpack_from("!i", buf, pos + 1)[0]
+            if len(buf) - pos < length + 1:
+                break
+            code = chr(buf[pos])
+            self._handle_message(code, str(buf[pos + 5:pos + 1 + length]))
+            pos += 1 + length
+        del buf[:pos]
+
+    def _handle_message(self, code, data):
+        if code == "S":
+            msg = protocol.ParameterStatus.createFromData(data)
+            if msg.key == "client_encoding":
+                self._client_encoding = types.encoding_convert(msg.value)
+            elif msg.key == "integer_datetimes":
+                self._integer_datetimes = (msg.value == "on")
+            return
+        if code in ("N", "A"):
+            # notices and notifications aren't delivered in this mode
+            return
+        if not self._ops:
+            self._fail(InternalError("unexpected response msg %r" % code))
+            return
+        op = self._ops[0]
+        if code == "E":
+            # report the error once the server is ready again
+            op[2] = protocol.ErrorResponse.createFromData(data).createException()
+            return
+        result = op[0](code, data)
+        if code == "Z":
+            self._ops.popleft()
+            if op[2] != None:
+                op[1].set_exception(op[2])
+            else:
+                op[1].set_result(result)
+
+    def _fail(self, exc):
+        self._closed = True
+        self._loop._conns.discard(self)
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+        ops, self._ops = self._ops, deque()
+        for handle, future, error in ops:
+            future.set_exception(exc)
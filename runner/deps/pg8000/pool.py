@@ -0,0 +1,268 @@
+# vim: sw=4:expandtab:foldmethod=marker
+#
+# This module was added to the copy of pg8000 bundled with the benchmark
+# runner; it isn't part of pg8000 as released by Mathieu Fenniak.  It is
+# distributed under the same BSD license terms as the rest of the
+# package.
+
+import socket
+import threading
+import time
+from collections import deque
+import dbapi
+from errors import *
+
+##
+# A thread-safe pool of {@link dbapi.ConnectionWrapper DBAPI connections},
+# so that threads running one query after another can share warm sessions
+# instead of each paying for a TCP connect and authentication.
+# <p>
+# Connections are opened on demand, up to max_size; min_size of them are
+# opened up front and kept even when idle.  Connections idle for longer than
+# max_idle seconds beyond that are closed.  Every idle connection is checked
+# with a round trip to the server before it is handed out, and replaced if
+# the server doesn't answer within check_timeout seconds, so that a
+# connection to a dead server, or one the network dropped, isn't handed out.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+#
+# @keyparam min_size    The number of connections kept open.  Defaults to 1.
+#
+# @keyparam max_size    The maximum number of connections open at once,
+# checked out or idle.  Defaults to 10.
+#
+# @keyparam max_idle    Seconds an idle connection beyond min_size is kept
+# open.  Defaults to 300.
+#
+# @keyparam timeout     Default number of seconds {@link #ConnectionPool.get
+# get} waits for a connection when max_size are checked out.  None, the
+# default, waits forever.
+#
+# @keyparam check_timeout   Seconds to wait for the server to answer the
+# check of an idle connection.  Defaults to 5.
+#
+# Any other keyword arguments are passed to {@link dbapi.connect
+# dbapi.connect}.
+class ConnectionPool(object):
+    def __init__(self, min_size=1, max_size=10, max_idle=300, timeout=None, check_timeout=5, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ProgrammingError("invalid pool size: min_size=%r max_size=%r" % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.check_timeout = check_timeout
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        # (connection, time it was returned), most recently returned last
+        self._idle = deque()
+        # connections open, idle or checked out, including ones being opened
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "evicted": 0,
+            "failed_checks": 0,
+        }
+        for i in range(min_size):
+            self._size += 1
+            self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        try:
+            conn = dbapi.connect(**self._connect_kwargs)
+        except:
+            self._cond.acquire()
+            try:
+                self._size -= 1
+                self._cond.notify()
+            finally:
+                self._cond.release()
+            raise
+        self._count("created")
+        return conn
+
+    ##
+    # Check a connection out of the pool, waiting up to timeout seconds (or
+    # the pool's default timeout) if max_size connections are checked out.
+    # Raises PoolTimeoutError if none becomes available.  The connection must
+    # be given back with {@link #ConnectionPool.put put}.
+    def get(self, timeout=None):
+        if timeout == None:
+            timeout = self.timeout
+        start = time.time()
+        waited = False
+        while 1:
+            conn, evicted = None, []
+            self._cond.acquire()
+            try:
+                while 1:
+                    if self._closed:
+                        raise InterfaceError("connection pool is closed")
+                    evicted.extend(self._evict_idle())
+                    if self._idle:
+                        conn = self._idle.pop()[0]
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = None
+                    if timeout != None:
+                        remaining = start + timeout - time.time()
+                        if remaining <= 0:
+                            self._stats["timeouts"] += 1
+                            raise PoolTimeoutError("no connection available after %.1fs" % timeout)
+                    waited = True
+                    self._cond.wait(remaining)
+            finally:
+                self._cond.release()
+            self._close_all(evicted)
+
+            if conn == None:
+                conn = self._connect()
+            elif not self._healthy(conn):
+                self._count("failed_checks")
+                self._discard(conn)
+                continue
+
+            if waited:
+                self._count("checkouts", wait_time=time.time() - start)
+            else:
+                self._count("checkouts")
+            return conn
+
+    ##
+    # Return a connection to the pool.  A transaction left open on it is
+    # rolled back; a connection that has been closed, or that fails to roll
+    # back, is dropped from the pool.
+    def put(self, conn):
+        try:
+            if conn.conn != None and conn.in_transaction:
+                conn.rollback()
+        except (Error, socket.error):
+            self._discard(conn)
+            return
+        if conn.conn == None:
+            self._discard(conn)
+            return
+        self._cond.acquire()
+        try:
+            if self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if conn != None:
+            self._close_all([conn])
+
+    ##
+    # Check a connection out for the duration of a with block, eg.
+    # <pre>
+    # with pool.connection() as conn:
+    #     cursor = conn.cursor()
+    # </pre>
+    def connection(self, timeout=None):
+        return _PooledConnection(self, timeout)
+
+    ##
+    # Close the idle connections and refuse further checkouts.  Connections
+    # checked out at the time are closed when they are returned.
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            idle = [conn for conn, returned in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        self._close_all(idle)
+
+    ##
+    # Return a dict of pool statistics: the current size, idle and in_use
+    # connection counts; the number of checkouts, how many of them had to
+    # wait for a connection, their total and longest wait_time in seconds,
+    # and how many timed out; and the number of connections created, evicted
+    # for being idle, and discarded after failing a health check.
+    def stats(self):
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            return stats
+        finally:
+            self._cond.release()
+
+    def _count(self, name, wait_time=None):
+        self._cond.acquire()
+        try:
+            self._stats[name] += 1
+            if wait_time != None:
+                self._stats["waits"] += 1
+                self._stats["wait_time"] += wait_time
+                self._stats["max_wait_time"] = max(self._stats["max_wait_time"], wait_time)
+        finally:
+            self._cond.release()
+
+    # Remove and return the connections idle for longer than max_idle, oldest
+    # first, without going below min_size.  Called with the lock held.
+    def _evict_idle(self):
+        evicted = []
+        if self.max_idle == None:
+            return evicted
+        deadline = time.time() - self.max_idle
+        while self._idle and self._size > self.min_size and self._idle[0][1] < deadline:
+            evicted.append(self._idle.popleft()[0])
+            self._size -= 1
+            self._stats["evicted"] += 1
+        return evicted
+
+    def _healthy(self, conn):
+        if conn.conn == None or conn.in_transaction:
+            return False
+        try:
+            conn.conn.ping(self.check_timeout)
+        except (Error, socket.error):
+            return False
+        return True
+
+    def _discard(self, conn):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        self._close_all([conn])
+
+    def _close_all(self, conns):
+        for conn in conns:
+            try:
+                if conn.conn != None:
+                    conn.close()
+            except (Error, socket.error):
+                pass
+
+class _PooledConnection(object):
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.conn = self.pool.get(self.timeout)
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pool.put(self.conn)
+        self.conn = None
@@ -35,12 +35,72 @@ import select
 import threading
 import struct
 import hashlib
-from cStringIO import StringIO
+import time
 
 from errors import *
 from util import MulticastDelegate
 import types
 
+##
+# A reusable, growing buffer that outgoing messages serialize themselves into
+# with struct.pack_into, so that a batch of messages is sent with a single
+# sendall of the buffer instead of joining a string per message.
+# <p>
+# Stability: This is an internal class.  No stability guarantee is made.
+class SendBuffer(object):
+    def __init__(self, size=8192):
+        self.buf = bytearray(size)
+        self.end = 0
+
+    # Reserves byte_count bytes at the end of the buffer, growing it if
+    # needed, and returns the offset they start at.
+    def reserve(self, byte_count):
+        pos = self.end
+        end = pos + byte_count
+        if end > len(self.buf):
+            self.buf.extend(bytearray(max(end, 2 * len(self.buf)) - len(self.buf)))
+        self.end = end
+        return pos
+
+    def write(self, data):
+        pos = self.reserve(len(data))
+        self.buf[pos:self.end] = data
+
+    def getvalue(self):
+        return str(self.buf[:self.end])
+
+    def clear(self):
+        self.end = 0
+
+
+_pack_int32 = struct.Struct("!i").pack
+_pack_int16_into = struct.Struct("!h").pack_into
+
+# Precompiled Structs for the fixed part of Bind and Execute messages, keyed
+# by the lengths of the portal and statement names they contain.
+_bind_headers = {}
+_execute_headers = {}
+
+# A count followed by the format codes, as Bind sends them for its parameters
+# and results.  There are only a few distinct lists per connection.
+_format_code_bytes = {}
+def _format_codes(fcs):
+    fcs = tuple(fcs)
+    data = _format_code_bytes.get(fcs)
+    if data == None:
+        data = struct.pack("!h%dh" % len(fcs), len(fcs), *fcs)
+        if len(_format_code_bytes) < 1000:
+            _format_code_bytes[fcs] = data
+    return data
+
+# Serializes a message that implements serialize_into, for the callers that
+# need the message as a string.
+def _serialize(msg):
+    out = SendBuffer(64)
+    msg.serialize_into(out)
+    return out.getvalue()
+
+
 ##
 # An SSLRequest message.  To initiate an SSL-encrypted connection, an
 # SSLRequest message is used rather than a {@link StartupMessage
@@ -58,6 +118,24 @@ class SSLRequest(object):
         return struct.pack("!ii", 8, 80877103)
 
 
+##
+# Asks the server to cancel the query running on another connection.  It is
+# sent on a new connection, in place of a StartupMessage.
+# <p>
+# Stability: This is an internal class.  No stability guarantee is made.
+class CancelRequest(object):
+    def __init__(self, process_id, secret_key):
+        self.process_id = process_id
+        self.secret_key = secret_key
+
+    # Int32(16) - Message length, including self.<br>
+    # Int32(80877102) - The cancel request code.<br>
+    # Int32 - The process ID of the target backend.<br>
+    # Int32 - The secret key for the target backend.<br>
+    def serialize(self):
+        return struct.pack("!iiii", 16, 80877102, self.process_id, self.secret_key)
+
+
 ##
 # A StartupMessage message.  Begins a DB session, identifying the user to be
 # authenticated as and the database to connect to.
@@ -175,28 +253,36 @@ class Bind(object):
     # Int16 - The number of result-column format codes.
     # For each result-column format code:
     #   Int16 - The format code.
-    def serialize(self):
-        retval = StringIO()
-        retval.write(self.portal + "\x00")
-        retval.write(self.ps + "\x00")
-        retval.write(struct.pack("!h", len(self.in_fc)))
-        for fc in self.in_fc:
-            retval.write(struct.pack("!h", fc))
-        retval.write(struct.pack("!h", len(self.params)))
-        for param in self.params:
+    def serialize_into(self, out):
+        params = self.params
+        values = []
+        append = values.append
+        for param in params:
             if param == None:
                 # special case, NULL value
-                retval.write(struct.pack("!i", -1))
+                append("\xff\xff\xff\xff")
             else:
-                retval.write(struct.pack("!i", len(param)))
-                retval.write(param)
-        retval.write(struct.pack("!h", len(self.out_fc)))
-        for fc in self.out_fc:
-            retval.write(struct.pack("!h", fc))
-        val = retval.getvalue()
-        val = struct.pack("!i", len(val) + 4) + val
-        val = "B" + val
-        return val
+                append(_pack_int32(len(param)))
+                append(param)
+        append(_format_codes(self.out_fc))
+        values = "".join(values)
+        key = (len(self.portal), len(self.ps))
+        head = _bind_headers.get(key)
+        if head == None:
+            head = _bind_headers[key] = struct.Struct("!ci%dsx%dsx" % key)
+        in_fc = _format_codes(self.in_fc)
+        size = head.size + len(in_fc) + 2 + len(values)
+        pos = out.reserve(size)
+        buf = out.buf
+        head.pack_into(buf, pos, "B", size - 1, self.portal, self.ps)
+        pos += head.size
+        buf[pos:pos + len(in_fc)] = in_fc
+        pos += len(in_fc)
+        _pack_int16_into(buf, pos, len(params))
+        buf[pos + 2:out.end] = values
+
+    def serialize(self):
+        return _serialize(self)
 
 
 ##
@@ -300,6 +386,10 @@ class DescribePreparedStatement(Describe):
 class Flush(object):
     # Byte1('H') - Identifies the message as a flush command.
     # Int32(4) - Length of message, including self.
+    def serialize_into(self, out):
+        pos = out.reserve(5)
+        out.buf[pos:pos + 5] = 'H\x00\x00\x00\x04'
+
     def serialize(self):
         return 'H\x00\x00\x00\x04'
 
@@ -314,6 +404,10 @@ class Flush(object):
 class Sync(object):
     # Byte1('S') - Identifies the message as a sync command.
     # Int32(4) - Length of message, including self.
+    def serialize_into(self, out):
+        pos = out.reserve(5)
+        out.buf[pos:pos + 5] = 'S\x00\x00\x00\x04'
+
     def serialize(self):
         return 'S\x00\x00\x00\x04'
 
@@ -357,11 +451,17 @@ class Execute(object):
     # String -  The name of the portal to execute.
     # Int32 -   Maximum number of rows to return, if portal contains a query that
     #           returns rows.  0 = no limit.
+    def serialize_into(self, out):
+        head = _execute_headers.get(len(self.portal))
+        if head == None:
+            head = _execute_headers[len(self.portal)] = \
+                    struct.Struct("!ci%dsxi" % len(self.portal))
+        pos = out.reserve(head.size)
+        head.pack_into(out.buf, pos, "E", head.size - 1, self.portal,
+                self.row_count)
+
     def serialize(self):
-        val = self.portal + "\x00" + struct.pack("!i", self.row_count)
-        val = struct.pack("!i", len(val) + 4) + val
-        val = "E" + val
-        return val
+        return _serialize(self)
 
 
 ##
@@ -733,6 +833,8 @@ class ParameterDescription(object):
 class RowDescription(object):
     def __init__(self, fields):
         self.fields = fields
+        # (settings, decode function) cached by Connection._row_decoder.
+        self._decoder = None
 
     def createFromData(data):
         count = struct.unpack("!h", data[:2])[0]
@@ -776,18 +878,24 @@ class DataRow(object):
     def __init__(self, fields):
         self.fields = fields
 
+    # Byte1('D') - Identifier.
+    # Int32 - Message length, including self.
+    # Int16 - Number of column values that follow.
+    # For each column:
+    #   Int32 - Length of the column value, or -1 for NULL.
+    #   Byte[n] - Value of the column.
     def createFromData(data):
-        count = struct.unpack("!h", data[:2])[0]
-        data = data[2:]
+        count = struct.unpack_from("!h", data)[0]
+        pos = 2
         fields = []
         for i in range(count):
-            val_len = struct.unpack("!i", data[:4])[0]
-            data = data[4:]
+            val_len = struct.unpack_from("!i", data, pos)[0]
+            pos += 4
             if val_len == -1:
                 fields.append(None)
             else:
-                fields.append(data[:val_len])
-                data = data[val_len:]
+                fields.append(data[pos:pos + val_len])
+                pos += val_len
         return DataRow(fields)
     createFromData = staticmethod(createFromData)
 
@@ -801,8 +909,13 @@ class CopyData(object):
         return CopyData(data)
     createFromData = staticmethod(createFromData)
     
+    def serialize_into(self, out):
+        pos = out.reserve(5 + len(self.data))
+        struct.pack_into('!ci', out.buf, pos, 'd', len(self.data) + 4)
+        out.buf[pos + 5:out.end] = self.data
+
     def serialize(self):
-        return 'd' + struct.pack('!i', len(self.data) + 4) + self.data
+        return _serialize(self)
 
 
 class CopyDone(object):
@@ -817,6 +930,22 @@ class CopyDone(object):
     def serialize(self):
         return 'c\x00\x00\x00\x04'
 
+
+##
+# Aborts a COPY FROM STDIN.
+# <p>
+# Stability: This is an internal class.  No stability guarantee is made.
+class CopyFail(object):
+    def __init__(self, msg):
+        self.msg = msg
+
+    # Byte1('f') - Identifier.
+    # Int32 - Message length, including self.
+    # String - An error message to report as the cause of failure.
+    def serialize(self):
+        val = self.msg + "\x00"
+        return 'f' + struct.pack('!i', len(val) + 4) + val
+
 class CopyOutResponse(object):
     # Byte1('H')
     # Int32(4) - Length of message contents in bytes, including self.
@@ -852,10 +981,17 @@ class CopyInResponse(object):
     createFromData = staticmethod(createFromData)
 
 
+##
+# Reads messages from the backend and dispatches them to the handlers that
+# have been registered for them.  Handlers are kept in a table keyed by the
+# backend message code, so dispatching a message costs a single dict lookup
+# regardless of how many handlers are registered.
+# <p>
+# Stability: This is an internal class.  No stability guarantee is made.
 class MessageReader(object):
     def __init__(self, connection):
         self._conn = connection
-        self._msgs = []
+        self._msgs = {}
 
         # If true, raise exception from an ErrorResponse after messages are
         # processed.  This can be used to leave the connection in a usable
@@ -866,21 +1002,36 @@ class MessageReader(object):
         self.ignore_unhandled_messages = True
 
     def add_message(self, msg_class, handler, *args, **kwargs):
-        self._msgs.append((msg_class, handler, args, kwargs))
+        code = message_code(msg_class)
+        self._msgs.setdefault(code, []).append((msg_class, handler, args, kwargs))
 
     def clear_messages(self):
-        self._msgs = []
+        self._msgs = {}
 
     def return_value(self, value):
         self._retval = value
-    
-    def handle_messages(self):
+
+    ##
+    # Read and dispatch messages until a handler asks for the loop to end.
+    # If code and data are provided, they are dispatched as the first message
+    # before anything else is read from the connection.
+    def handle_messages(self, code=None, data=None):
         exc = None
+        read = self._conn._read_raw_message
+        msgs = self._msgs
         while 1:
-            msg = self._conn._read_message()
-            msg_handled = False
-            for (msg_class, handler, args, kwargs) in self._msgs:
-                if isinstance(msg, msg_class):
+            if code == None:
+                code, data = read()
+            msg = message_types[code].createFromData(data)
+            handlers = msgs.get(code)
+            code = None
+            if handlers:
+                msg_handled = False
+                for (msg_class, handler, args, kwargs) in handlers:
+                    # Only needed to tell apart the subclasses sharing a
+                    # message code, eg. the Authentication* messages.
+                    if msg.__class__ is not msg_class and not isinstance(msg, msg_class):
+                        continue
                     msg_handled = True
                     retval = handler(msg, *args, **kwargs)
                     if retval:
@@ -892,12 +1043,14 @@ class MessageReader(object):
                     elif hasattr(self, "_retval"):
                         # The handler told us to return -- used for non-true
                         # return values
+                        retval = self._retval
+                        del self._retval
                         if exc != None:
                             raise exc
-                        return self._retval
-            if msg_handled:
-                continue
-            elif isinstance(msg, ErrorResponse):
+                        return retval
+                if msg_handled:
+                    continue
+            if isinstance(msg, ErrorResponse):
                 exc = msg.createException()
                 if not self.delay_raising_exception:
                     raise exc
@@ -910,6 +1063,22 @@ class MessageReader(object):
             elif not self.ignore_unhandled_messages:
                 raise InternalError("Unexpected response msg %r" % (msg))
 
+# Report the time spent in a Connection method to the connection's tracer, as
+# the given phase of the request.
+def traced(phase):
+    def decorate(fn):
+        def _fn(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer == None:
+                return fn(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                tracer.phase(phase, time.time() - start)
+        return _fn
+    return decorate
+
 def sync_on_error(fn):
     def _fn(self, *args, **kwargs):
         try:
@@ -923,26 +1092,40 @@ def sync_on_error(fn):
     return _fn
 
 class Connection(object):
-    def __init__(self, unix_sock=None, host=None, port=5432, socket_timeout=60, ssl=False):
+    # Initial size of the receive buffer.  The buffer grows if a single
+    # message is larger than this.
+    _recv_buffer_size = 128 * 1024
+
+    # Number of parameter sets execute_many sends before reading their
+    # responses.  Bounds how much the server has to buffer for us, so that
+    # neither side blocks writing while the other is writing too.
+    _pipeline_batch_size = 1000
+
+    # Initial size of the send buffer.  A buffer that grew past
+    # _send_buffer_max_size for a large message or batch is replaced by a new
+    # one of the initial size once it has been sent.
+    _send_buffer_size = 8192
+    _send_buffer_max_size = 1024 * 1024
+
+    def __init__(self, unix_sock=None, host=None, port=5432, socket_timeout=60, ssl=False, binary_results=True, tracer=None):
+        # An optional trace.Tracer, or any object with the same methods,
+        # that is told about the messages, network waits and decoding of
+        # this connection.
+        self.tracer = tracer
+        self._recv_time = 0.0
         self._client_encoding = "ascii"
+        self._binary_results = binary_results
         self._integer_datetimes = False
-        self._sock_buf = ""
+        self._sock_buf = bytearray(self._recv_buffer_size)
+        self._sock_buf_view = memoryview(self._sock_buf)
         self._sock_buf_pos = 0
-        self._send_sock_buf = []
+        self._sock_buf_end = 0
+        self._bytes_received = 0
+        self._send_buf = SendBuffer(self._send_buffer_size)
         self._block_size = 8192
         self._sock_lock = threading.Lock()
-        if unix_sock == None and host != None:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        elif unix_sock != None:
-            if not hasattr(socket, "AF_UNIX"):
-                raise InterfaceError("attempt to connect to unix socket on unsupported platform")
-            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        else:
-            raise ProgrammingError("one of host or unix_sock must be provided")
-        if unix_sock == None and host != None:
-            self._sock.connect((host, port))
-        elif unix_sock != None:
-            self._sock.connect(unix_sock)
+        self._address = (unix_sock, host, port, socket_timeout)
+        self._sock = self._connect_socket()
         if ssl:
             self._sock_lock.acquire()
             try:
@@ -967,49 +1150,158 @@ class Connection(object):
 
         self.ParameterStatusReceived += self._onParameterStatusReceived
 
+        # Reused by _fetch for every batch of rows; the portal and row
+        # handler of the current fetch are kept in _fetch_state.
+        self._fetch_state = None
+        self._fetch_reader = MessageReader(self)
+        self._fetch_reader.add_message(DataRow, self._fetch_datarow)
+        self._fetch_reader.add_message(PortalSuspended, lambda msg: 1)
+        self._fetch_reader.add_message(CommandComplete, self._fetch_commandcomplete)
+        # Execute is followed by a Flush, not a Sync, so after an error (eg.
+        # the statement was cancelled) the server sends nothing more until
+        # it gets one.  Raise right away; sync_on_error sends the Sync.
+        self._fetch_reader.delay_raising_exception = False
+
+    # Open a new socket to the server this connection was made to.
+    def _connect_socket(self):
+        unix_sock, host, port, socket_timeout = self._address
+        if unix_sock == None and host != None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        elif unix_sock != None:
+            if not hasattr(socket, "AF_UNIX"):
+                raise InterfaceError("attempt to connect to unix socket on unsupported platform")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            raise ProgrammingError("one of host or unix_sock must be provided")
+        if unix_sock == None and host != None:
+            sock.connect((host, port))
+        elif unix_sock != None:
+            sock.connect(unix_sock)
+        return sock
+
+    ##
+    # Ask the server to cancel the query running on this connection, if any.
+    # The request is sent over a separate connection, without taking the
+    # socket lock, so it can be made from another thread while a query is
+    # running.  The cancelled query fails with an ErrorResponse.  There's no
+    # guarantee that the server acts on the request, or acts on it before the
+    # query completes.
+    def cancel(self):
+        if self._backend_key_data == None:
+            raise InterfaceError("no backend key data, can't cancel")
+        sock = self._connect_socket()
+        try:
+            sock.settimeout(self._address[3])
+            sock.sendall(CancelRequest(self._backend_key_data.process_id,
+                    self._backend_key_data.secret_key).serialize())
+            # the server closes the connection once it has the request
+            sock.recv(1)
+        finally:
+            sock.close()
+
     def verifyState(self, state):
         if self._state != state:
             raise InternalError("connection state must be %s, is %s" % (state, self._state))
 
+    # Messages on the hot paths (Bind, Execute, Sync, Flush, CopyData) pack
+    # themselves straight into the send buffer; the others are serialized to a
+    # string first and copied in.
     def _send(self, msg):
         assert self._sock_lock.locked()
         #print "_send(%r)" % msg
-        data = msg.serialize()
-        if not isinstance(data, str):
-            raise TypeError("bytes data expected")
-        self._send_sock_buf.append(data)
+        out = self._send_buf
+        start = out.end
+        if hasattr(msg, "serialize_into"):
+            msg.serialize_into(out)
+        else:
+            data = msg.serialize()
+            if not isinstance(data, str):
+                raise TypeError("bytes data expected")
+            out.write(data)
+        if self.tracer != None:
+            self.tracer.message_sent(msg, out.end - start)
     
     def _flush(self):
         assert self._sock_lock.locked()
-        self._sock.sendall("".join(self._send_sock_buf))
-        del self._send_sock_buf[:]
+        out = self._send_buf
+        try:
+            self._sock.sendall(buffer(out.buf, 0, out.end))
+        finally:
+            out.clear()
+        if len(out.buf) > self._send_buffer_max_size:
+            self._send_buf = SendBuffer(self._send_buffer_size)
+
+    # Make sure at least byte_count bytes are available in the receive buffer,
+    # starting at _sock_buf_pos.  Data is received directly into the reusable
+    # buffer with recv_into; the buffer is only compacted or grown when the
+    # message being read doesn't fit in the remaining space.
+    def _fill_buffer(self, byte_count):
+        buf = self._sock_buf
+        pos = self._sock_buf_pos
+        end = self._sock_buf_end
+        if end - pos >= byte_count:
+            return
+        if pos + byte_count > len(buf):
+            avail = end - pos
+            if byte_count > len(buf):
+                newbuf = bytearray(max(byte_count, len(buf) * 2))
+                newbuf[:avail] = buf[pos:end]
+                self._sock_buf = buf = newbuf
+                self._sock_buf_view = memoryview(newbuf)
+            elif avail:
+                buf[:avail] = buf[pos:end]
+            pos, end = 0, avail
+            self._sock_buf_pos = 0
+        view = self._sock_buf_view
+        while end - pos < byte_count:
+            if self.tracer != None:
+                start = time.time()
+                n = self._sock.recv_into(view[end:])
+                elapsed = time.time() - start
+                self._recv_time += elapsed
+                self.tracer.recv(elapsed, n)
+            else:
+                n = self._sock.recv_into(view[end:])
+            if n == 0:
+                self._sock_buf_end = end
+                raise InterfaceError("network error on read")
+            end += n
+            self._bytes_received += n
+        self._sock_buf_end = end
+
+    # Return the number of bytes of backend messages read so far.  Data that
+    # has been received but not read as messages yet isn't counted.
+    def bytes_read(self):
+        return self._bytes_received - (self._sock_buf_end - self._sock_buf_pos)
 
     def _read_bytes(self, byte_count):
-        retval = []
-        bytes_read = 0
-        while bytes_read < byte_count:
-            if self._sock_buf_pos == len(self._sock_buf):
-                self._sock_buf = self._sock.recv(1024)
-                self._sock_buf_pos = 0
-            rpos = min(len(self._sock_buf), self._sock_buf_pos + (byte_count - bytes_read))
-            addt_data = self._sock_buf[self._sock_buf_pos:rpos]
-            bytes_read += (rpos - self._sock_buf_pos)
-            assert bytes_read <= byte_count
-            self._sock_buf_pos = rpos
-            retval.append(addt_data)
-        return "".join(retval)
+        self._fill_buffer(byte_count)
+        pos = self._sock_buf_pos
+        self._sock_buf_pos = pos + byte_count
+        return self._sock_buf_view[pos:pos + byte_count].tobytes()
+
+    # Read the next message from the backend, returning its message code and
+    # undecoded body.
+    def _read_raw_message(self):
+        assert self._sock_lock.locked()
+        # The message header is parsed in place; only the message body is
+        # copied out of the receive buffer.
+        self._fill_buffer(5)
+        pos = self._sock_buf_pos
+        message_code = chr(self._sock_buf[pos])
+        data_len = struct.unpack_from("!i", self._sock_buf, pos + 1)[0] - 4
+        self._sock_buf_pos = pos + 5
+        if self.tracer != None:
+            self.tracer.message_received(message_code, data_len + 5)
+        return message_code, self._read_bytes(data_len)
 
     def _read_message(self):
-        assert self._sock_lock.locked()
-        bytes = self._read_bytes(5)
-        message_code = bytes[0]
-        data_len = struct.unpack("!i", bytes[1:])[0] - 4
-        bytes = self._read_bytes(data_len)
-        assert len(bytes) == data_len
+        message_code, bytes = self._read_raw_message()
         msg = message_types[message_code].createFromData(bytes)
         #print "_read_message() -> %r" % msg
         return msg
 
+    @traced("auth")
     def authenticate(self, user, **kwargs):
         self.verifyState("noauth")
         self._sock_lock.acquire()
@@ -1043,6 +1335,7 @@ class Connection(object):
     def _receive_backend_key_data(self, msg):
         self._backend_key_data = msg
 
+    @traced("parse")
     @sync_on_error
     def parse(self, statement, qs, param_types):
         self.verifyState("ready")
@@ -1072,6 +1365,7 @@ class Connection(object):
 
         return reader.handle_messages()
 
+    @traced("bind")
     @sync_on_error
     def bind(self, portal, statement, params, parse_data, copy_stream):
         self.verifyState("ready")
@@ -1083,7 +1377,7 @@ class Connection(object):
         else:
             # We've got row_desc that allows us to identify what we're going to
             # get back from this statement.
-            output_fc = [types.py_type_info(f) for f in row_desc.fields]
+            output_fc = [types.py_type_info(f, self._binary_results) for f in row_desc.fields]
         self._send(Bind(portal, statement, param_fc, params, output_fc, client_encoding = self._client_encoding, integer_datetimes = self._integer_datetimes))
         # We need to describe the portal after bind, since the return
         # format codes will be different (hopefully, always what we
@@ -1110,15 +1404,31 @@ class Connection(object):
 
         return reader.handle_messages()
 
+    # fileobj is either a file-like object, which is read in _block_size
+    # blocks, or an iterable of byte strings, each of which is sent as one
+    # CopyData message.  Each message is sent before the next one is read, so
+    # a slow server holds up the producer rather than data piling up here.
     def _copy_in_response(self, copyin, fileobj, old_reader):
         if fileobj == None:
             raise CopyQueryWithoutStreamError()
-        while True:
-            data = fileobj.read(self._block_size)
-            if not data:
-                break
-            self._send(CopyData(data))
+        if hasattr(fileobj, "read"):
+            chunks = iter(lambda: fileobj.read(self._block_size), "")
+        else:
+            chunks = fileobj
+        try:
+            for data in chunks:
+                if isinstance(data, unicode):
+                    data = data.encode(self._client_encoding)
+                if data:
+                    self._send(CopyData(data))
+                    self._flush()
+        except Exception, e:
+            # The server ignores Sync until the copy ends, so the copy has to
+            # be failed before sync_on_error can sync.
+            self._send_buf.clear()
+            self._send(CopyFail(str(e)))
             self._flush()
+            raise
         self._send(CopyDone())
         self._send(Sync())
         self._flush()
@@ -1151,39 +1461,136 @@ class Connection(object):
 
         old_reader.return_value((None, output['msg']))
 
+    ##
+    # Bind and execute statement once for each sequence of parameters in
+    # param_sets, without waiting for the server between executions.  Only a
+    # single Sync is sent, after the last execution.  The statement must not
+    # return rows.  Returns the total number of rows affected, or -1 if the
+    # server doesn't report it.
+    @traced("execute_many")
+    @sync_on_error
+    def execute_many(self, statement, param_sets, parse_data):
+        self.verifyState("ready")
+
+        row_desc, param_fc = parse_data
+        if row_desc != None:
+            raise ProgrammingError("execute_many can't be used with a statement that returns rows")
+
+        output = {"rows": 0}
+        reader = MessageReader(self)
+        reader.add_message(BindComplete, lambda msg: 0)
+        reader.add_message(CommandComplete, self._execute_many_complete, output)
+        reader.add_message(ReadyForQuery, lambda msg: 1)
+        # Until the Sync is sent, an error is raised right away, and
+        # sync_on_error syncs for us.
+        reader.delay_raising_exception = False
+
+        for i in range(0, len(param_sets), self._pipeline_batch_size):
+            batch = param_sets[i:i + self._pipeline_batch_size]
+            for params in batch:
+                self._send(Bind("", statement, param_fc, params, (), client_encoding = self._client_encoding, integer_datetimes = self._integer_datetimes))
+                self._send(Execute("", 0))
+            if i + len(batch) < len(param_sets):
+                # read this batch's results before sending more
+                self._send(Flush())
+                self._flush()
+                output["remaining"] = len(batch)
+                reader.handle_messages()
+        self._send(Sync())
+        self._flush()
+        output["remaining"] = None
+        # read up to the ReadyForQuery for our Sync before raising any error
+        reader.delay_raising_exception = True
+        reader.handle_messages()
+        return output["rows"]
+
+    def _execute_many_complete(self, msg, output):
+        if msg.rows == None or output["rows"] == -1:
+            output["rows"] = -1
+        else:
+            output["rows"] += msg.rows
+        if output["remaining"] != None:
+            output["remaining"] -= 1
+            return output["remaining"] == 0
+        return False
+
+    @traced("fetch")
     @sync_on_error
     def fetch_rows(self, portal, row_count, row_desc):
+        rows = []
+        append = rows.append
+        decode = self._row_decoder(row_desc)
+        end_of_data = self._fetch(portal, row_count,
+                lambda fields: append(decode(fields)))
+        return end_of_data, rows
+
+    ##
+    # Read all remaining rows of portal into a types.ColumnBuilder instead of
+    # decoding them into rows.
+    @traced("fetch")
+    @sync_on_error
+    def fetch_columns(self, portal, columns):
+        self._fetch(portal, 0, columns.add_row)
+
+    ##
+    # Return a types.ColumnBuilder for row_desc, set up for the current
+    # connection settings.
+    def column_builder(self, row_desc, use_numpy=False):
+        return types.ColumnBuilder(row_desc.fields, use_numpy,
+                client_encoding=self._client_encoding,
+                integer_datetimes=self._integer_datetimes)
+
+    # Execute portal for up to row_count rows (0 for all), passing the fields
+    # of every DataRow to add_row.  Returns true once the end of the data is
+    # reached.
+    def _fetch(self, portal, row_count, add_row):
         self.verifyState("ready")
 
         self._send(Execute(portal, row_count))
         self._send(Flush())
         self._flush()
-        rows = []
+        self._fetch_state = (portal, add_row)
+        if self.tracer != None:
+            start, recv_time = time.time(), self._recv_time
+
+        # DataRow messages make up nearly all of the traffic here, so they
+        # are decoded in a tight loop.  Anything else is passed on to the
+        # reader, which also handles any DataRow that follows, eg. a notice.
+        read = self._read_raw_message
+        create_datarow = DataRow.createFromData
+        while 1:
+            code, data = read()
+            if code != "D":
+                retval = self._fetch_reader.handle_messages(code, data)
+                break
+            add_row(create_datarow(data).fields)
 
-        reader = MessageReader(self)
-        reader.add_message(DataRow, self._fetch_datarow, rows, row_desc)
-        reader.add_message(PortalSuspended, lambda msg: 1)
-        reader.add_message(CommandComplete, self._fetch_commandcomplete, portal)
-        retval = reader.handle_messages()
+        if self.tracer != None:
+            # everything but waiting for the network is decoding
+            self.tracer.decode(time.time() - start - (self._recv_time - recv_time))
 
         # retval = 2 when command complete, indicating that we've hit the
         # end of the available data for this command
-        return (retval == 2), rows
-
-    def _fetch_datarow(self, msg, rows, row_desc):
-        rows.append(
-            [
-                types.py_value(
-                    msg.fields[i],
-                    row_desc.fields[i],
+        return retval == 2
+
+    def _fetch_datarow(self, msg):
+        portal, add_row = self._fetch_state
+        add_row(msg.fields)
+
+    # Return the row decoder for a result set, building it on first use.  The
+    # decoder is specialized for the current client_encoding and
+    # integer_datetimes settings, so it is rebuilt if the server changes them.
+    def _row_decoder(self, row_desc):
+        settings = (self._client_encoding, self._integer_datetimes)
+        if row_desc._decoder == None or row_desc._decoder[0] != settings:
+            decode = types.py_row_decoder(row_desc.fields,
                     client_encoding=self._client_encoding,
-                    integer_datetimes=self._integer_datetimes,
-                )
-                for i in range(len(msg.fields))
-            ]
-        )
+                    integer_datetimes=self._integer_datetimes)
+            row_desc._decoder = (settings, decode)
+        return row_desc._decoder[1]
 
-    def _fetch_commandcomplete(self, msg, portal):
+    def _fetch_commandcomplete(self, msg):
+        portal = self._fetch_state[0]
         self._send(ClosePortal(portal))
         self._send(Sync())
         self._flush()
@@ -1211,6 +1618,7 @@ class Connection(object):
         reader.add_message(ReadyForQuery, lambda msg: True)
         reader.handle_messages()
 
+    @traced("close")
     def close_statement(self, statement):
         if self._state == "closed":
             return
@@ -1228,6 +1636,7 @@ class Connection(object):
         finally:
             self._sock_lock.release()
 
+    @traced("close")
     def close_portal(self, portal):
         if self._state == "closed":
             return
@@ -1274,6 +1683,29 @@ class Connection(object):
         # This should be safe to do without a lock
         return self._sock.fileno()
     
+    ##
+    # Check that the server is still there, with a round trip: send a Sync
+    # and wait up to timeout seconds for the ReadyForQuery that answers it.
+    # Raises socket.timeout if it doesn't come, or InterfaceError if the
+    # connection has been closed.  Must not be called while a statement is
+    # running.
+    def ping(self, timeout):
+        self.verifyState("ready")
+        self._sock_lock.acquire()
+        try:
+            old_timeout = self._sock.gettimeout()
+            self._sock.settimeout(timeout)
+            try:
+                self._send(Sync())
+                self._flush()
+                reader = MessageReader(self)
+                reader.add_message(ReadyForQuery, lambda msg: True)
+                reader.handle_messages()
+            finally:
+                self._sock.settimeout(old_timeout)
+        finally:
+            self._sock_lock.release()
+
     def isready(self):
         self._sock_lock.acquire()
         try:
@@ -1309,4 +1741,16 @@ message_types = {
     "H": CopyOutResponse,
     }
 
+# Message class -> backend message code, used to build MessageReader dispatch
+# tables.
+message_codes = dict((klass, code) for code, klass in message_types.items())
+
+def message_code(msg_class):
+    # Subclasses such as AuthenticationOk share the code of their base class.
+    for klass in msg_class.__mro__:
+        code = message_codes.get(klass)
+        if code != None:
+            return code
+    raise InternalError("%r is not a backend message" % (msg_class,))
+
 
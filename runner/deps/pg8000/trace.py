@@ -0,0 +1,93 @@
+# vim: sw=4:expandtab:foldmethod=marker
+#
+# This module was added to the copy of pg8000 bundled with the benchmark
+# runner; it isn't part of pg8000 as released by Mathieu Fenniak.  It is
+# distributed under the same BSD license terms as the rest of the
+# package.
+
+import time
+import protocol
+
+##
+# Collects message counts, byte counts and timings from a connection.  Pass
+# one as the tracer argument when connecting, or set a connection's tracer
+# attribute; call {@link #Tracer.reset reset} before and {@link
+# #Tracer.summary summary} after the work to be measured, eg. one execute.
+# <p>
+# The methods other than reset and summary are the hooks the connection
+# calls.  Subclasses can override them to log or forward events; they're
+# called with the connection's socket lock held, so should be quick.
+# <p>
+# Stability: Extension to v1.xx, no stability guarantee is made.
+class Tracer(object):
+    def __init__(self):
+        self.reset()
+
+    ##
+    # Clear everything collected so far.
+    def reset(self):
+        self.start_time = time.time()
+        # message class name -> count
+        self.messages_sent = {}
+        self.messages_received = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.recv_calls = 0
+        self.recv_time = 0.0
+        self.decode_time = 0.0
+        # phase name, eg. "parse" or "fetch" -> seconds
+        self.phase_time = {}
+
+    ##
+    # Called for every message queued for sending, with its serialized size.
+    def message_sent(self, msg, byte_count):
+        name = msg.__class__.__name__
+        self.messages_sent[name] = self.messages_sent.get(name, 0) + 1
+        self.bytes_sent += byte_count
+
+    ##
+    # Called for every message read, with its code and size.
+    def message_received(self, code, byte_count):
+        msg_class = protocol.message_types.get(code)
+        name = msg_class.__name__ if msg_class != None else code
+        self.messages_received[name] = self.messages_received.get(name, 0) + 1
+        self.bytes_received += byte_count
+
+    ##
+    # Called for every recv call, with the time it blocked for and the number
+    # of bytes it returned.
+    def recv(self, seconds, byte_count):
+        self.recv_calls += 1
+        self.recv_time += seconds
+
+    ##
+    # Called after a batch of rows is read, with the time spent parsing and
+    # decoding them, excluding network waits.
+    def decode(self, seconds):
+        self.decode_time += seconds
+
+    ##
+    # Called when a request phase completes: "auth", "parse", "bind" (which
+    # includes running statements that return no rows), "fetch",
+    # "execute_many" or "close".
+    def phase(self, name, seconds):
+        self.phase_time[name] = self.phase_time.get(name, 0.0) + seconds
+
+    ##
+    # Return what was collected since the last reset as a dict.  elapsed is
+    # the wall time since the reset, recv_time the part of it spent waiting
+    # for the server (server time plus network), and client_time the rest.
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return {
+            "elapsed": elapsed,
+            "recv_time": self.recv_time,
+            "client_time": elapsed - self.recv_time,
+            "decode_time": self.decode_time,
+            "recv_calls": self.recv_calls,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "messages_sent": dict(self.messages_sent),
+            "messages_received": dict(self.messages_received),
+            "phase_time": dict(self.phase_time),
+        }
@@ -29,10 +29,13 @@
 
 __author__ = "Mathieu Fenniak"
 
+import array
 import datetime
 import decimal
 import struct
 import math
+import sys
+from itertools import izip
 from errors import (NotSupportedError, ArrayDataParseError, InternalError,
         ArrayContentEmptyError, ArrayContentNotHomogenousError,
         ArrayContentNotSupportedError, ArrayDimensionsNotConsistentError)
@@ -50,6 +53,11 @@ except ImportError:
             return ZERO
     utc = UTC()
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Bytea(str):
     pass
 
@@ -155,13 +163,17 @@ def pg_value(value, fc, **kwargs):
         raise NotSupportedError("type %r, format code %r not supported" % (typ, fc))
     return func(value, **kwargs)
 
-def py_type_info(description):
+##
+# Return the format code to request for a result column.  Binary is preferred
+# unless binary is false, in which case text is used for every type that can
+# be read as text.
+def py_type_info(description, binary=True):
     type_oid = description['type_oid']
     data = pg_types.get(type_oid)
     if data == None:
         raise NotSupportedError("type oid %r not mapped to py type" % type_oid)
     # prefer bin, but go with whatever exists
-    if data.get("bin_in"):
+    if data.get("bin_in") and (binary or not data.get("txt_in")):
         format = 1
     elif data.get("txt_in"):
         format = 0
@@ -188,9 +200,119 @@ def py_value(v, description, **kwargs):
         raise NotSupportedError("data response format %r, type %r not supported" % (format, type_oid))
     return func(v, **kwargs)
 
+##
+# Return a callable that converts a single non-NULL column value described by
+# description into a Python value.  The type and format lookups are done once,
+# here, and decoders for common types are specialized on kwargs so that no
+# keyword arguments need to be passed per value.
+def py_decoder(description, **kwargs):
+    type_oid = description['type_oid']
+    format = description['format']
+    data = pg_types.get(type_oid)
+    if data == None:
+        raise NotSupportedError("type oid %r not supported" % type_oid)
+    if format == 0:
+        func = data.get("txt_in")
+    elif format == 1:
+        func = data.get("bin_in")
+    else:
+        raise NotSupportedError("format code %r not supported" % format)
+    if func == None:
+        raise NotSupportedError("data response format %r, type %r not supported" % (format, type_oid))
+    factory = pg_decoder_factories.get(func)
+    if factory != None:
+        return factory(**kwargs)
+    return lambda v: func(v, **kwargs)
+
+##
+# Return a function that converts the fields of a DataRow into a tuple of
+# Python values, for rows with the given row description fields.  Meant to be
+# built once per result set.
+def py_row_decoder(descriptions, **kwargs):
+    decoders = [py_decoder(d, **kwargs) for d in descriptions]
+    def decode(fields):
+        return tuple([v if v is None else f(v) for f, v in izip(decoders, fields)])
+    return decode
+
+##
+# Collects a result set column by column, for cursors that fetch columns
+# rather than rows.  Binary int2, int4, int8, float4 and float8 columns are
+# kept as raw bytes and turned into an array.array (or a NumPy array, if
+# use_numpy is true) in one step, without creating a Python object per value.
+# Other columns, and any packed column that turns out to contain a NULL, are
+# returned as lists of decoded values.
+class ColumnBuilder(object):
+    def __init__(self, descriptions, use_numpy=False, **kwargs):
+        if use_numpy and numpy == None:
+            raise NotSupportedError("numpy is not installed")
+        self.use_numpy = use_numpy
+        self.row_count = 0
+        self._columns = []
+        self._appenders = []
+        for description in descriptions:
+            decoder = py_decoder(description, **kwargs)
+            typecode = None
+            if description['format'] == 1:
+                typecode = pg_array_typecodes.get(description['type_oid'])
+            # values holds raw bytes for packed columns, decoded values
+            # otherwise; decoded holds rows that were already decoded before
+            # the builder was used, see add_decoded_row.
+            values, decoded = [], []
+            self._columns.append((typecode, decoder, values, decoded))
+            if typecode != None:
+                self._appenders.append(values.append)
+            else:
+                self._appenders.append(
+                        lambda v, append=values.append, decode=decoder:
+                            append(v if v is None else decode(v)))
+
+    ##
+    # Add the raw fields of a DataRow.
+    def add_row(self, fields):
+        for append, v in izip(self._appenders, fields):
+            append(v)
+        self.row_count += 1
+
+    ##
+    # Add a row that has already been decoded, eg. from a statement's row
+    # cache.  Must be called before any add_row.
+    def add_decoded_row(self, row):
+        for column, v in izip(self._columns, row):
+            column[3].append(v)
+        self.row_count += 1
+
+    ##
+    # Return the collected columns, in row description order.
+    def columns(self):
+        return [self._column(*c) for c in self._columns]
+
+    def _column(self, typecode, decoder, values, decoded):
+        if typecode == None:
+            values = decoded + values
+        elif None in values or None in decoded:
+            values = decoded + [v if v is None else decoder(v) for v in values]
+        elif self.use_numpy:
+            packed = numpy.frombuffer("".join(values), dtype=">" + typecode)
+            return numpy.concatenate((numpy.array(decoded, dtype=typecode),
+                    packed.astype(typecode)))
+        else:
+            column = array.array(typecode, decoded)
+            packed = array.array(typecode)
+            packed.fromstring("".join(values))
+            if sys.byteorder == "little":
+                packed.byteswap()
+            column.extend(packed)
+            return column
+        if self.use_numpy:
+            return numpy.array(values, dtype=object)
+        return values
+
 def boolrecv(data, **kwargs):
     return data == "\x01"
 
+def boolin(data, **kwargs):
+    return data == "t"
+
 def boolsend(v, **kwargs):
     if v:
         return "\x01"
@@ -211,6 +333,12 @@ def int_inspect(value):
     else:
         return {"typeoid": 1700, "bin_out": numeric_send}
 
+def int_in(data, **kwargs):
+    return int(data)
+
+def oidrecv(data, **kwargs):
+    return struct.unpack("!I", data)[0]
+
 def int2recv(data, **kwargs):
     return struct.unpack("!h", data)[0]
 
@@ -238,6 +366,9 @@ def float8recv(data, **kwargs):
 def float8send(v, **kwargs):
     return struct.pack("!d", v)
 
+def float_in(data, **kwargs):
+    return float(data)
+
 def datetime_inspect(value):
     if value.tzinfo != None:
         # send as timestamptz if timezone is provided
@@ -283,6 +414,10 @@ def date_in(data, **kwargs):
     day = int(data[8:10])
     return datetime.date(year, month, day)
 
+# data is a 32-bit integer representing days since 2000-01-01
+def date_recv(data, **kwargs):
+    return datetime.date(2000, 1, 1) + datetime.timedelta(days = struct.unpack("!i", data)[0])
+
 def date_out(v, **kwargs):
     return v.isoformat()
 
@@ -292,6 +427,18 @@ def time_in(data, **kwargs):
     sec = decimal.Decimal(data[6:])
     return datetime.time(hour, minute, int(sec), int((sec - int(sec)) * 1000000))
 
+def time_recv(data, integer_datetimes, **kwargs):
+    if integer_datetimes:
+        # data is 64-bit integer representing microseconds since midnight
+        val = struct.unpack("!q", data)[0]
+    else:
+        # data is double-precision float representing seconds since midnight
+        val = int(round(struct.unpack("!d", data)[0] * 1000000))
+    seconds, microsecond = divmod(val, 1000000)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return datetime.time(hour, minute, second, microsecond)
+
 def time_out(v, **kwargs):
     return v.isoformat()
 
@@ -301,19 +448,25 @@ def numeric_in(data, **kwargs):
     else:
         return decimal.Decimal(data)
 
+# The base 10000 digits are formatted into a single decimal digit string and
+# converted in one step, rather than summing a Decimal per digit.  The result
+# has dscale fractional digits, the same as the value's text representation.
 def numeric_recv(data, **kwargs):
     num_digits, weight, sign, scale = struct.unpack("!hhhh", data[:8])
-    data = data[8:]
-    digits = struct.unpack("!" + ("h" * num_digits), data)
-    weight = decimal.Decimal(weight)
-    retval = 0
-    for d in digits:
-        d = decimal.Decimal(d)
-        retval += d * (10000 ** weight)
-        weight -= 1
+    if sign == -0x4000:
+        # 0xC000, NaN
+        return decimal.Decimal("NaN")
+    if num_digits == 0:
+        return 0
+    digits = ("%04d" * num_digits) % struct.unpack("!" + ("h" * num_digits), data[8:])
+    fraction = (num_digits - weight - 1) * 4
+    if fraction > scale:
+        digits = digits[:scale - fraction] or "0"
+    else:
+        digits += "0" * (scale - fraction)
     if sign:
-        retval *= -1
-    return retval
+        digits = "-" + digits
+    return decimal.Decimal("%sE-%d" % (digits, scale))
 
 def numeric_send(v, **kwargs):
     sign = 0
@@ -618,16 +771,16 @@ py_array_types = {
 }
 
 pg_types = {
-    16: {"bin_in": boolrecv},
+    16: {"bin_in": boolrecv, "txt_in": boolin},
     17: {"bin_in": bytearecv},
     19: {"bin_in": varcharin}, # name type
-    20: {"bin_in": int8recv},
-    21: {"bin_in": int2recv},
-    23: {"bin_in": int4recv},
+    20: {"bin_in": int8recv, "txt_in": int_in},
+    21: {"bin_in": int2recv, "txt_in": int_in},
+    23: {"bin_in": int4recv, "txt_in": int_in},
     25: {"bin_in": varcharin}, # TEXT type
-    26: {"txt_in": numeric_in}, # oid type
-    700: {"bin_in": float4recv},
-    701: {"bin_in": float8recv},
+    26: {"bin_in": oidrecv, "txt_in": numeric_in}, # oid type
+    700: {"bin_in": float4recv, "txt_in": float_in},
+    701: {"bin_in": float8recv, "txt_in": float_in},
     829: {"txt_in": varcharin}, # MACADDR type
     1000: {"bin_in": array_recv}, # BOOL[]
     1003: {"bin_in": array_recv}, # NAME[]
@@ -641,14 +794,67 @@ pg_types = {
     1022: {"bin_in": array_recv}, # FLOAT8[]
     1042: {"bin_in": varcharin}, # CHAR type
     1043: {"bin_in": varcharin}, # VARCHAR type
-    1082: {"txt_in": date_in},
-    1083: {"txt_in": time_in},
+    1082: {"bin_in": date_recv, "txt_in": date_in},
+    1083: {"bin_in": time_recv, "txt_in": time_in},
     1114: {"bin_in": timestamp_recv},
     1184: {"bin_in": timestamptz_recv}, # timestamp w/ tz
     1186: {"bin_in": interval_recv},
     1231: {"bin_in": array_recv}, # NUMERIC[]
     1263: {"bin_in": array_recv}, # cstring[]
-    1700: {"bin_in": numeric_recv},
+    1700: {"bin_in": numeric_recv, "txt_in": numeric_in},
     2275: {"bin_in": varcharin}, # cstring
 }
 
+def unpack_decoder(fmt):
+    unpack = struct.Struct(fmt).unpack
+    def factory(**kwargs):
+        return lambda data: unpack(data)[0]
+    return factory
+
+def varchar_decoder(client_encoding, **kwargs):
+    encoding = encoding_convert(client_encoding)
+    return lambda data: unicode(data, encoding)
+
+def date_decoder(**kwargs):
+    epoch = datetime.date(2000, 1, 1)
+    timedelta = datetime.timedelta
+    unpack = struct.Struct("!i").unpack
+    return lambda data: epoch + timedelta(days = unpack(data)[0])
+
+def timestamp_decoder(integer_datetimes, **kwargs):
+    epoch = datetime.datetime(2000, 1, 1)
+    timedelta = datetime.timedelta
+    if integer_datetimes:
+        unpack = struct.Struct("!q").unpack
+        return lambda data: epoch + timedelta(microseconds = unpack(data)[0])
+    else:
+        unpack = struct.Struct("!d").unpack
+        return lambda data: epoch + timedelta(seconds = unpack(data)[0])
+
+# type oid -> array typecode, for binary types whose wire format is a fixed
+# size big-endian value that array.array can load directly.  array has no
+# typecode guaranteed to be 64 bits wide, so int8 is only packed where "l" is.
+pg_array_typecodes = {
+    21: "h",
+    23: "i",
+    700: "f",
+    701: "d",
+}
+if array.array("l").itemsize == 8:
+    pg_array_typecodes[20] = "l"
+
+# receive function -> factory of a decoder specialized for the connection
+# settings, see py_decoder.
+pg_decoder_factories = {
+    boolrecv: lambda **kwargs: lambda data: data == "\x01",
+    int_in: lambda **kwargs: int,
+    float_in: lambda **kwargs: float,
+    int2recv: unpack_decoder("!h"),
+    int4recv: unpack_decoder("!i"),
+    int8recv: unpack_decoder("!q"),
+    float4recv: unpack_decoder("!f"),
+    float8recv: unpack_decoder("!d"),
+    varcharin: varchar_decoder,
+    date_recv: date_decoder,
+    timestamp_recv: timestamp_decoder,
+}
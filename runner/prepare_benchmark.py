@@ -12,6 +12,7 @@ import os
 import time
 from pg8000 import DBAPI
 import pg8000.errors
+from ssh_sessions import sessions
 
 # A scratch directory on your filesystem
 LOCAL_TMP_DIR = "/tmp"
@@ -108,21 +109,21 @@ def parse_args():
 
 # Run a command on a host through ssh, throwing an exception if ssh fails
 def ssh(host, username, identity_file, command):
-  subprocess.check_call(
-      "ssh -t -o StrictHostKeyChecking=no -i %s %s@%s '%s'" %
-      (identity_file, username, host, command), shell=True)
+  sessions.check_call(host, "ssh -t %s %s@%s '%s'" % (
+      sessions.options(host, username, identity_file), username, host,
+      command))
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
 def scp_to(host, identity_file, username, local_file, remote_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s' '%s@%s:%s'" %
-      (identity_file, local_file, username, host, remote_file), shell=True)
+  sessions.check_call(host, "scp -q %s '%s' '%s@%s:%s'" % (
+      sessions.options(host, username, identity_file), local_file, username,
+      host, remote_file))
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
 def scp_from(host, identity_file, username, remote_file, local_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s@%s:%s' '%s'" %
-      (identity_file, username, host, remote_file, local_file), shell=True)
+  sessions.check_call(host, "scp -q %s '%s@%s:%s' '%s'" % (
+      sessions.options(host, username, identity_file), username, host,
+      remote_file, local_file))
 
 # Insert AWS credentials into a given XML file on the given remote host
 def add_aws_credentials(remote_host, remote_user, identity_file, 
@@ -349,6 +350,8 @@ def main():
     prepare_shark_dataset(opts)
   if opts.redshift:
     prepare_redshift_dataset(opts)
+  if sessions.masters:
+    print >> stderr, sessions.summary()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,189 @@
+"""Finds performance regressions across the runs in the results store.
+
+   For every engine, scale factor, file format and query, the latest run is
+   compared with the runs before it, and the whole history of run medians
+   is searched for a lasting shift in level:
+
+   - latest run: its median against the medians of the previous
+     --baseline-runs runs. Runs differ from each other by more than their
+     trials do (the cluster is busier, the data is laid out differently),
+     so the runs, not the trials, are the samples: the test is whether the
+     log of the latest median falls outside the prediction interval of the
+     earlier ones. It is a regression (or improvement) if the medians differ
+     by more than --threshold and the test is significant at --alpha. It
+     takes at least two earlier runs.
+   - change point: the split of the run medians into before and after that
+     differs most by a Mann-Whitney test, corrected for the number of splits
+     tried. Reported if it is significant and the medians of the two sides
+     differ by more than the threshold, which catches slow drifts that no
+     single run shows.
+
+   Every night tests every series twice, so some test would come out
+   significant by chance on most nights. The p values of all the tests in a
+   report are adjusted together (Holm), so that a report of stable series
+   has a regression in it with a chance of at most --alpha.
+
+   Prints a line per flagged query (or per query with --all) and exits with
+   1 if there were any regressions, eg. for a nightly job:
+
+     python regressions.py --threshold 0.1 || mail -s regressions ...
+"""
+
+import math
+import sys
+from optparse import OptionParser
+
+import trial_stats
+from results_store import ResultsStore, DEFAULT_DB
+
+REGRESSION = "REGRESSION"
+IMPROVEMENT = "improvement"
+OK = "ok"
+
+def _status(ratio, p, threshold, alpha):
+  if p is None or p >= alpha:
+    return OK
+  if ratio > 1 + threshold:
+    return REGRESSION
+  if ratio < 1 - threshold:
+    return IMPROVEMENT
+  return OK
+
+def check_latest(runs, baseline_runs):
+  """Compares the median of the last of runs, a list of (run id, started,
+     trial times), with those of up to baseline_runs runs before it.
+     Returns (baseline median, latest median, ratio, p value or None), or
+     None if there is only one run. The p value is None with fewer than two
+     earlier runs, as one run says nothing of how much runs vary."""
+  if len(runs) < 2:
+    return None
+  medians = [trial_stats.median(run[2])
+             for run in runs[-1 - baseline_runs:]]
+  base_median = trial_stats.median(medians[:-1])
+  new_median = medians[-1]
+  if base_median <= 0:
+    return None
+  ratio = new_median / base_median
+  p = None
+  if len(medians) > 2 and min(medians) > 0:
+    p = trial_stats.prediction_test([math.log(m) for m in medians[:-1]],
+                                    math.log(new_median))[1]
+  return base_median, new_median, ratio, p
+
+def check_history(runs):
+  """Looks for a shift in the medians of runs. Returns (run id of the first
+     run after the shift, ratio of the medians after and before, p value),
+     or None if the series is too short to have one."""
+  medians = [trial_stats.median(run[2]) for run in runs]
+  index, p = trial_stats.change_point(medians)
+  if index is None:
+    return None
+  before = trial_stats.median(medians[:index])
+  if before <= 0:
+    return None
+  return runs[index][0], trial_stats.median(medians[index:]) / before, p
+
+def find_regressions(store, threshold=0.05, alpha=0.05, baseline_runs=10,
+                     engine=None, query=None, scale_factor=None,
+                     file_format=None):
+  """The report rows for every series in store matching the given keys:
+     (key, number of runs, latest run id, latest, shift), where key is
+     (engine, scale_factor, file_format, query), latest is (status,
+     baseline median, latest median, ratio, p value) or None, and shift is
+     (status, run id, ratio, p value), or None unless it is flagged. The p
+     values are Holm adjusted over all the tests of the report."""
+  series = store.series(engine, query, scale_factor, file_format)
+  keys = sorted(series)
+  latest = [check_latest(series[key], baseline_runs) for key in keys]
+  shifts = [check_history(series[key]) for key in keys]
+  p_values = trial_stats.holm([l[3] if l is not None else None
+                               for l in latest] +
+                              [s[2] if s is not None else None
+                               for s in shifts])
+  rows = []
+  for n, key in enumerate(keys):
+    runs = series[key]
+    l, s = latest[n], shifts[n]
+    if l is not None:
+      p = p_values[n]
+      l = (_status(l[2], p, threshold, alpha),) + l[:3] + (p,)
+    if s is not None:
+      p = p_values[len(keys) + n]
+      status = _status(s[1], p, threshold, alpha)
+      s = (status,) + s[:2] + (p,) if status != OK else None
+    rows.append((key, len(runs), runs[-1][0], l, s))
+  return rows
+
+def _format_p(p):
+  return "p=%.3f" % p if p is not None else "p=-"
+
+def format_row(row):
+  key, num_runs, run_id, latest, shift = row
+  name = "/".join(str(k) for k in key if k is not None)
+  parts = ["%-24s %3d runs" % (name, num_runs)]
+  if latest is None:
+    parts.append("run %s: no earlier runs" % run_id)
+  else:
+    status, base, new, ratio, p = latest
+    parts.append("run %s: %s %.3fs -> %.3fs (%+.1f%%, %s)" % (
+        run_id, status, base, new, (ratio - 1) * 100, _format_p(p)))
+  if shift is not None:
+    status, shift_run, ratio, p = shift
+    parts.append("shift from run %s: %s %+.1f%% (%s)" % (
+        shift_run, status, (ratio - 1) * 100, _format_p(p)))
+  return "  ".join(parts)
+
+def flagged(row):
+  latest, shift = row[3], row[4]
+  return (latest is not None and latest[0] != OK) or shift is not None
+
+def parse_args():
+  parser = OptionParser(usage="regressions.py [options]")
+  parser.add_option("--db", default=DEFAULT_DB,
+      help="Results database (default %default)")
+  parser.add_option("--threshold", type="float", default=0.05,
+      help="Smallest relative change in the median to flag (default "
+           "%default)")
+  parser.add_option("--alpha", type="float", default=0.05,
+      help="Chance of a false regression in the whole report (default "
+           "%default)")
+  parser.add_option("--baseline-runs", type="int", default=10,
+      help="Number of runs before the latest to compare it with (default "
+           "%default)")
+  parser.add_option("--engine", help="Only this engine, eg. shark_mem")
+  parser.add_option("--query", help="Only this query, eg. 1a")
+  parser.add_option("--scale-factor", help="Only this scale factor")
+  parser.add_option("--file-format", help="Only this file format")
+  parser.add_option("--all", action="store_true", default=False,
+      help="Report every query, not just the flagged ones")
+  (opts, args) = parser.parse_args()
+
+  if args:
+    parser.print_help()
+    sys.exit(1)
+  if opts.baseline_runs < 2:
+    print >> sys.stderr, "--baseline-runs must be at least 2"
+    sys.exit(1)
+  return opts
+
+def main():
+  opts = parse_args()
+  store = ResultsStore(opts.db)
+  rows = find_regressions(store, opts.threshold, opts.alpha,
+                          opts.baseline_runs, opts.engine, opts.query,
+                          opts.scale_factor, opts.file_format)
+  store.close()
+
+  regressions = 0
+  for row in rows:
+    if row[3] is not None and row[3][0] == REGRESSION or \
+       row[4] is not None and row[4][0] == REGRESSION:
+      regressions += 1
+    if opts.all or flagged(row):
+      print format_row(row)
+  print "%s queries checked, %s with regressions, %s flagged" % (
+      len(rows), regressions, len([r for r in rows if flagged(r)]))
+  sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,247 @@
+"""An append-only SQLite store of benchmark results, and a CLI to query it.
+
+   Every run of run_query.py adds a run, keyed by engine, scale factor and
+   file format, with one row per trial holding the query, the trial number,
+   its time in seconds and the raw output it was parsed from. Sub-phase
+   timings (eg. the two parts of query 4, or where a Redshift trial spent its
+   time) go in a phases table. Runs are only ever added, never changed.
+
+   Examples, from the runner directory:
+
+     python results_store.py runs --engine shark_mem --query 1a
+     python results_store.py show 12
+     python results_store.py compare 12 15
+     python results_store.py history --engine redshift --query 2a
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import sys
+from optparse import OptionParser
+
+import trial_stats
+
+DEFAULT_DB = os.path.join("results", "results.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  started TEXT NOT NULL,
+  engine TEXT NOT NULL,
+  scale_factor TEXT,
+  file_format TEXT,
+  options TEXT
+);
+CREATE TABLE IF NOT EXISTS trials (
+  run_id INTEGER NOT NULL REFERENCES runs(id),
+  query TEXT NOT NULL,
+  trial INTEGER NOT NULL,
+  seconds REAL NOT NULL,
+  raw TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+  run_id INTEGER NOT NULL,
+  query TEXT NOT NULL,
+  trial INTEGER NOT NULL,
+  phase TEXT NOT NULL,
+  seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_key
+  ON runs (engine, scale_factor, file_format, started);
+CREATE INDEX IF NOT EXISTS trials_query ON trials (query, run_id);
+CREATE INDEX IF NOT EXISTS trials_run ON trials (run_id, query, trial);
+CREATE INDEX IF NOT EXISTS phases_run ON phases (run_id, query, trial);
+"""
+
+class ResultsStore(object):
+  """Results of benchmark runs in the SQLite database at path."""
+
+  def __init__(self, path=DEFAULT_DB):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.db = sqlite3.connect(path)
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def add_run(self, engine, trials, scale_factor=None, file_format=None,
+              options=None, started=None):
+    """Adds a run and its trials in one transaction; returns the run id.
+
+       trials is a sequence of dicts with the keys query, trial and seconds,
+       and optionally raw (the output the time was parsed from) and phases
+       (a dict of sub-phase name to seconds). options is any JSON-encodable
+       description of how the run was made."""
+    if started is None:
+      started = datetime.datetime.now()
+    with self.db:
+      cur = self.db.execute(
+          "INSERT INTO runs (started, engine, scale_factor, file_format, "
+          "options) VALUES (?, ?, ?, ?, ?)",
+          (started.isoformat(), engine, scale_factor, file_format,
+           json.dumps(options, sort_keys=True)))
+      run_id = cur.lastrowid
+      self.db.executemany(
+          "INSERT INTO trials (run_id, query, trial, seconds, raw) "
+          "VALUES (?, ?, ?, ?, ?)",
+          [(run_id, t["query"], t["trial"], t["seconds"], t.get("raw"))
+           for t in trials])
+      self.db.executemany(
+          "INSERT INTO phases (run_id, query, trial, phase, seconds) "
+          "VALUES (?, ?, ?, ?, ?)",
+          [(run_id, t["query"], t["trial"], phase, seconds)
+           for t in trials
+           for phase, seconds in sorted((t.get("phases") or {}).items())])
+    return run_id
+
+  def runs(self, engine=None, query=None, scale_factor=None,
+           file_format=None, limit=None):
+    """Runs matching all of the given keys, oldest first, as tuples of
+       (id, started, engine, scale_factor, file_format, queries), where
+       queries is a comma separated list of the queries run. With a limit,
+       only that many of the latest runs are returned."""
+    where, args = [], []
+    for column, value in (("engine", engine), ("scale_factor", scale_factor),
+                          ("file_format", file_format)):
+      if value is not None:
+        where.append("runs.%s = ?" % column)
+        args.append(value)
+    if query is not None:
+      where.append("runs.id IN (SELECT run_id FROM trials WHERE query = ?)")
+      args.append(query)
+    sql = ("SELECT runs.id, started, engine, scale_factor, file_format, "
+           "(SELECT group_concat(DISTINCT query) FROM trials "
+           " WHERE run_id = runs.id) FROM runs")
+    if where:
+      sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY started DESC, runs.id DESC"
+    if limit is not None:
+      sql += " LIMIT %d" % limit
+    return list(reversed(self.db.execute(sql, args).fetchall()))
+
+  def trial_times(self, run_id, query):
+    """The times of the trials of query in a run, in trial order."""
+    return [row[0] for row in self.db.execute(
+        "SELECT seconds FROM trials WHERE run_id = ? AND query = ? "
+        "ORDER BY trial", (run_id, query))]
+
+  def queries(self, run_id):
+    return [row[0] for row in self.db.execute(
+        "SELECT DISTINCT query FROM trials WHERE run_id = ? ORDER BY query",
+        (run_id,))]
+
+  def phases(self, run_id, query):
+    """Sub-phase timings of query in a run, as (trial, phase, seconds)."""
+    return self.db.execute(
+        "SELECT trial, phase, seconds FROM phases "
+        "WHERE run_id = ? AND query = ? ORDER BY trial, phase",
+        (run_id, query)).fetchall()
+
+  def compare(self, base_run, new_run):
+    """Per query run in both, (query, base median, new median, new median as
+       a fraction of the base one)."""
+    rows = []
+    for query in self.queries(base_run):
+      base = self.trial_times(base_run, query)
+      new = self.trial_times(new_run, query)
+      if base and new:
+        base_median = trial_stats.median(base)
+        new_median = trial_stats.median(new)
+        rows.append((query, base_median, new_median,
+                     new_median / base_median if base_median else None))
+    return rows
+
+  def history(self, engine, query, scale_factor=None, file_format=None,
+              limit=None):
+    """Per run of query on engine, oldest first: (run id, started, number of
+       trials, median, min)."""
+    rows = []
+    for run in self.runs(engine, query, scale_factor, file_format, limit):
+      times = self.trial_times(run[0], query)
+      rows.append((run[0], run[1], len(times), trial_stats.median(times),
+                   min(times)))
+    return rows
+
+  def series(self, engine=None, query=None, scale_factor=None,
+             file_format=None):
+    """Every run of every query matching the given keys, in one scan. A
+       dict from (engine, scale_factor, file_format, query) to a list of
+       (run id, started, trial times) per run, oldest first."""
+    where, args = [], []
+    for column, value in (("runs.engine", engine),
+                          ("runs.scale_factor", scale_factor),
+                          ("runs.file_format", file_format),
+                          ("trials.query", query)):
+      if value is not None:
+        where.append("%s = ?" % column)
+        args.append(value)
+    sql = ("SELECT engine, scale_factor, file_format, query, runs.id, "
+           "started, seconds FROM runs JOIN trials ON trials.run_id = runs.id")
+    if where:
+      sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY engine, scale_factor, file_format, query, started, " \
+           "runs.id, trial"
+    result = {}
+    for row in self.db.execute(sql, args):
+      runs = result.setdefault(row[:4], [])
+      if not runs or runs[-1][0] != row[4]:
+        runs.append((row[4], row[5], []))
+      runs[-1][2].append(row[6])
+    return result
+
+def parse_args():
+  parser = OptionParser(usage="results_store.py [options] "
+      "runs | show RUN | compare BASE_RUN NEW_RUN | history")
+  parser.add_option("--db", default=DEFAULT_DB,
+      help="Results database (default %default)")
+  parser.add_option("--engine", help="Only runs on this engine, eg. shark_mem")
+  parser.add_option("--query", help="Only runs of this query, eg. 1a")
+  parser.add_option("--scale-factor", help="Only runs at this scale factor")
+  parser.add_option("--file-format", help="Only runs on this file format")
+  parser.add_option("--limit", type="int",
+      help="Only the latest this many runs")
+  (opts, args) = parser.parse_args()
+
+  commands = {"runs": 0, "show": 1, "compare": 2, "history": 0}
+  if not args or args[0] not in commands or \
+     len(args) != commands[args[0]] + 1:
+    parser.print_help()
+    sys.exit(1)
+  if args[0] == "history" and (opts.engine is None or opts.query is None):
+    print >> sys.stderr, "history needs --engine and --query"
+    sys.exit(1)
+  return opts, args
+
+def main():
+  opts, args = parse_args()
+  store = ResultsStore(opts.db)
+  command = args[0]
+  if command == "runs":
+    for row in store.runs(opts.engine, opts.query, opts.scale_factor,
+                          opts.file_format, opts.limit):
+      print "%s\t%s\t%s\t%s\t%s\t%s" % row
+  elif command == "show":
+    run_id = int(args[1])
+    for query in store.queries(run_id):
+      times = store.trial_times(run_id, query)
+      print "%s\tmedian %.3f\tmin %.3f\t%s" % (
+          query, trial_stats.median(times), min(times),
+          ",".join("%.3f" % t for t in times))
+      for trial, phase, seconds in store.phases(run_id, query):
+        print "  trial %s\t%s\t%.3f" % (trial, phase, seconds)
+  elif command == "compare":
+    for query, base, new, ratio in store.compare(int(args[1]), int(args[2])):
+      print "%s\t%.3f\t%.3f\t%s" % (
+          query, base, new, "%.3fx" % ratio if ratio is not None else "-")
+  elif command == "history":
+    for row in store.history(opts.engine, opts.query, opts.scale_factor,
+                             opts.file_format, opts.limit):
+      print "%s\t%s\t%s trials\tmedian %.3f\tmin %.3f" % row
+  store.close()
+
+if __name__ == "__main__":
+  main()
@@ -1,8 +1,9 @@
-"""Run a single query from the big data benchmark on a remote EC2 cluster.
+"""Run queries from the big data benchmark on a remote EC2 cluster.
 
-   This will execute a single query from the benchmark multiple times
-   and output percentile results. Note that to run an entire suite of
-   queries, you'll need to wrap this script and call run multiple times.
+   This will execute a query from the benchmark multiple times and output
+   percentile results. Given a comma separated list of queries, it runs them
+   as a suite: the cluster is set up once and the trials of all queries are
+   run in the order given by --suite-order, with results for each query.
 """
 
 import subprocess
@@ -10,11 +11,23 @@ import sys
 from sys import stderr
 from optparse import OptionParser
 import os
+import random
 import time
 import datetime
 import re
 from StringIO import StringIO
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from pg8000 import DBAPI
+import pg8000.errors
+from pg8000.trace import Tracer
+from ssh_sessions import sessions, DEVNULL
+import trial_stats
+from timing_parser import TimingParser, Statement, split_statements, \
+    join_statements, trial_events, trial_time, trial_phases, HIVE, IMPALA, \
+    SETUP, WARMUP, CACHE_LOAD, CLEAN, QUERY, INSERT
+from results_store import ResultsStore, DEFAULT_DB
+import throughput
 
 # A scratch directory on your filesystem
 LOCAL_TMP_DIR = "/tmp"
@@ -131,7 +144,75 @@ def make_input_cached(query):
 def make_output_cached(query):
   return query.replace(TMP_TABLE, TMP_TABLE_CACHED)
 
+# Turn a given query into one that writes to another table than TMP_TABLE, so
+# that concurrent clients don't clobber each other's results
+def make_output_private(query, table):
+  return re.sub(r"\b%s\b" % TMP_TABLE, table, query)
+
 ### Runner ###
+SUITE_ORDERS = ["sequential", "interleaved", "shuffled"]
+
+# The (query, trial) pairs of a run, in the order they are run. Finished
+# trials are passed to record(), and kept in `trials` for the results store.
+# With a target_ci, a query stops getting trials once it has min_trials and
+# the bootstrap confidence interval of its median is at most target_ci times
+# the median wide; num_trials is then the most trials a query gets. With a
+# time_budget, no trials are started after that many seconds.
+class TrialSchedule(object):
+  def __init__(self, query_nums, num_trials, order, seed=None,
+               target_ci=None, min_trials=3, time_budget=None):
+    self.query_nums = query_nums
+    self.num_trials = num_trials
+    self.order = order
+    # Drawn once, so that every pass over the schedule (eg. printing the
+    # order, then running it) shuffles the same way
+    self.seed = seed if seed is not None else random.randrange(2 ** 32)
+    self.target_ci = target_ci
+    self.min_trials = min_trials
+    self.time_budget = time_budget
+    self.times = dict((q, []) for q in query_nums)
+    self.trials = []
+
+  # raw is the output the time was parsed from, phases a dict of sub-phase
+  # name to seconds.
+  def record(self, query_num, trial, seconds, raw=None, phases=None):
+    self.times[query_num].append(seconds)
+    self.trials.append({"query": query_num, "trial": trial,
+                        "seconds": seconds, "raw": raw, "phases": phases})
+
+  def converged(self, query_num):
+    times = self.times[query_num]
+    return (self.target_ci is not None and len(times) >= self.min_trials and
+            trial_stats.relative_ci_width(times) <= self.target_ci)
+
+  def __iter__(self):
+    start = time.time()
+    def out_of_time():
+      if self.time_budget is not None and \
+         time.time() - start > self.time_budget:
+        print >> stderr, "Time budget of %ss used up" % self.time_budget
+        return True
+      return False
+
+    if self.order == "sequential":
+      for q in self.query_nums:
+        for i in range(self.num_trials):
+          if self.converged(q):
+            break
+          if out_of_time():
+            return
+          yield q, i
+      return
+    rng = random.Random(self.seed)
+    for i in range(self.num_trials):
+      trials = [(q, i) for q in self.query_nums if not self.converged(q)]
+      if self.order == "shuffled":
+        rng.shuffle(trials)
+      for q, i in trials:
+        if out_of_time():
+          return
+        yield q, i
+
 def parse_args():
   parser = OptionParser(usage="run_query.py [options]")
 
@@ -168,12 +249,69 @@ def parse_args():
       help="Password for Redshift ODBC connection")
   parser.add_option("-e", "--redshift-database",
       help="Database to use in Redshift")
+  parser.add_option("--redshift-query-timeout", type="float",
+      help="Cancel a Redshift trial that runs for longer than this many "
+           "seconds and move on to the next one")
+  parser.add_option("--redshift-trace", action="store_true", default=False,
+      help="Report, for each Redshift trial, the time spent waiting on the "
+           "server apart from client-side overhead")
   parser.add_option("--num-trials", type="int", default=10,
-      help="Number of trials to run for this query")
-
+      help="Number of trials to run for this query; with --target-ci, the "
+           "most trials to run")
+  parser.add_option("--target-ci", type="float",
+      help="Run trials of a query until the 95%% bootstrap confidence "
+           "interval of its median time is at most this fraction of the "
+           "median wide, eg. 0.05")
+  parser.add_option("--min-trials", type="int", default=3,
+      help="Fewest trials to run for a query with --target-ci")
+  parser.add_option("--time-budget", type="float",
+      help="Start no more trials after this many seconds")
+  parser.add_option("--ssh-parallelism", type="int", default=32,
+      help="Maximum number of hosts to run a command on at once when a "
+           "command is run on every node, eg. to clear buffer caches")
+
+
+  parser.add_option("--results-db", default=DEFAULT_DB,
+      help="SQLite database to add the results of the run to (default "
+           "%default); see results_store.py for querying it")
+  parser.add_option("--scale-factor",
+      help="Scale factor of the data set, eg. 5nodes, to record with the "
+           "results")
+  parser.add_option("--file-format",
+      help="File format of the data set, eg. text or sequence, to record "
+           "with the results")
 
   parser.add_option("-q", "--query-num", default="1",
-      help="Which query to run in benchmark")
+      help="Which query to run in benchmark, or a comma separated list of "
+           "queries to run as a suite, with the cluster set up once")
+  parser.add_option("--suite-order", default="sequential",
+      choices=SUITE_ORDERS,
+      help="Order to run the trials of a suite in: %s. sequential runs all "
+           "trials of one query before the next, interleaved runs one trial "
+           "of each query per round, shuffled does too but in a random "
+           "order each round" % ", ".join(SUITE_ORDERS))
+  parser.add_option("--suite-seed", type="int",
+      help="Random seed for --suite-order=shuffled (default: a random one, "
+           "which is printed)")
+
+  parser.add_option("--clients", type="int",
+      help="Measure throughput rather than latency: run this many client "
+           "streams at once, each running queries from the mix one after "
+           "another, for --duration seconds")
+  parser.add_option("--duration", type="float", default=300,
+      help="Seconds to run the clients for (default %default)")
+  parser.add_option("--query-mix",
+      help="Queries for the clients to run, with the weight of each, eg. "
+           "1a:3,2a:1 to run 1a three times as often as 2a (default: the "
+           "queries of -q, equally often)")
+  parser.add_option("--think-time", type="float", default=0,
+      help="Mean seconds for a client to wait between queries, "
+           "exponentially distributed (default %default)")
+  parser.add_option("--load-seed", type="int",
+      help="Random seed for the query mix and think times")
+  parser.add_option("--max-failures", type="int", default=10,
+      help="Stop a client after this many queries in a row fail (default "
+           "%default)")
 
   (opts, args) = parser.parse_args()
 
@@ -205,31 +343,160 @@ def parse_args():
     print >> stderr, "Impala hosts:\n%s" % "\n".join(hosts)
     opts.impala_hosts = hosts
 
-  if opts.query_num not in QUERY_MAP:
-    print >> stderr, "Unknown query number: %s" % opts.query_num
+  if opts.clients is None:
+    opts.query_nums = opts.query_num.split(",")
+    for query_num in opts.query_nums:
+      if query_num not in QUERY_MAP:
+        print >> stderr, "Unknown query number: %s" % query_num
+        sys.exit(1)
+    if len(set(opts.query_nums)) != len(opts.query_nums):
+      print >> stderr, "Query listed more than once: %s" % opts.query_num
+      sys.exit(1)
+  else:
+    if opts.clients < 1 or opts.duration <= 0 or opts.think_time < 0 or \
+       opts.max_failures < 1:
+      print >> stderr, "Throughput mode needs at least one client, a " \
+                       "positive duration, a non-negative think time and " \
+                       "at least one failure to stop at"
+      sys.exit(1)
+    try:
+      opts.query_mix = throughput.parse_mix(
+          opts.query_mix or opts.query_num)
+    except ValueError as e:
+      print >> stderr, "Bad query mix: %s" % e
+      sys.exit(1)
+    opts.query_nums = [q for q, w in opts.query_mix]
+    for query_num in opts.query_nums:
+      if query_num not in QUERY_MAP:
+        print >> stderr, "Unknown query number: %s" % query_num
+        sys.exit(1)
+      if '4' in query_num:
+        print >> stderr, "Query 4 writes to tables shared by all clients, " \
+                         "so it can't run in throughput mode"
+        sys.exit(1)
+    if len(set(opts.query_nums)) != len(opts.query_nums):
+      print >> stderr, "Query listed more than once in the mix"
+      sys.exit(1)
+    if opts.shark and not opts.shark_no_cache:
+      # Cached tables only live as long as the Shark session that made them
+      print >> stderr, "Throughput mode runs a Shark session per query, " \
+                       "so it needs --shark-no-cache"
+      sys.exit(1)
+    if opts.clear_buffer_cache:
+      print >> stderr, "--clear-buffer-cache is per trial, so it doesn't " \
+                       "apply to throughput mode"
+      sys.exit(1)
+
+  if opts.target_ci is not None and opts.shark and \
+     not opts.shark_no_cache and len(opts.query_nums) > 1:
+    print >> stderr, "--target-ci needs a Shark session per trial, which " \
+                     "a Shark Mem suite doesn't have"
+    sys.exit(1)
+
+  if opts.ssh_parallelism < 1:
+    print >> stderr, "SSH parallelism must be at least 1"
     sys.exit(1)
     
   return opts
 
 # Run a command on a host through ssh, throwing an exception if ssh fails
 def ssh(host, username, identity_file, command):
-  return subprocess.check_call(
-      "ssh -t -o StrictHostKeyChecking=no -i %s %s@%s '%s'" %
-      (identity_file, username, host, command), shell=True)
+  return sessions.check_call(host, "ssh -t %s %s@%s '%s'" % (
+      sessions.options(host, username, identity_file), username, host,
+      command))
+
+# When a command was started, first printed something (None if it never
+# did) and ended, from time.time()
+Timeline = namedtuple("Timeline", "start first_output end")
+
+# Run a command on a host through ssh, passing each line of its combined
+# stdout and stderr to on_output as soon as it arrives, and throwing an
+# exception if ssh fails. Returns the command's Timeline.
+def ssh_stream(host, username, identity_file, command, on_output):
+  options = sessions.options(host, username, identity_file)
+  start = time.time()
+  first_output = None
+  proc = subprocess.Popen(
+      "ssh %s %s@%s '%s'" % (options, username, host, command), shell=True,
+      stdin=DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      close_fds=True)
+  # readline, because iterating over the pipe reads ahead in large blocks
+  for line in iter(proc.stdout.readline, ""):
+    if first_output is None:
+      first_output = time.time()
+    on_output(line)
+  proc.wait()
+  end = time.time()
+  sessions.record(host, end - start)
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, command)
+  return Timeline(start, first_output, end)
+
+SshResult = namedtuple("SshResult", "host returncode elapsed output")
+
+# Run a command on every host through ssh, on up to `parallelism` hosts at
+# once. Returns an SshResult per host, in the order of hosts, with the return
+# code, the time taken in seconds and the combined stdout and stderr.
+def ssh_all(hosts, username, identity_file, command, parallelism):
+  def run(host):
+    # -tt allocates a terminal (for sudo) even though stdin isn't one.
+    # close_fds keeps the pipes of one host's ssh from leaking into the
+    # others, which would hold up their communicate().
+    options = sessions.options(host, username, identity_file)
+    t0 = time.time()
+    proc = subprocess.Popen(
+        "ssh -tt %s %s@%s '%s'" % (options, username, host, command),
+        shell=True, stdin=devnull, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, close_fds=True)
+    output = proc.communicate()[0]
+    elapsed = time.time() - t0
+    sessions.record(host, elapsed)
+    return SshResult(host, proc.returncode, elapsed, output)
+
+  if not hosts:
+    return []
+  devnull = open(os.devnull)
+  pool = ThreadPool(min(parallelism, len(hosts)))
+  try:
+    return pool.map(run, hosts)
+  finally:
+    pool.close()
+    devnull.close()
+
+# Like ssh_all, but throws an exception if the command fails on any host,
+# after printing the output of the hosts it failed on.
+def check_ssh_all(hosts, username, identity_file, command, parallelism):
+  t0 = time.time()
+  results = ssh_all(hosts, username, identity_file, command, parallelism)
+  failed = [r for r in results if r.returncode != 0]
+  for r in failed:
+    print >> stderr, "%s failed on %s (%s):\n%s" % (
+        command, r.host, r.returncode, r.output)
+  slowest = max(results, key=lambda r: r.elapsed)
+  print >> stderr, "Ran on %s hosts in %.1fs, slowest %s in %.1fs" % (
+      len(results), time.time() - t0, slowest.host, slowest.elapsed)
+  if failed:
+    raise subprocess.CalledProcessError(failed[0].returncode, command)
+  return results
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
 def scp_to(host, identity_file, username, local_file, remote_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s' '%s@%s:%s'" %
-      (identity_file, local_file, username, host, remote_file), shell=True)
+  sessions.check_call(host, "scp -q %s '%s' '%s@%s:%s'" % (
+      sessions.options(host, username, identity_file), local_file, username,
+      host, remote_file))
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
 def scp_from(host, identity_file, username, remote_file, local_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s@%s:%s' '%s'" %
-      (identity_file, username, host, remote_file, local_file), shell=True)
-
-def run_shark_benchmark(opts):
+  sessions.check_call(host, "scp -q %s '%s@%s:%s' '%s'" % (
+      sessions.options(host, username, identity_file), username, host,
+      remote_file, local_file))
+
+# Cached tables, the warmup query and the scheduler restart are shared by all
+# queries of a suite. With Shark Mem and more than one query, all trials run
+# in one Shark session, so the tables are cached once; otherwise each trial
+# runs in a Shark session of its own, as a single query always has. Sessions
+# stream their timings back over ssh as they run.
+def run_shark_benchmark(opts, schedule):
   def ssh_shark(command):
     command = "source /root/.bash_profile; %s" % command
     ssh(opts.shark_host, "root", opts.shark_identity_file, command)
@@ -238,14 +505,9 @@ def run_shark_benchmark(opts):
   local_query_map = QUERY_MAP
 
   prefix = str(time.time()).split(".")[0]
-  query_file_name = "%s_workload.sh" % prefix
   slaves_file_name = "%s_slaves" % prefix
-  local_query_file = os.path.join(LOCAL_TMP_DIR, query_file_name)
   local_slaves_file = os.path.join(LOCAL_TMP_DIR, slaves_file_name)
-  query_file = open(local_query_file, 'w')
-  remote_result_file = "/mnt/%s_results" % prefix
   remote_tmp_file = "/mnt/%s_out" % prefix
-  remote_query_file = "/mnt/%s" % query_file_name
 
   runner = "/root/shark/bin/shark-withinfo"
 
@@ -265,10 +527,11 @@ def run_shark_benchmark(opts):
   # Two modes here: Shark Mem and Shark Disk. If using Shark disk clear buffer
   # cache in-between each query. If using Shark Mem, used cached tables.
 
-  query_list = "set mapred.reduce.tasks = %s;" % opts.reduce_tasks
+  setup_list = split_statements(
+      "set mapred.reduce.tasks = %s;" % opts.reduce_tasks, SETUP)
 
   # Throw away query for JVM warmup
-  query_list += "SELECT COUNT(*) FROM scratch;"
+  setup_list += split_statements("SELECT COUNT(*) FROM scratch;", WARMUP)
 
   # Create cached queries for Shark Mem
   if not opts.shark_no_cache:
@@ -280,159 +543,222 @@ def run_shark_benchmark(opts):
     local_query_map = {k: convert_to_cached(v) for k, v in QUERY_MAP.items()}
 
     # Set up cached tables
-    if '4' in opts.query_num:
+    if any('4' in q for q in opts.query_nums):
       # Query 4 uses entirely different tables
-      query_list += """
+      setup_list += split_statements("""
                     DROP TABLE IF EXISTS documents_cached;
                     CREATE TABLE documents_cached AS SELECT * FROM documents;
-                    """
-    else:
-      query_list += """
+                    """, CACHE_LOAD)
+    if any('4' not in q for q in opts.query_nums):
+      setup_list += split_statements("""
                     DROP TABLE IF EXISTS uservisits_cached;
                     DROP TABLE IF EXISTS rankings_cached;
                     CREATE TABLE uservisits_cached AS SELECT * FROM uservisits;
                     CREATE TABLE rankings_cached AS SELECT * FROM rankings;
-                    """
-
-  if '4' not in opts.query_num:
-    query_list += local_clean_query
-  query_list += local_query_map[opts.query_num][0]
-
-  query_list = re.sub("\s\s+", " ", query_list.replace('\n', ' '))
-
-  print "\nQuery:"
-  print query_list.replace(';', ";\n")
-
-  if opts.clear_buffer_cache:
-    query_file.write("python /root/shark/bin/dev/clear-buffer-cache.py\n")
-
-  query_file.write(
-    "%s -e '%s' > %s 2>&1\n" % (runner, query_list, remote_tmp_file))
-
-  query_file.write(
-      "cat %s | grep Time | grep -v INFO |grep -v MapReduce >> %s\n" % (
-        remote_tmp_file, remote_result_file))
+                    """, CACHE_LOAD)
+
+  # The statements of one trial of a query
+  def trial_list(query_num, trial):
+    query_list = []
+    if '4' not in query_num:
+      query_list += split_statements(local_clean_query, CLEAN,
+                                     (query_num, trial))
+    query_list += split_statements(local_query_map[query_num][0], QUERY,
+                                   (query_num, trial))
+    return query_list
+
+  if opts.shark_no_cache or len(opts.query_nums) == 1:
+    # Taken from the schedule one at a time, so it can stop early
+    shark_sessions = ([trial] for trial in schedule)
+  else:
+    shark_sessions = [list(schedule)]
 
-  query_file.close()
+  # Workload scripts already copied to Shark, by contents
+  remote_query_files = {}
 
-  print "Copying files to Shark"
-  scp_to(opts.shark_host, opts.shark_identity_file, "root", local_query_file,
-      remote_query_file)
-  ssh_shark("chmod 775 %s" % remote_query_file)
+  # Collect results
+  results = dict((q, []) for q in opts.query_nums)
+  contents = dict((q, []) for q in opts.query_nums)
 
-  # Run benchmark
-  print "Running remote benchmark..."
+  for session in shark_sessions:
+    statements = setup_list + sum((trial_list(q, i) for q, i in session), [])
+    query_list = re.sub("\s\s+", " ",
+                        join_statements(statements).replace('\n', ' '))
 
-  # Collect results
-  results = []
-  contents = []
+    workload = ""
+    if opts.clear_buffer_cache:
+      workload += "python /root/shark/bin/dev/clear-buffer-cache.py\n"
+    # The whole log stays on Shark; only the lines with timings come back.
+    workload += "%s -e '%s' 2>&1 | tee %s | egrep --line-buffered '%s'\n" % (
+        runner, query_list, remote_tmp_file, HIVE.remote_filter)
+
+    if workload not in remote_query_files:
+      print "\nQuery:"
+      print query_list.replace(';', ";\n")
+
+      query_file_name = "%s_workload%s.sh" % (prefix, len(remote_query_files))
+      local_query_file = os.path.join(LOCAL_TMP_DIR, query_file_name)
+      remote_query_file = "/mnt/%s" % query_file_name
+      query_file = open(local_query_file, 'w')
+      query_file.write(workload)
+      query_file.close()
+
+      print "Copying files to Shark"
+      scp_to(opts.shark_host, opts.shark_identity_file, "root",
+          local_query_file, remote_query_file)
+      ssh_shark("chmod 775 %s" % remote_query_file)
+      os.remove(local_query_file)
+      remote_query_files[workload] = remote_query_file
 
-  for i in range(opts.num_trials):
     print "Stopping Executors on Slaves....."
     ensure_spark_stopped_on_slaves(slaves)
-    print "Query %s : Trial %i" % (opts.query_num, i+1)
-    ssh_shark("%s" % remote_query_file)
-    local_results_file = os.path.join(LOCAL_TMP_DIR, "%s_results" % prefix)
-    scp_from(opts.shark_host, opts.shark_identity_file, "root",
-        "/mnt/%s_results" % prefix, local_results_file)
-    content = open(local_results_file).readlines()
-    all_times = map(lambda x: float(x.split(": ")[1].split(" ")[0]), content)
-
-    if '4' in opts.query_num:
-      query_times = all_times[-4:]
-      part_a = query_times[1]
-      part_b = query_times[3]
-      print "Parts: %s, %s" % (part_a, part_b)
-      result = float(part_a) + float(part_b)
-    else:
-      result = all_times[-1] # Only want time of last query
-
-    print "Result: ", result
-    print "Raw Times: ", content
-
-    results.append(result)
-    contents.append(content)
-
-    # Clean-up
-    #ssh_shark("rm /mnt/%s*" % prefix)
-    print "Clean Up...."
-    ssh_shark("rm /mnt/%s_results" % prefix)
-    os.remove(local_results_file)
+    for q, i in session:
+      print "Query %s : Trial %i" % (q, i+1)
+    parser = TimingParser(HIVE, statements)
+    # When each trial's first and last timings arrived
+    first_timing, last_timing = {}, {}
+    def on_output(line):
+      now = time.time()
+      for e in parser.feed(line):
+        print "  %s %s: %ss" % (
+            "%s#%s" % (e.tag[0], e.tag[1] + 1) if e.tag else "Session",
+            e.phase, e.seconds)
+        first_timing.setdefault(e.tag, now)
+        last_timing[e.tag] = now
+    session_timeline = ssh_stream(
+        opts.shark_host, "root", opts.shark_identity_file,
+        "source /root/.bash_profile; %s" % remote_query_files[workload],
+        on_output)
+    parser.close()
+    parser.check()
+
+    # A trial starts when the one before it ends, and the last one ends
+    # with the session, so shutting Shark down counts towards it. Only the
+    # session has a first output (the filter drops all but the timings), so
+    # trials have the time to their first timing instead.
+    start = session_timeline.start
+    for n, (q, i) in enumerate(session):
+      if n == len(session) - 1:
+        end = session_timeline.end
+      else:
+        end = last_timing[(q, i)]
+
+      if len(session) > 1:
+        print "Query %s : Trial %i" % (q, i+1)
+      events = trial_events(parser.events, (q, i))
+      trial_content = [e.line for e in events]
+      if '4' in q:
+        print "Parts: %s" % ", ".join(
+            str(e.seconds) for e in events if e.phase == QUERY)
+      result = trial_time(events)
+      phases = trial_phases(events)
+      phases["first_timing"] = first_timing[(q, i)] - start
+      phases["wall"] = end - start
+      if n == 0:
+        phases["first_output"] = session_timeline.first_output - start
+      start = end
+
+      print "Result: ", result
+      print "Raw Times: ", trial_content
+      print "Timeline: first timing after %.1fs, done after %.1fs" % (
+          phases["first_timing"], phases["wall"])
+
+      results[q].append(result)
+      contents[q].append(trial_content)
+      schedule.record(q, i, result, "".join(trial_content), phases)
 
   os.remove(local_slaves_file)
-  os.remove(local_query_file)
 
   return results, contents
 
-def run_impala_benchmark(opts):
+def run_impala_benchmark(opts, schedule):
   impala_host = opts.impala_hosts[0]
   def ssh_impala(command): 
     ssh(impala_host, "ubuntu", opts.impala_identity_file, command)
 
   runner = "impala-shell -r -q"
+  grammar = IMPALA
   if (opts.impala_use_hive):
     runner = "hive -e"
+    grammar = HIVE
 
   prefix = str(time.time()).split(".")[0]
-  query_file_name = "%s_workload.sh" % prefix
-  local_query_file = os.path.join(LOCAL_TMP_DIR, query_file_name)
-  query_file = open(local_query_file, 'w')
-  remote_tmp_file = "/tmp/%s_tmp" % prefix
-  remote_result_file = "/tmp/%s_results" % prefix
+  remote_query_files = {}
+  remote_result_files = {}
+  query_statements = {}
 
-  query_file.write("hive -e '%s'\n" % IMPALA_MAP[opts.query_num])
-  query = QUERY_MAP[opts.query_num][1]
-
-  # Populate the full buffer cache if running Impala + cached
-  if (not opts.impala_use_hive) and (not opts.clear_buffer_cache):
-    query = "select count(*) from rankings;" + query
-    query = "select count(*) from uservisits;" + query
-
-  connect_stmt = "connect localhost;"
-  if (opts.impala_use_hive):
-    connect_stmt = ""
-
-  query_file.write(
-      "%s '%s%s' > %s 2>&1;\n" % (runner, connect_stmt, query, remote_tmp_file))
-  query_file.write("cat %s |egrep 'Inserted|Time' |grep -v MapReduce >> %s;\n" % (
-      remote_tmp_file, remote_result_file)) 
-  query_file.write("hive -e '%s';\n" % CLEAN_QUERY)
-  query_file.close()
-
-  remote_query_file = "/tmp/%s" % query_file_name
   print >> stderr, "Copying files to Impala"
-  scp_to(impala_host, opts.impala_identity_file, "ubuntu", 
-      local_query_file, remote_query_file)
-  ssh_impala("chmod 775 %s" % remote_query_file)
+  for query_num in opts.query_nums:
+    query_file_name = "%s_%s_workload.sh" % (prefix, query_num)
+    local_query_file = os.path.join(LOCAL_TMP_DIR, query_file_name)
+    query_file = open(local_query_file, 'w')
+    remote_tmp_file = "/tmp/%s_%s_tmp" % (prefix, query_num)
+    remote_result_file = "/tmp/%s_%s_results" % (prefix, query_num)
+
+    query_file.write("hive -e '%s'\n" % IMPALA_MAP[query_num])
+    statements = split_statements(QUERY_MAP[query_num][1], INSERT)
+
+    # Populate the full buffer cache if running Impala + cached
+    if (not opts.impala_use_hive) and (not opts.clear_buffer_cache):
+      statements = split_statements("select count(*) from uservisits;"
+                                    "select count(*) from rankings;",
+                                    CACHE_LOAD) + statements
+
+    if not opts.impala_use_hive:
+      statements = [Statement("connect localhost", SETUP, None)] + statements
+
+    query_file.write("%s '%s' > %s 2>&1;\n" % (
+        runner, join_statements(statements), remote_tmp_file))
+    # Only this trial's timings, so each copy back is of a few lines
+    query_file.write("egrep '%s' %s > %s;\n" % (
+        grammar.remote_filter, remote_tmp_file, remote_result_file))
+    query_file.write("hive -e '%s';\n" % CLEAN_QUERY)
+    query_file.close()
+
+    remote_query_file = "/tmp/%s" % query_file_name
+    scp_to(impala_host, opts.impala_identity_file, "ubuntu", 
+        local_query_file, remote_query_file)
+    ssh_impala("chmod 775 %s" % remote_query_file)
+    os.unlink(local_query_file)
+    remote_query_files[query_num] = remote_query_file
+    remote_result_files[query_num] = remote_result_file
+    query_statements[query_num] = statements
 
   # Run benchmark
   print >> stderr, "Running remote benchmark..."
-  for i in range(opts.num_trials):
-    if opts.clear_buffer_cache:
-      for host in opts.impala_hosts:
-        ssh(host, "ubuntu", opts.impala_identity_file,
-            "sudo bash -c \"sync && echo 3 > /proc/sys/vm/drop_caches\"")
-    ssh_impala("sudo -u hdfs %s" % remote_query_file)
-
-  # Collect results
+  results = dict((q, []) for q in opts.query_nums)
+  contents = dict((q, []) for q in opts.query_nums)
   local_result_file = os.path.join(LOCAL_TMP_DIR, "%s_results" % prefix)
-  scp_from(impala_host, opts.impala_identity_file, "ubuntu", 
-      remote_result_file, local_result_file) 
-  contents = open(local_result_file).readlines()
-
-  if opts.impala_use_hive:
-    results = map(lambda x: float(x.split(": ")[1].split(" ")[0]), contents)
-  else:
-    results = map(lambda x: float(x.split("in ")[1].split("s")[0]), contents)
+  for query_num, i in schedule:
+    if opts.clear_buffer_cache:
+      check_ssh_all(opts.impala_hosts, "ubuntu", opts.impala_identity_file,
+          "sudo bash -c \"sync && echo 3 > /proc/sys/vm/drop_caches\"",
+          opts.ssh_parallelism)
+    ssh_impala("sudo -u hdfs %s" % remote_query_files[query_num])
+
+    # Collect the results of this trial, which the schedule needs to decide
+    # on the next ones
+    scp_from(impala_host, opts.impala_identity_file, "ubuntu", 
+        remote_result_files[query_num], local_result_file) 
+    parser = TimingParser(grammar, query_statements[query_num])
+    parser.feed(open(local_result_file).read())
+    parser.close()
+    parser.check()
+    result = trial_time(parser.events)
+    trial_content = "".join(e.line for e in parser.events)
+    contents[query_num].append(trial_content)
+    results[query_num].append(result)
+    schedule.record(query_num, i, result, trial_content,
+                    trial_phases(parser.events))
 
   # Clean-up
   #ssh_impala("rm -f /tmp/%s*" % prefix) # Temporarily disabled
-  os.unlink(local_query_file)
-  os.unlink(local_result_file)
+  if os.path.exists(local_result_file):
+    os.unlink(local_result_file)
 
   return results, contents
 
-def run_redshift_benchmark(opts):
+def run_redshift_benchmark(opts, schedule):
   conn = DBAPI.connect(
     host = opts.redshift_host,
     database = opts.redshift_database,
@@ -442,42 +768,244 @@ def run_redshift_benchmark(opts):
     socket_timeout=6000)
   print >> stderr, "Connecting to Redshift..."
   cursor = conn.cursor()
+  if opts.redshift_trace:
+    conn.tracer = Tracer()
 
   print >> stderr, "Connection succeeded..."
-  times = []
+  times = dict((q, []) for q in opts.query_nums)
   # Clean up old table if still exists
   try:
     cursor.execute(CLEAN_QUERY)
   except:
     pass
-  for i in range(opts.num_trials):
+  for query_num, i in schedule:
+    if conn.tracer:
+      conn.tracer.reset()
     t0 = time.time()
-    cursor.execute(QUERY_MAP[opts.query_num][2])
-    times.append(time.time() - t0)
+    try:
+      cursor.execute(QUERY_MAP[query_num][2],
+                     timeout=opts.redshift_query_timeout)
+    except pg8000.errors.QueryTimeoutError as e:
+      # The query was cancelled, so there is no table to clean up.
+      print >> stderr, "Query %s trial %s: %s" % (query_num, i, e)
+      continue
+    times[query_num].append(time.time() - t0)
+    phases = None
+    if conn.tracer:
+      summary = conn.tracer.summary()
+      print >> stderr, format_trace(query_num, i, summary)
+      phases = dict(summary["phase_time"])
+      phases.update(recv=summary["recv_time"], client=summary["client_time"],
+                    decode=summary["decode_time"])
+    schedule.record(query_num, i, times[query_num][-1], phases=phases)
     cursor.execute(CLEAN_QUERY)
+  if not any(times.values()):
+    print >> stderr, "All trials timed out"
+    sys.exit(1)
   return times
 
+### Throughput clients ###
+# Each client of a throughput run writes to tables of its own, and only the
+# query itself counts towards its latency, not cleaning up after it.
+
+class RedshiftClient(object):
+  def __init__(self, opts, n):
+    self.timeout = opts.redshift_query_timeout
+    self.table = "%s_c%s" % (TMP_TABLE, n)
+    self.clean_query = make_output_private(CLEAN_QUERY, self.table)
+    self.conn = DBAPI.connect(
+      host = opts.redshift_host,
+      database = opts.redshift_database,
+      user = opts.redshift_username,
+      password = opts.redshift_password,
+      port = 5439,
+      socket_timeout=6000)
+    self.cursor = self.conn.cursor()
+    try:
+      self.cursor.execute(self.clean_query)
+    except:
+      pass
+
+  def run(self, query_num):
+    t0 = time.time()
+    self.cursor.execute(
+        make_output_private(QUERY_MAP[query_num][2], self.table),
+        timeout=self.timeout)
+    latency = time.time() - t0
+    self.cursor.execute(self.clean_query)
+    return latency
+
+  def close(self):
+    self.conn.close()
+
+# Runs each query in a shell of its own on a host. The latency is as the
+# client sees it, so it includes starting the shell, less the time the shell
+# reports for cleaning up before the query. The shell runs a workload script
+# per query, shared by the clients on a host, that takes the name of the
+# table to write to as its argument. The scripts start by dropping the table
+# (and making it again, if the query inserts into it), so tables don't grow
+# over the run.
+class ShellClient(object):
+  def __init__(self, host, username, identity_file, prefix, scripts,
+               statements, grammar, drop_tables, n):
+    self.host = host
+    self.username = username
+    self.identity_file = identity_file
+    self.prefix = prefix
+    self.scripts = scripts
+    self.statements = statements
+    self.grammar = grammar
+    self.drop_tables = drop_tables
+    self.n = n
+    self.tables = {}
+
+  def run(self, query_num):
+    # A table per query, as the queries' results differ in their columns
+    table = self.tables.setdefault(
+        query_num, "%s_c%s_%s" % (TMP_TABLE, self.n, query_num))
+    parser = TimingParser(self.grammar, self.statements[query_num])
+    timeline = ssh_stream(
+        self.host, self.username, self.identity_file, "%s%s %s" % (
+        self.prefix, self.scripts[query_num], table), parser.feed)
+    parser.close()
+    parser.check()
+    return timeline.end - timeline.start - sum(
+        e.seconds for e in parser.events if e.phase == CLEAN)
+
+  def close(self):
+    if self.tables:
+      self.drop_tables(self.host, self.tables.values())
+
+# Copies a workload script per query to each host, running statements
+# (from a query number and a table name) with runner and sending back the
+# lines of its output that grammar needs. Returns the remote path of the
+# script of each query, and the statements of each.
+def copy_load_scripts(hosts, username, identity_file, query_nums, runner,
+                      statements, grammar, parallelism):
+  prefix = str(time.time()).split(".")[0]
+  scripts = {}
+  query_statements = {}
+  for query_num in query_nums:
+    # The table is spliced into the single quoted statements by closing
+    # the quotes around "$1"
+    sql = join_statements(statements(query_num, "'\"$1\"'"))
+    query_file_name = "%s_%s_load.sh" % (prefix, query_num)
+    local_query_file = os.path.join(LOCAL_TMP_DIR, query_file_name)
+    query_file = open(local_query_file, 'w')
+    query_file.write("%s '%s' 2>&1 | egrep --line-buffered '%s'\n" % (
+        runner, sql, grammar.remote_filter))
+    query_file.close()
+    scripts[query_num] = "/tmp/%s" % query_file_name
+    for host in hosts:
+      scp_to(host, identity_file, username, local_query_file,
+             scripts[query_num])
+    os.remove(local_query_file)
+    query_statements[query_num] = statements(query_num, TMP_TABLE)
+  check_ssh_all(hosts, username, identity_file,
+                "chmod 775 %s" % " ".join(scripts.values()), parallelism)
+  return scripts, query_statements
+
+def impala_clients(opts):
+  username = "ubuntu"
+  identity_file = opts.impala_identity_file
+  runner = "impala-shell -r -q"
+  grammar = IMPALA
+  if opts.impala_use_hive:
+    runner = "hive -e"
+    grammar = HIVE
+
+  # Queries insert into the table, so it is made afresh, untimed, before
+  # each one
+  def statements(query_num, table):
+    result = split_statements(make_output_private(
+        "DROP TABLE IF EXISTS %s;%s" % (TMP_TABLE, IMPALA_MAP[query_num]),
+        table), CLEAN) + split_statements(
+        make_output_private(QUERY_MAP[query_num][1], table), INSERT)
+    if not opts.impala_use_hive:
+      result = [Statement("connect localhost", SETUP, None)] + result
+    return result
+
+  def drop_tables(host, tables):
+    ssh(host, username, identity_file, "sudo -u hdfs hive -e \"%s\"" % (
+        "".join("DROP TABLE IF EXISTS %s;" % t for t in tables)))
+
+  print >> stderr, "Copying files to Impala"
+  scripts, query_statements = copy_load_scripts(
+      opts.impala_hosts, username, identity_file, opts.query_nums, runner,
+      statements, grammar, opts.ssh_parallelism)
+  # Clients take turns at the hosts, so every Impala daemon coordinates
+  # some of the queries
+  return lambda n: ShellClient(
+      opts.impala_hosts[n % len(opts.impala_hosts)], username, identity_file,
+      "sudo -u hdfs ", scripts, query_statements, grammar, drop_tables, n)
+
+def shark_clients(opts):
+  runner = "/root/shark/bin/shark-withinfo -e"
+
+  def statements(query_num, table):
+    return split_statements(make_output_private(
+        "DROP TABLE IF EXISTS %s;%s" % (TMP_TABLE, QUERY_MAP[query_num][0]),
+        table), QUERY)
+
+  def drop_tables(host, tables):
+    ssh(host, "root", opts.shark_identity_file,
+        "source /root/.bash_profile; %s \"%s\"" % (
+        runner, "".join("DROP TABLE IF EXISTS %s;" % t for t in tables)))
+
+  print "Copying files to Shark"
+  scripts, query_statements = copy_load_scripts(
+      [opts.shark_host], "root", opts.shark_identity_file, opts.query_nums,
+      runner, statements, HIVE, opts.ssh_parallelism)
+  return lambda n: ShellClient(
+      opts.shark_host, "root", opts.shark_identity_file,
+      "source /root/.bash_profile; ", scripts, query_statements, HIVE,
+      drop_tables, n)
+
+def run_throughput_benchmark(opts):
+  if opts.redshift:
+    make_client = lambda n: RedshiftClient(opts, n)
+  elif opts.impala:
+    make_client = impala_clients(opts)
+  else:
+    make_client = shark_clients(opts)
+  print >> stderr, "Running %s clients for %ss..." % (opts.clients,
+                                                       opts.duration)
+  return throughput.run_load(
+      opts.clients, throughput.QueryMix(opts.query_mix), opts.duration,
+      make_client, opts.think_time, opts.load_seed, opts.max_failures)
+
+def format_trace(query_num, trial, summary):
+  phases = ", ".join("%s %.3fs" % (name, t)
+                     for name, t in sorted(summary["phase_time"].items()))
+  return ("Query %s trial %s: %.3fs total, %.3fs waiting on server, %.3fs "
+          "client (%.3fs decoding); %d bytes in, %d bytes out; %s" % (
+          query_num, trial, summary["elapsed"], summary["recv_time"],
+          summary["client_time"], summary["decode_time"],
+          summary["bytes_received"], summary["bytes_sent"], phases))
+
 def get_percentiles(in_list):
-  def get_pctl(lst, pctl):
-    return lst[int(len(lst) * pctl)]
-  in_list = sorted(in_list)
   return "%s\t%s\t%s" % (
-    get_pctl(in_list, 0.05),
-    get_pctl(in_list, .5),
-    get_pctl(in_list, .95)
+    trial_stats.percentile(in_list, 0.05),
+    trial_stats.percentile(in_list, .5),
+    trial_stats.percentile(in_list, .95)
   )
 
-def ssh_ret_code(host, user, id_file, cmd):
-  try:
-    return ssh(host, user, id_file, cmd)
-  except subprocess.CalledProcessError as e:
-    return e.returncode
+def get_median_ci(in_list):
+  low, high = trial_stats.bootstrap_ci(in_list)
+  return "%s\t%s\t(%.1f%% of median)" % (
+    low, high, 100 * trial_stats.relative_ci_width(in_list))
+
+def get_outliers(in_list):
+  flagged = [x for x, outlier in zip(in_list, trial_stats.outliers(in_list))
+             if outlier]
+  return ",".join(str(x) for x in flagged) or "none"
 
 def ensure_spark_stopped_on_slaves(slaves):
   stop = False
   while not stop:
     cmd = "jps | grep ExecutorBackend"
-    ret_vals = map(lambda s: ssh_ret_code(s, "root", opts.shark_identity_file, cmd), slaves)
+    ret_vals = [r.returncode for r in ssh_all(
+        slaves, "root", opts.shark_identity_file, cmd, opts.ssh_parallelism)]
     print ret_vals
     if 0 in ret_vals:
       print "Spark is still running on some slaves... sleeping"
@@ -485,17 +1013,41 @@ def ensure_spark_stopped_on_slaves(slaves):
     else:
       stop = True
 
+# Adds a run to the results store, with the options it was run with, bar
+# passwords and keys
+def store_run(engine, trials):
+  store = ResultsStore(opts.results_db)
+  options = dict((k, v) for k, v in vars(opts).items()
+                 if "password" not in k and "identity" not in k)
+  run_id = store.add_run(engine, trials, opts.scale_factor, opts.file_format,
+                         options)
+  store.close()
+  print >> stderr, "Results stored as run %s in %s" % (run_id,
+                                                       opts.results_db)
+
+# Writes the report of a throughput run to a results file and its queries
+# to the results store, where the engine includes the number of clients, so
+# that runs are compared with others of the same concurrency.
+def report_throughput(fname, requests, elapsed, stopped):
+  report = throughput.format_report(requests, elapsed, opts.clients, stopped)
+  print report
+  outfile = open('results/%s_throughput_%s' % (fname, datetime.datetime.now()),
+                 'w')
+  print >> outfile, report
+  outfile.close()
+
+  trials = []
+  counts = {}
+  for r in sorted(requests, key=lambda r: r.start):
+    if r.error is None:
+      trials.append({"query": r.query, "trial": counts.get(r.query, 0),
+                     "seconds": r.latency})
+      counts[r.query] = counts.get(r.query, 0) + 1
+  store_run("%s_c%s" % (fname, opts.clients), trials)
+
 def main():
   global opts
   opts = parse_args()
-  print "Query %s:" % opts.query_num
-  if opts.impala:
-    results, contents = run_impala_benchmark(opts)
-  if opts.shark:
-    results, contents = run_shark_benchmark(opts)
-  if opts.redshift:
-    results = run_redshift_benchmark(opts)
-
   if opts.impala:
     if opts.clear_buffer_cache:
       fname = "impala_disk"
@@ -508,24 +1060,63 @@ def main():
   elif opts.redshift:
     fname = "redshift"
 
-  def prettylist(lst):
-    return ",".join([str(k) for k in lst]) 
-
-  output = StringIO()
-  outfile = open('results/%s_%s_%s' % (fname, opts.query_num, datetime.datetime.now()), 'w')
+  if opts.clients is not None:
+    requests, elapsed, stopped = run_throughput_benchmark(opts)
+    report_throughput(fname, requests, elapsed, stopped)
+    if sessions.masters:
+      print >> stderr, sessions.summary()
+    return
 
-  print >> output, "=================================="
-  print >> output, "Results: %s" % prettylist(results)
-  print >> output, "Percentiles: %s" % get_percentiles(results)
-  print >> output, "Best: %s"  % min(results)
-  if not opts.redshift:
-    print >> output, "Contents: \n%s" % str(prettylist(contents))
+  print "Query %s:" % opts.query_num
+  schedule = TrialSchedule(opts.query_nums, opts.num_trials, opts.suite_order,
+                           opts.suite_seed, opts.target_ci, opts.min_trials,
+                           opts.time_budget)
+  if opts.suite_order == "shuffled":
+    # Stored with the run's options, and printed so it can be run again
+    opts.suite_seed = schedule.seed
+    print "Suite seed: %s" % schedule.seed
+  if len(opts.query_nums) > 1 and opts.target_ci is None:
+    print "Suite order: %s" % ", ".join(
+        "%s#%s" % (q, i + 1) for q, i in schedule)
+  if opts.impala:
+    results, contents = run_impala_benchmark(opts, schedule)
+  if opts.shark:
+    results, contents = run_shark_benchmark(opts, schedule)
+  if opts.redshift:
+    results = run_redshift_benchmark(opts, schedule)
 
-  print output.getvalue()
-  print >> outfile, output.getvalue()
+  def prettylist(lst):
+    return ",".join([str(k) for k in lst]) 
 
-  output.close()
-  outfile.close()
+  for query_num in opts.query_nums:
+    if not results[query_num]:
+      # eg. the time budget ran out first
+      print >> stderr, "No trials of query %s completed" % query_num
+      continue
+    if len(opts.query_nums) > 1:
+      print "Query %s:" % query_num
+    output = StringIO()
+    outfile = open('results/%s_%s_%s' % (fname, query_num, datetime.datetime.now()), 'w')
+
+    print >> output, "=================================="
+    print >> output, "Results: %s" % prettylist(results[query_num])
+    print >> output, "Percentiles: %s" % get_percentiles(results[query_num])
+    print >> output, "Median 95%% CI: %s" % get_median_ci(results[query_num])
+    print >> output, "Outliers: %s" % get_outliers(results[query_num])
+    print >> output, "Best: %s"  % min(results[query_num])
+    if not opts.redshift:
+      print >> output, "Contents: \n%s" % str(prettylist(contents[query_num]))
+
+    print output.getvalue()
+    print >> outfile, output.getvalue()
+
+    output.close()
+    outfile.close()
+
+  store_run(fname, schedule.trials)
+
+  if sessions.masters:
+    print >> stderr, sessions.summary()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,124 @@
+"""Persistent ssh connections for the runner scripts.
+
+   Every ssh and scp to a host goes over one master connection per host and
+   user (OpenSSH ControlMaster), so the key exchange and authentication are
+   done once rather than for every command. The time spent setting up those
+   connections is kept apart from the time spent running commands over them.
+"""
+
+import atexit
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+DEVNULL = open(os.devnull, "r+")
+
+class SshSessions(object):
+  """Master connections, started on first use and kept open until close().
+
+     Thread safe: commands on different hosts can run at the same time, and
+     concurrent first uses of a host share one master connection."""
+
+  def __init__(self, persist=600):
+    # Masters exit by themselves this many seconds after their last use, in
+    # case close() is never called.
+    self.persist = persist
+    self.control_dir = None
+    self.masters = {}
+    self.host_locks = {}
+    self.lock = threading.Lock()
+    self.setup_times = {}
+    self.command_times = {}
+    self.command_counts = {}
+
+  def _control_path(self, host, username):
+    # Unix socket paths are limited to about 100 characters, so the path is
+    # a short hash of the destination rather than the host name.
+    name = hashlib.md5("%s@%s" % (username, host)).hexdigest()[:16]
+    return os.path.join(self.control_dir, name)
+
+  def _host_lock(self, key):
+    self.lock.acquire()
+    try:
+      if self.control_dir is None:
+        self.control_dir = tempfile.mkdtemp(prefix="bdb-ssh-")
+      if key not in self.host_locks:
+        self.host_locks[key] = threading.Lock()
+      return self.host_locks[key]
+    finally:
+      self.lock.release()
+
+  def options(self, host, username, identity_file):
+    """Options for ssh or scp to username@host over the master connection,
+       starting the master if it isn't running. If it can't be started, the
+       options make a connection of their own, as if there were no master."""
+    key = (host, username)
+    base = "-o StrictHostKeyChecking=no -i %s" % identity_file
+    host_lock = self._host_lock(key)
+    host_lock.acquire()
+    try:
+      if key not in self.masters:
+        path = self._control_path(host, username)
+        t0 = time.time()
+        # -f returns once the master is authenticated and in the background
+        ret = subprocess.call(
+            "ssh -M -N -f %s -o ControlPath=%s -o ControlPersist=%s %s@%s" %
+            (base, path, self.persist, username, host), shell=True,
+            stdin=DEVNULL, close_fds=True)
+        self.setup_times[host] = self.setup_times.get(host, 0) + \
+            time.time() - t0
+        self.masters[key] = path if ret == 0 else None
+      path = self.masters[key]
+    finally:
+      host_lock.release()
+    if path is None:
+      return base
+    return "%s -o ControlMaster=no -o ControlPath=%s" % (base, path)
+
+  def record(self, host, elapsed):
+    """Adds a command that took elapsed seconds on host to the totals."""
+    self.lock.acquire()
+    try:
+      self.command_times[host] = self.command_times.get(host, 0) + elapsed
+      self.command_counts[host] = self.command_counts.get(host, 0) + 1
+    finally:
+      self.lock.release()
+
+  def check_call(self, host, command):
+    """subprocess.check_call of a shell command line that runs over a
+       connection to host, counting its time as command time."""
+    t0 = time.time()
+    try:
+      return subprocess.check_call(command, shell=True)
+    finally:
+      self.record(host, time.time() - t0)
+
+  def summary(self):
+    setup = sum(self.setup_times.values())
+    commands = sum(self.command_times.values())
+    # Times are summed over hosts, so they can be more than the wall clock
+    # time when hosts are used in parallel.
+    return ("SSH: %s connections to %s hosts, %.1fs setting them up; %s "
+            "commands, %.1fs running them" % (
+            len(self.masters), len(self.setup_times), setup,
+            sum(self.command_counts.values()), commands))
+
+  def close(self):
+    """Stops all master connections."""
+    for (host, username), path in self.masters.items():
+      if path is not None:
+        subprocess.call(
+            "ssh -O exit -o ControlPath=%s %s@%s" % (path, username, host),
+            shell=True, stdout=DEVNULL, stderr=DEVNULL, close_fds=True)
+    self.masters.clear()
+    if self.control_dir is not None:
+      shutil.rmtree(self.control_dir, ignore_errors=True)
+      self.control_dir = None
+
+# The sessions shared by everything in a script run; closed when it exits.
+sessions = SshSessions()
+atexit.register(sessions.close)
@@ -0,0 +1,144 @@
+"""A fake PostgreSQL backend for the tests of the bundled pg8000.
+
+   It speaks enough of the extended query protocol for pg8000: any login is
+   accepted, statements starting with SELECT return the rows in rows as a
+   single column of type type_oid (int4 unless set), and everything else
+   returns no data. After an error,
+   messages are dropped until the next Sync, as a real server does.
+"""
+
+import socket
+import struct
+import threading
+
+CANCEL_REQUEST_CODE = 80877102
+
+def message(code, body):
+  return code + struct.pack("!i", len(body) + 4) + body
+
+def row_description(type_oid, format_code):
+  return message("T", struct.pack("!h", 1) + "x\x00" +
+                 struct.pack("!ihihih", 0, 0, type_oid, 4, -1, format_code))
+
+def data_row(value, format_code):
+  data = struct.pack("!i", value) if format_code else str(value)
+  return message("D", struct.pack("!hi", 1, len(data)) + data)
+
+def error(code, text):
+  return message("E", "SERROR\x00C%s\x00M%s\x00\x00" % (code, text))
+
+class Backend(threading.Thread):
+  """Serves every connection made to port, numbering them from 1. With
+     stall set, an Execute of a SELECT sends its first row and then waits
+     for a CancelRequest, which it answers with the error of a cancelled
+     query. The messages of the connections numbered in silent are read but
+     never answered, like a server that has hung or a network that has
+     dropped the connection without either side knowing."""
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.listener = socket.socket()
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(5)
+    self.port = self.listener.getsockname()[1]
+    self.rows = [1, 2]
+    self.type_oid = 23
+    self.stall = False
+    self.silent = set()
+    self.sockets = {}
+    self.cancelled = threading.Event()
+    self.connections = 0
+    self.syncs = 0
+    self.start()
+
+  def run(self):
+    while True:
+      sock = self.listener.accept()[0]
+      t = threading.Thread(target=self.serve, args=(sock,))
+      t.daemon = True
+      t.start()
+
+  def drop(self, number):
+    """Closes connection number, as a server that went away would."""
+    self.sockets[number].shutdown(socket.SHUT_RDWR)
+
+  def serve(self, sock):
+    buf = [""]
+    def read(n):
+      while len(buf[0]) < n:
+        data = sock.recv(65536)
+        if not data:
+          raise EOFError()
+        buf[0] += data
+      result, buf[0] = buf[0][:n], buf[0][n:]
+      return result
+    try:
+      length = struct.unpack("!i", read(4))[0]
+      body = read(length - 4)
+      if struct.unpack("!i", body[:4])[0] == CANCEL_REQUEST_CODE:
+        self.cancelled.set()
+        return
+      self.connections += 1
+      number = self.connections
+      self.sockets[number] = sock
+      sock.sendall(message("R", struct.pack("!i", 0)) +
+                   message("K", struct.pack("!ii", 1, 2)) + message("Z", "I"))
+      returns_rows = {}
+      portals = {}
+      failed = False
+      while True:
+        code = read(1)
+        length = struct.unpack("!i", read(4))[0]
+        body = read(length - 4)
+        if code == "X":
+          return
+        if number in self.silent:
+          continue
+        if code == "S":
+          self.syncs += 1
+          failed = False
+          sock.sendall(message("Z", "I"))
+        elif failed:
+          continue
+        elif code == "P":
+          name, rest = body.split("\x00", 1)
+          returns_rows[name] = rest.lstrip().upper().startswith("SELECT")
+          sock.sendall(message("1", ""))
+        elif code == "D":
+          name = body[1:].split("\x00")[0]
+          if body[0] == "S":
+            sock.sendall(message("t", struct.pack("!h", 0)))
+            rows = returns_rows[name]
+            fc = 0
+          else:
+            rows, fc = portals[name]
+          sock.sendall(row_description(self.type_oid, fc) if rows
+                       else message("n", ""))
+        elif code == "B":
+          portal, statement, rest = body.split("\x00", 2)
+          # the last format code asked for is that of the one column
+          fc = struct.unpack("!h", rest[-2:])[0] if len(rest) >= 2 else 0
+          portals[portal] = (returns_rows[statement], fc)
+          sock.sendall(message("2", ""))
+        elif code == "E":
+          portal = body.split("\x00")[0]
+          rows, fc = portals[portal]
+          if not rows:
+            sock.sendall(message("C", "OK\x00"))
+            continue
+          if self.stall:
+            sock.sendall(data_row(self.rows[0], fc))
+            self.cancelled.wait(30)
+            sock.sendall(error("57014",
+                               "canceling statement due to user request"))
+            failed = True
+            continue
+          sock.sendall("".join(data_row(v, fc) for v in self.rows) +
+                       message("C", "SELECT %s\x00" % len(self.rows)))
+        elif code == "C":
+          sock.sendall(message("3", ""))
+    except (EOFError, socket.error):
+      pass
+    finally:
+      sock.close()
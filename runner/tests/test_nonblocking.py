@@ -0,0 +1,110 @@
+"""Tests of pg8000.nonblocking against a minimal fake backend.
+
+   Run from the runner directory: python -m unittest discover tests
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "deps"))
+
+from pg8000 import nonblocking
+from pg8000.errors import NotSupportedError, ProgrammingError
+
+from backend import Backend
+
+def message(code, body):
+  return code + struct.pack("!i", len(body) + 4) + body
+
+# A backend that accepts any login and fails every statement it is asked to
+# parse, answering each Sync with ReadyForQuery.
+class FailingBackend(threading.Thread):
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.listener = socket.socket()
+    self.listener.bind(("127.0.0.1", 0))
+    self.listener.listen(1)
+    self.port = self.listener.getsockname()[1]
+    self.parses = 0
+    self.start()
+
+  def run(self):
+    sock = self.listener.accept()[0]
+    buf = [""]
+    def read(n):
+      while len(buf[0]) < n:
+        data = sock.recv(65536)
+        if not data:
+          raise EOFError()
+        buf[0] += data
+      result, buf[0] = buf[0][:n], buf[0][n:]
+      return result
+    try:
+      length = struct.unpack("!i", read(4))[0]
+      read(length - 4)
+      sock.sendall(message("R", struct.pack("!i", 0)) + message("Z", "I"))
+      failed = False
+      while True:
+        code = read(1)
+        length = struct.unpack("!i", read(4))[0]
+        read(length - 4)
+        if code == "P":
+          self.parses += 1
+          failed = True
+        elif code == "S":
+          if failed:
+            sock.sendall(message(
+                "E", "SERROR\x00C42601\x00Msyntax error\x00\x00"))
+            failed = False
+          sock.sendall(message("Z", "I"))
+        elif code == "X":
+          return
+    except EOFError:
+      pass
+    finally:
+      sock.close()
+
+class ParseFailureTest(unittest.TestCase):
+  def test_concurrent_callers_of_a_failing_statement(self):
+    backend = FailingBackend()
+    loop = nonblocking.EventLoop()
+    conn = nonblocking.AsyncConnection(loop, user="u", host="127.0.0.1",
+                                       port=backend.port)
+    first = conn.fetch("SELECT bad")
+    second = conn.fetch("SELECT bad")
+    self.assertRaises(ProgrammingError, loop.run_until_complete, first)
+    self.assertRaises(ProgrammingError, loop.run_until_complete, second)
+    self.assertTrue(second.done())
+    self.assertEqual(backend.parses, 1)
+    self.assertEqual(conn._statements, {})
+
+    # The failed parse isn't cached, so the statement is parsed again
+    third = conn.fetch("SELECT bad")
+    self.assertRaises(ProgrammingError, loop.run_until_complete, third)
+    self.assertEqual(backend.parses, 2)
+    conn.close()
+
+class BindFailureTest(unittest.TestCase):
+  def test_unreadable_result_type_fails_the_fetch(self):
+    backend = Backend()
+    backend.type_oid = 9999
+    loop = nonblocking.EventLoop()
+    conn = nonblocking.AsyncConnection(loop, user="u", host="127.0.0.1",
+                                       port=backend.port)
+    future = conn.fetch("SELECT x")
+    self.assertRaises(NotSupportedError, loop.run_until_complete, future)
+    self.assertTrue(future.done())
+
+    # Nothing was sent for it, so the connection carries on
+    backend.type_oid = 23
+    rows = loop.run_until_complete(conn.fetch("SELECT y"))
+    self.assertEqual([tuple(r) for r in rows], [(1,), (2,)])
+    conn.close()
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,91 @@
+"""Tests of pg8000.dbapi.convert_paramstyle.
+
+   The expected results were recorded from the character by character
+   scanner that convert_paramstyle replaced, so they check that the
+   tokenizer and its cache give the same queries, args and errors.
+
+   Run from the runner directory: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "deps"))
+
+from pg8000 import dbapi
+
+D = {"a": 1, "b": 2, "b_1": 3, u"n\xe9": 4}
+
+# (paramstyle, query, args, (query, args) or the name of the error raised)
+CASES = [
+  ('format', 'SELECT * FROM t WHERE a = %s AND b = %s', (1, 2),
+    ('SELECT * FROM t WHERE a = $1 AND b = $2', (1, 2))),
+  ('format', "SELECT '%%s', a FROM t WHERE a = %s", (1,),
+    ("SELECT '%s', a FROM t WHERE a = $1", (1,))),
+  ('format', 'SELECT 10 %% 3, %s', (1,), ('SELECT 10 % 3, $1', (1,))),
+  ('format', 'SELECT a::int FROM t WHERE b = %s', (1,),
+    ('SELECT a::int FROM t WHERE b = $1', (1,))),
+  ('format', "SELECT E'it\\'s', %s", (1,), ("SELECT E'it\\'s', $1", (1,))),
+  ('format', "SELECT 'it''s', %s", (1,), ("SELECT 'it''s', $1", (1,))),
+  ('format', 'SELECT "100%%" FROM t WHERE a = %s', (1,),
+    ('SELECT "100%" FROM t WHERE a = $1', (1,))),
+  ('format', 'SELECT a % 2', (), 'QueryParameterParseError'),
+  ('format', "SELECT '%d'", (), 'QueryParameterParseError'),
+  ('format', 'SELECT %s, %s', (1,), 'QueryParameterIndexError'),
+  ('qmark', "SELECT * FROM t WHERE a = ? AND b = '?'", (1,),
+    ("SELECT * FROM t WHERE a = $1 AND b = '?'", (1,))),
+  ('qmark', 'SELECT a::text, ? FROM t WHERE "?" = ?', (1, 2),
+    ('SELECT a::text, $1 FROM t WHERE "?" = $2', (1, 2))),
+  ('qmark', "SELECT E'\\'?', ?", (1,), ("SELECT E'\\'?', $1", (1,))),
+  ('qmark', 'SELECT ?, ?', (1,), 'QueryParameterIndexError'),
+  ('numeric', 'SELECT :1, :2, :1', (1, 2), ('SELECT $1, $2, $1', (1, 2))),
+  ('numeric', "SELECT ':1', :1", (1,), ("SELECT ':1', $1", (1,))),
+  ('numeric', 'SELECT a::int, :1', (1,), 'QueryParameterParseError'),
+  ('named', 'SELECT :a, :b, :a', D, ('SELECT $1, $2, $1', (1, 2))),
+  ('named', 'SELECT \':a\', ":b", :b_1', D, ('SELECT \':a\', ":b", $1', (3,))),
+  ('named', 'SELECT a::int FROM t WHERE b = :b', D,
+    'QueryParameterParseError'),
+  ('named', 'SELECT :a\xc3\xa9', D, ('SELECT $1\xc3\xa9', (1,))),
+  ('named', u'SELECT :n\xe9', D, (u'SELECT $1', (4,))),
+  ('named', 'SELECT :c', D, 'KeyError'),
+  ('pyformat', 'SELECT %(a)s, %(b)s, %(a)s', D, ('SELECT $1, $2, $1', (1, 2))),
+  ('pyformat', 'SELECT %s, %s', (1, 2), ('SELECT $1, $2', (1, 2))),
+  ('pyformat', "SELECT '%%', %(a)s", D, ("SELECT '%', $1", (1,))),
+  ('pyformat', 'SELECT a::int, %(b)s', D, ('SELECT a::int, $1', (2,))),
+  ('pyformat', 'SELECT %(a)d', D, 'QueryParameterParseError'),
+  ('pyformat', 'SELECT %(a', D, 'QueryParameterParseError'),
+  ('pyformat', "SELECT '%(a)s'", D, 'QueryParameterParseError'),
+]
+
+class ConvertParamstyleTest(unittest.TestCase):
+  def convert(self, style, query, args):
+    try:
+      return dbapi.convert_paramstyle(style, query, args)
+    except Exception as e:
+      return type(e).__name__
+
+  def test_recorded_cases(self):
+    dbapi._paramstyle_cache.clear()
+    for style, query, args, expected in CASES:
+      self.assertEqual(self.convert(style, query, args), expected,
+                       "%s %r" % (style, query))
+
+  def test_cached_queries(self):
+    # Each query a second time comes from the cache
+    for style, query, args, expected in CASES:
+      self.convert(style, query, args)
+      self.assertEqual(self.convert(style, query, args), expected,
+                       "%s %r" % (style, query))
+    self.assertEqual(
+        dbapi.convert_paramstyle("format", "SELECT %s, %s", ("x", "y")),
+        ("SELECT $1, $2", ("x", "y")))
+
+  def test_pyformat_percent(self):
+    # The old scanner didn't skip the second % of a %% outside quotes
+    self.assertEqual(
+        dbapi.convert_paramstyle("pyformat", "SELECT 10 %% 3, %(a)s", D),
+        ("SELECT 10 % 3, $1", (1,)))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,53 @@
+"""Tests of the health check of pg8000.pool.ConnectionPool.
+
+   Run from the runner directory: python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "deps"))
+
+from pg8000.pool import ConnectionPool
+
+from backend import Backend
+
+class HealthCheckTest(unittest.TestCase):
+  def setUp(self):
+    self.backend = Backend()
+    self.pool = ConnectionPool(min_size=1, max_size=2, check_timeout=0.5,
+                               user="u", host="127.0.0.1",
+                               port=self.backend.port, socket_timeout=10)
+
+  def tearDown(self):
+    self.pool.close()
+
+  def test_healthy_connection_is_reused(self):
+    conn = self.pool.get()
+    self.assertEqual(self.backend.syncs, 1)
+    self.pool.put(conn)
+    self.assertTrue(self.pool.get() is conn)
+    self.assertEqual(self.backend.syncs, 2)
+    self.assertEqual(self.pool.stats()["failed_checks"], 0)
+    self.pool.put(conn)
+
+  def test_hung_connection_is_replaced(self):
+    self.backend.silent.add(1)
+    t0 = time.time()
+    conn = self.pool.get()
+    self.assertTrue(time.time() - t0 < 5)
+    self.assertEqual(self.pool.stats()["failed_checks"], 1)
+    self.assertEqual(self.backend.connections, 2)
+    self.pool.put(conn)
+
+  def test_closed_connection_is_replaced(self):
+    self.backend.drop(1)
+    conn = self.pool.get()
+    self.assertEqual(self.pool.stats()["failed_checks"], 1)
+    self.assertEqual(self.backend.connections, 2)
+    self.pool.put(conn)
+
+if __name__ == "__main__":
+  unittest.main()
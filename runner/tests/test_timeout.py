@@ -0,0 +1,39 @@
+"""Tests of the statement timeout of the bundled pg8000.
+
+   Run from the runner directory: python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "deps"))
+
+from pg8000 import interface
+from pg8000.errors import QueryTimeoutError
+
+from backend import Backend
+
+class TimeoutTest(unittest.TestCase):
+  def test_cancel_during_fetch(self):
+    backend = Backend()
+    conn = interface.Connection(user="u", host="127.0.0.1",
+                                port=backend.port, socket_timeout=10)
+    backend.stall = True
+    t0 = time.time()
+    self.assertRaises(QueryTimeoutError, conn.execute, "SELECT x",
+                      timeout=0.5)
+    # well before socket_timeout, which is where a fetch still waiting for
+    # the server after the error would give up
+    self.assertTrue(time.time() - t0 < 5)
+    self.assertTrue(backend.cancelled.is_set())
+
+    # The connection is back to ReadyForQuery and usable
+    backend.stall = False
+    conn.execute("SELECT x", timeout=5)
+    self.assertEqual(list(conn.iterate_tuple()), [(1,), (2,)])
+    conn.close()
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,166 @@
+"""Tests of timing_parser on output recorded from the Shark and Impala
+   shells.
+
+   Run from the runner directory: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from timing_parser import (HIVE, IMPALA, CLEAN, INSERT, QUERY, SETUP,
+                           Statement, ParseError, TimingParser,
+                           split_statements, trial_events, trial_phases,
+                           trial_time)
+
+# Query 4 of a Shark trial: two CREATE TABLE AS parts, each after a DROP
+QUERY_4 = ("DROP TABLE IF EXISTS url_counts_partial;"
+           "CREATE TABLE url_counts_partial AS SELECT TRANSFORM (line) "
+           "USING \"python /root/url_count.py\" as (sourcePage, destPage, "
+           "count) from documents;"
+           "DROP TABLE IF EXISTS url_counts_total;"
+           "CREATE TABLE url_counts_total AS SELECT SUM(count) AS "
+           "totalCount, destpage FROM url_counts_partial GROUP BY destpage;")
+
+SHARK_QUERY_4 = """\
+Logging initialized using configuration in jar:file:/root/shark/lib_managed/jars/edu.berkeley.cs.shark/hive-common/hive-common-0.9.0-shark-0.8.0.jar!/hive-log4j.properties
+Hive history file=/tmp/root/hive_job_log_root_201305211010_1085394622.txt
+13/05/21 10:10:02 INFO exec.ExecDriver: Time taken: 0.01 seconds to load
+OK
+Time taken: 0.412 seconds
+13/05/21 10:10:05 INFO scheduler.DAGScheduler: Completed ResultTask(1, 118)
+13/05/21 10:10:05 INFO spark.SparkContext: Job finished: collect, took 62.90 s
+OK
+Time taken: 63.081 seconds
+OK
+Time taken: 0.15 seconds
+13/05/21 10:11:10 INFO spark.SparkContext: Job finished: collect, took 10.2 s
+OK
+Time taken: 10.5 seconds
+"""
+
+IMPALA_TRIAL = """\
+Connected to localhost:21000
+Query: drop table if exists result
+Returned 0 row(s) in 0.11s
+Query: create table result (pageURL STRING, pageRank INT)
+Returned 0 row(s) in 0.20s
+Query: insert into table result select pageURL, pageRank from rankings where pageRank > 1000
+Inserted 32888 rows in 2.73s
+"""
+
+def impala_statements(tag):
+  return ([Statement("connect localhost", SETUP, None)] +
+          split_statements("DROP TABLE IF EXISTS result;CREATE TABLE result "
+                           "(pageURL STRING, pageRank INT)", CLEAN, tag) +
+          split_statements("INSERT INTO TABLE result SELECT pageURL, "
+                           "pageRank FROM rankings WHERE pageRank > 1000",
+                           INSERT, tag))
+
+class TimingParserTest(unittest.TestCase):
+  def test_query_4(self):
+    statements = split_statements(QUERY_4, QUERY, ("4", 0))
+    self.assertEqual([s.phase for s in statements],
+                     [CLEAN, QUERY, CLEAN, QUERY])
+    parser = TimingParser(HIVE, statements)
+    events = parser.feed(SHARK_QUERY_4)
+    self.assertEqual(parser.close(), [])
+    parser.check()
+    self.assertEqual([e.seconds for e in events], [0.412, 63.081, 0.15, 10.5])
+    # The parts of the query count, cleaning up before them doesn't
+    self.assertAlmostEqual(trial_time(events), 73.581)
+    self.assertEqual(trial_phases(events), {
+        "clean_1": 0.412, "query_1": 63.081, "clean_2": 0.15,
+        "query_2": 10.5})
+
+  def test_chunks_split_anywhere(self):
+    statements = split_statements(QUERY_4, QUERY, ("4", 0))
+    output = SHARK_QUERY_4.replace("\n", "\r\n")
+    for size in (1, 7, 64):
+      parser = TimingParser(HIVE, statements)
+      events = []
+      for i in range(0, len(output), size):
+        events.extend(parser.feed(output[i:i + size]))
+      events.extend(parser.close())
+      self.assertEqual([e.seconds for e in events],
+                       [0.412, 63.081, 0.15, 10.5])
+
+  def test_last_line_without_newline(self):
+    parser = TimingParser(HIVE, split_statements("SELECT 1", QUERY))
+    self.assertEqual(parser.feed("OK\nTime taken: 1.5 seconds"), [])
+    self.assertEqual([e.seconds for e in parser.close()], [1.5])
+    self.assertTrue(parser.done())
+
+  def test_fetched_rows(self):
+    parser = TimingParser(HIVE, split_statements("SELECT * FROM t", QUERY))
+    event = parser.feed("Time taken: 2.25 seconds, Fetched: 10 row(s)\n")[0]
+    self.assertEqual((event.seconds, event.rows), (2.25, 10))
+
+  def test_untimed_statements(self):
+    statements = split_statements("set mapred.reduce.tasks=150;"
+                                  "SELECT 1", QUERY)
+    parser = TimingParser(HIVE, statements)
+    events = parser.feed("Time taken: 3.0 seconds\n")
+    self.assertEqual(events[0].statement.sql, "SELECT 1")
+    parser.check()
+
+  def test_impala_trials(self):
+    statements = impala_statements(("1a", 0)) + impala_statements(("1a", 1))
+    parser = TimingParser(IMPALA, statements)
+    events = parser.feed(IMPALA_TRIAL + IMPALA_TRIAL.replace("2.73", "2.5"))
+    parser.check()
+    first = trial_events(events, ("1a", 0))
+    self.assertEqual([(e.phase, e.seconds, e.rows) for e in first],
+                     [(CLEAN, 0.11, 0), (CLEAN, 0.2, 0),
+                      (INSERT, 2.73, 32888)])
+    self.assertEqual(trial_time(first), 2.73)
+    self.assertEqual(trial_time(trial_events(events, ("1a", 1))), 2.5)
+
+  def test_query_and_insert_add_up(self):
+    statements = (split_statements("CREATE TABLE t AS SELECT 1", QUERY) +
+                  split_statements("INSERT INTO TABLE t SELECT 2", INSERT))
+    parser = TimingParser(HIVE, statements)
+    events = parser.feed("Time taken: 4.0 seconds\nTime taken: 1.5 seconds\n")
+    self.assertEqual(trial_time(events), 5.5)
+
+  def test_failed_statement(self):
+    parser = TimingParser(HIVE, split_statements(QUERY_4, QUERY, ("4", 0)))
+    parser.feed("OK\nTime taken: 0.412 seconds\n"
+                "FAILED: Execution Error, return code 2 from "
+                "org.apache.hadoop.hive.ql.exec.MapRedTask\n")
+    parser.close()
+    self.assertFalse(parser.done())
+    self.assertEqual(len(parser.errors), 1)
+    try:
+      parser.check()
+      self.fail("check() should have raised")
+    except ParseError as e:
+      self.assertTrue("no time for 3 of 4 statements" in str(e))
+      self.assertTrue("CREATE TABLE url_counts_partial" in str(e))
+      self.assertTrue("return code 2" in str(e))
+
+  def test_impala_error(self):
+    parser = TimingParser(IMPALA, impala_statements(("1a", 0)))
+    parser.feed("Connected to localhost:21000\n"
+                "ERROR: AnalysisException: Table does not exist: "
+                "default.rankings\n")
+    self.assertEqual(parser.errors, [
+        "ERROR: AnalysisException: Table does not exist: default.rankings"])
+    self.assertRaises(ParseError, parser.check)
+
+  def test_missing_timings(self):
+    parser = TimingParser(HIVE, split_statements(QUERY_4, QUERY, ("4", 0)))
+    parser.feed(SHARK_QUERY_4.split("Time taken: 0.15")[0])
+    parser.close()
+    self.assertEqual(len(parser.events), 2)
+    self.assertRaises(ParseError, parser.check)
+
+  def test_more_timings_than_statements(self):
+    parser = TimingParser(HIVE, split_statements("SELECT 1", QUERY))
+    self.assertRaises(ParseError, parser.feed,
+                      "Time taken: 1 seconds\nTime taken: 2 seconds\n")
+
+if __name__ == "__main__":
+  unittest.main()
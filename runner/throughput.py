@@ -0,0 +1,204 @@
+"""Closed-loop load generation for throughput benchmarks.
+
+   A number of client streams run at once, each picking queries from a
+   weighted mix and running them one after another, with an optional think
+   time in between, until the duration is up. The report gives the queries
+   per second and the latency distribution of each query class, as well as
+   over all of them.
+
+   Clients are made by the engine: any object with run(query), which runs
+   one query and returns its latency in seconds as the client sees it, and
+   close().
+"""
+
+import bisect
+import math
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import trial_stats
+
+# A query run by a client: which query, when it started (in seconds from
+# the start of the load), its latency, and the exception it raised if it
+# failed, in which case latency is how long it took to fail.
+Request = namedtuple("Request", "client query start latency error")
+
+def parse_mix(spec):
+  """(query, weight) pairs from a comma separated list of queries, each
+     optionally followed by a colon and its weight, eg. "1a:3,2a:1". A query
+     without a weight has a weight of 1."""
+  mix = []
+  for part in spec.split(","):
+    query, _, weight = part.partition(":")
+    weight = float(weight) if weight else 1.0
+    if weight <= 0:
+      raise ValueError("weight of %s must be positive" % query)
+    mix.append((query, weight))
+  return mix
+
+class QueryMix(object):
+  """Picks queries at random, in proportion to their weights."""
+
+  def __init__(self, weights):
+    self.queries = [q for q, w in weights]
+    self.cumulative = []
+    total = 0.0
+    for q, w in weights:
+      total += w
+      self.cumulative.append(total)
+
+  def choose(self, rng):
+    return self.queries[bisect.bisect_right(
+        self.cumulative, rng.random() * self.cumulative[-1])]
+
+def run_load(clients, mix, duration, make_client, think_time=0, seed=None,
+             max_failures=10):
+  """Runs clients streams of queries from mix for duration seconds, with
+     make_client(n) making the client of stream n. Clients are all made
+     before the load starts, so connecting isn't part of it. Think times are
+     exponentially distributed with a mean of think_time seconds. Queries
+     running when the time is up are waited for. If a client can't be made,
+     those that were are closed and the error is raised. A client whose last
+     max_failures queries all failed stops, rather than failing as fast as
+     it can for the rest of the load. Returns the list of Requests, the
+     number of seconds the load ran for and the clients that stopped, as a
+     dict of the time each stopped (in seconds from the start)."""
+  def make(n):
+    try:
+      return make_client(n), None
+    except Exception:
+      return None, sys.exc_info()
+
+  pool = ThreadPool(clients)
+  try:
+    made = pool.map(make, range(clients))
+  finally:
+    pool.close()
+  client_objects = [c for c, error in made if error is None]
+  errors = [error for c, error in made if error is not None]
+  if errors:
+    for client in client_objects:
+      try:
+        client.close()
+      except Exception:
+        pass
+    raise errors[0][0], errors[0][1], errors[0][2]
+
+  requests = []
+  stopped = {}
+  lock = threading.Lock()
+  start = time.time()
+  deadline = start + duration
+
+  def stream(n, client):
+    rng = random.Random(None if seed is None else seed + n)
+    failures = 0
+    while time.time() < deadline:
+      query = mix.choose(rng)
+      t0 = time.time()
+      try:
+        latency, error = client.run(query), None
+      except Exception as e:
+        latency, error = time.time() - t0, e
+      lock.acquire()
+      try:
+        requests.append(Request(n, query, t0 - start, latency, error))
+      finally:
+        lock.release()
+      failures = failures + 1 if error is not None else 0
+      if failures >= max_failures:
+        stopped[n] = time.time() - start
+        break
+      if think_time:
+        time.sleep(min(rng.expovariate(1.0 / think_time),
+                       max(0, deadline - time.time())))
+
+  threads = [threading.Thread(target=stream, args=(n, client))
+             for n, client in enumerate(client_objects)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  for client in client_objects:
+    client.close()
+  return requests, elapsed, stopped
+
+def histogram(values, buckets_per_doubling=2):
+  """Counts of values in buckets whose bounds grow geometrically, as
+     (low, high, count), from the bucket of the smallest value to that of
+     the largest. Latencies spread over orders of magnitude, so equal width
+     buckets would put nearly everything in the first one."""
+  positive = [v for v in values if v > 0]
+  if not positive:
+    return [(0.0, 0.0, len(values))]
+
+  def bucket(v):
+    # Logs are rounded, eg. log(8, sqrt(2)) comes out at 5.999..., which
+    # would put 8 below its bucket; a value that close to a bound is on it.
+    x = math.log(v, 2) * buckets_per_doubling
+    return int(math.floor(x + 1e-9))
+
+  def bound(b):
+    return 2 ** (b / float(buckets_per_doubling))
+
+  low = bucket(min(positive))
+  high = bucket(max(positive))
+  counts = [0] * (high - low + 1)
+  for v in values:
+    index = bucket(v) - low if v > 0 else 0
+    counts[min(max(index, 0), len(counts) - 1)] += 1
+  return [(bound(low + i), bound(low + i + 1), c)
+          for i, c in enumerate(counts)]
+
+def _summary(name, requests, elapsed):
+  latencies = [r.latency for r in requests if r.error is None]
+  errors = len(requests) - len(latencies)
+  if not latencies:
+    return "%-6s %6d %6d %8.2f" % (name, 0, errors, 0)
+  return "%-6s %6d %6d %8.2f %8.3f %8.3f %8.3f %8.3f %8.3f" % (
+      name, len(latencies), errors, len(latencies) / elapsed,
+      sum(latencies) / len(latencies), trial_stats.percentile(latencies, 0.5),
+      trial_stats.percentile(latencies, 0.95),
+      trial_stats.percentile(latencies, 0.99), max(latencies))
+
+def format_report(requests, elapsed, clients, stopped=None, width=40):
+  """A text report of a load: throughput and latency percentiles per query
+     and over all queries, then a latency histogram per query. Only queries
+     that succeeded count towards the throughput and latencies. stopped is
+     the clients that stopped early, as returned by run_load."""
+  queries = sorted(set(r.query for r in requests))
+  done = [r for r in requests if r.error is None]
+  lines = ["Throughput: %s clients for %.1fs, %s queries done (%s failed), "
+           "%.2f queries/s" % (clients, elapsed, len(done),
+                               len(requests) - len(done),
+                               len(done) / elapsed)]
+  if stopped:
+    lines.append("Stopped after failing repeatedly: %s" % ", ".join(
+        "client %s at %.1fs" % (n, stopped[n]) for n in sorted(stopped)))
+  lines.append("%-6s %6s %6s %8s %8s %8s %8s %8s %8s" % (
+      "Query", "Done", "Failed", "QPS", "Mean", "p50", "p95", "p99", "Max"))
+  for query in queries:
+    lines.append(_summary(query, [r for r in requests if r.query == query],
+                          elapsed))
+  lines.append(_summary("All", requests, elapsed))
+  for query in queries:
+    latencies = [r.latency for r in done if r.query == query]
+    if not latencies:
+      continue
+    lines.append("Latency of %s (seconds):" % query)
+    buckets = histogram(latencies)
+    most = max(c for l, h, c in buckets)
+    for low, high, count in buckets:
+      lines.append("  %8.3f - %8.3f %6d %s" % (
+          low, high, count, "#" * int(round(width * count / float(most)))))
+  errors = [r for r in requests if r.error is not None]
+  if errors:
+    lines.append("First failure: query %s on client %s: %s" % (
+        errors[0].query, errors[0].client, errors[0].error))
+  return "\n".join(lines)
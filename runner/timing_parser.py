@@ -0,0 +1,173 @@
+"""Incremental parsing of the timings printed by the Shark, Hive and Impala
+   shells.
+
+   A shell is given a list of statements and prints a line with its time
+   (and often a row count) for each one it runs, among any amount of other
+   output. A TimingParser knows the statements, each tagged with the phase
+   of the benchmark it belongs to and the trial it is part of, and is fed
+   the output in chunks as it arrives. It turns each timing line into an
+   Event for the next statement that reports a time. The engine's Grammar
+   says which lines are timings, which are errors and which statements
+   print no timing at all.
+
+   Every Grammar also has a remote_filter: an egrep pattern for the lines
+   it cares about, so the remote side can drop everything else before the
+   output is shipped back.
+"""
+
+import re
+from collections import deque, namedtuple
+
+# Phases of a benchmark run
+SETUP = "setup"
+WARMUP = "warmup"
+CACHE_LOAD = "cache_load"
+CLEAN = "clean"
+QUERY = "query"
+INSERT = "insert"
+
+# The phases whose time is the time of a query
+TIMED_PHASES = (QUERY, INSERT)
+
+# A statement sent to a shell; tag says which trial it is part of, eg.
+# ("1a", 0), or is None for statements outside of any trial.
+Statement = namedtuple("Statement", ["sql", "phase", "tag"])
+
+# The timing of a statement: its phase and tag, the time in seconds, the
+# number of rows if the shell said, and the line it was parsed from.
+Event = namedtuple("Event", ["phase", "tag", "seconds", "rows", "statement",
+                             "line"])
+
+class ParseError(Exception):
+  pass
+
+class Grammar(object):
+  """The timing output of a shell.
+
+     time_pattern must match (from the start of a line) the lines with the
+     time of a statement, with a group named seconds and optionally one
+     named rows. Lines matching error_pattern are kept as errors. Statements
+     matching untimed_pattern don't print a time."""
+
+  def __init__(self, name, time_pattern, error_pattern, untimed_pattern,
+               remote_filter):
+    self.name = name
+    self.time_re = re.compile(time_pattern)
+    self.error_re = re.compile(error_pattern)
+    self.untimed_re = re.compile(untimed_pattern, re.IGNORECASE)
+    self.remote_filter = remote_filter
+
+  def timed(self, sql):
+    return not self.untimed_re.match(sql)
+
+# The Hive CLI, which Shark's is built on: "Time taken: 1.5 seconds", with
+# ", Fetched: 10 row(s)" in later versions. INFO log lines can mention times
+# too, but never at the start of the line.
+HIVE = Grammar("hive",
+    r"Time taken: (?P<seconds>[0-9.]+) seconds"
+    r"(?:, Fetched: (?P<rows>[0-9]+) row)?",
+    r"FAILED: ",
+    r"\s*(set|add|reset|dfs)\b",
+    "^(Time taken: |FAILED: )")
+
+# impala-shell: "Returned 1 row(s) in 0.52s", "Inserted 100 rows in 1.20s"
+IMPALA = Grammar("impala",
+    r"(?:Returned|Inserted) (?P<rows>[0-9]+) rows?(?:\(s\))? in "
+    r"(?P<seconds>[0-9.]+)s",
+    r"(ERROR|Query aborted)",
+    r"\s*(connect|set|use)\b",
+    "^((Returned|Inserted) [0-9]+ row|ERROR|Query aborted)")
+
+def split_statements(sql, phase, tag=None):
+  """The statements of a string of ;-separated ones, all in phase except
+     for DROPs, which clean up after (or before) it."""
+  statements = []
+  for s in sql.split(";"):
+    s = s.strip()
+    if s:
+      statements.append(Statement(
+          s, CLEAN if s.upper().startswith("DROP ") else phase, tag))
+  return statements
+
+def join_statements(statements):
+  return "".join("%s;" % s.sql for s in statements)
+
+class TimingParser(object):
+  """Events for the timed statements of a shell session, from its output.
+     feed() and close() return the events they completed; all of them are
+     also kept in events, and any error lines in errors."""
+
+  def __init__(self, grammar, statements):
+    self.grammar = grammar
+    self.pending = deque(s for s in statements if grammar.timed(s.sql))
+    self.partial = ""
+    self.events = []
+    self.errors = []
+
+  def feed(self, data):
+    lines = (self.partial + data).split("\n")
+    self.partial = lines.pop()
+    return filter(None, [self._parse_line(line) for line in lines])
+
+  def close(self):
+    """Parses what is left of the output, which has ended."""
+    line, self.partial = self.partial, ""
+    if line:
+      event = self._parse_line(line)
+      if event is not None:
+        return [event]
+    return []
+
+  def done(self):
+    return not self.pending
+
+  def check(self):
+    """Raises ParseError unless every timed statement got its time."""
+    if self.pending:
+      raise ParseError("%s: no time for %s of %s statements, from %r%s" % (
+          self.grammar.name, len(self.pending),
+          len(self.pending) + len(self.events), self.pending[0].sql,
+          "; errors: %s" % " ".join(self.errors) if self.errors else ""))
+
+  def _parse_line(self, line):
+    line = line.rstrip("\r")
+    m = self.grammar.time_re.match(line)
+    if m is None:
+      if self.grammar.error_re.match(line):
+        self.errors.append(line)
+      return None
+    if not self.pending:
+      raise ParseError("%s: more times than statements, at %r" % (
+          self.grammar.name, line))
+    statement = self.pending.popleft()
+    rows = m.group("rows") if "rows" in m.groupdict() else None
+    event = Event(statement.phase, statement.tag, float(m.group("seconds")),
+                  int(rows) if rows is not None else None, statement,
+                  line + "\n")
+    self.events.append(event)
+    return event
+
+def trial_events(events, tag):
+  return [e for e in events if e.tag == tag]
+
+def trial_time(events):
+  """The time of a trial, from its events: the sum of those of its queries
+     and inserts, leaving out cleaning up."""
+  return sum(e.seconds for e in events if e.phase in TIMED_PHASES)
+
+def trial_phases(events):
+  """The times of the events of a trial by phase, numbering the phases that
+     happen more than once (eg. query_1 and query_2 for the two parts of
+     query 4)."""
+  counts = {}
+  for e in events:
+    counts[e.phase] = counts.get(e.phase, 0) + 1
+  phases = {}
+  seen = {}
+  for e in events:
+    if counts[e.phase] > 1:
+      seen[e.phase] = seen.get(e.phase, 0) + 1
+      phases["%s_%s" % (e.phase, seen[e.phase])] = e.seconds
+    else:
+      phases[e.phase] = e.seconds
+  return phases
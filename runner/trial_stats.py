@@ -0,0 +1,201 @@
+"""Summary statistics for the timings of benchmark trials.
+
+   Trial counts are small, so percentiles are interpolated between the
+   sorted timings, and the uncertainty of the median is estimated with a
+   bootstrap rather than assuming any particular distribution.
+"""
+
+import math
+import random
+
+def percentile(values, pctl):
+  """The pctl (0 to 1) percentile of values, linearly interpolated between
+     the closest ranks, as numpy.percentile does by default."""
+  if not values:
+    raise ValueError("percentile of no values")
+  values = sorted(values)
+  rank = pctl * (len(values) - 1)
+  low = int(rank)
+  high = min(low + 1, len(values) - 1)
+  return values[low] + (values[high] - values[low]) * (rank - low)
+
+def median(values):
+  return percentile(values, 0.5)
+
+def bootstrap_ci(values, stat=median, confidence=0.95, resamples=2000,
+                 seed=0):
+  """Percentile bootstrap confidence interval (low, high) of stat(values).
+     Seeded, so the same timings always give the same interval."""
+  rng = random.Random(seed)
+  n = len(values)
+  stats = [stat([values[rng.randrange(n)] for i in xrange(n)])
+           for j in xrange(resamples)]
+  alpha = (1 - confidence) / 2
+  return percentile(stats, alpha), percentile(stats, 1 - alpha)
+
+def relative_ci_width(values, confidence=0.95):
+  """Width of the bootstrap confidence interval of the median, relative to
+     the median."""
+  low, high = bootstrap_ci(values, confidence=confidence)
+  mid = median(values)
+  if mid == 0:
+    return 0.0 if high == low else float("inf")
+  return (high - low) / abs(mid)
+
+def outliers(values, k=1.5):
+  """Flags, in the order of values, for the values outside Tukey's fences:
+     more than k interquartile ranges below the first or above the third
+     quartile."""
+  if len(values) < 4:
+    return [False] * len(values)
+  q1, q3 = percentile(values, 0.25), percentile(values, 0.75)
+  low, high = q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+  return [v < low or v > high for v in values]
+
+def ranks(values):
+  """Ranks (1 based) of values, in their order, ties getting the mean of the
+     ranks they span."""
+  order = sorted(range(len(values)), key=values.__getitem__)
+  result = [0.0] * len(values)
+  i = 0
+  while i < len(order):
+    j = i
+    while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+      j += 1
+    for k in order[i:j + 1]:
+      result[k] = (i + j) / 2.0 + 1
+    i = j + 1
+  return result
+
+_u_counts = {}
+
+def _u_distribution(m, n):
+  """Counts of the orderings of m and n values with U = 0, 1, ..., m * n,
+     when the values are all distinct."""
+  key = (m, n)
+  if key not in _u_counts:
+    if m == 0 or n == 0:
+      _u_counts[key] = [1]
+    else:
+      # The largest value is either one of the m (adding n to U) or not.
+      with_m = _u_distribution(m - 1, n)
+      without = _u_distribution(m, n - 1)
+      counts = [0] * (m * n + 1)
+      for u, c in enumerate(without):
+        counts[u] += c
+      for u, c in enumerate(with_m):
+        counts[u + n] += c
+      _u_counts[key] = counts
+  return _u_counts[key]
+
+def mann_whitney(x, y, exact_max=20):
+  """Mann-Whitney U test of whether the values in x and y come from the same
+     distribution. Returns (U of x, two sided p value). The p value is exact
+     when there are no ties and neither sample has more than exact_max
+     values, otherwise it is the normal approximation, corrected for ties
+     and continuity."""
+  m, n = len(x), len(y)
+  if m == 0 or n == 0:
+    raise ValueError("mann_whitney needs values in both samples")
+  all_ranks = ranks(list(x) + list(y))
+  u = sum(all_ranks[:m]) - m * (m + 1) / 2.0
+  ties = len(set(x) | set(y)) < m + n
+  if not ties and m <= exact_max and n <= exact_max:
+    counts = _u_distribution(m, n)
+    total = float(sum(counts))
+    u = int(round(u))
+    low = sum(counts[:u + 1]) / total
+    high = sum(counts[u:]) / total
+    return u, min(1.0, 2 * min(low, high))
+  mean = m * n / 2.0
+  tie_sizes = {}
+  for r in all_ranks:
+    tie_sizes[r] = tie_sizes.get(r, 0) + 1
+  tie_term = sum(t ** 3 - t for t in tie_sizes.values())
+  variance = m * n / 12.0 * ((m + n + 1) - tie_term / float((m + n) *
+                                                           (m + n - 1)))
+  if variance <= 0:
+    return u, 1.0
+  z = (abs(u - mean) - 0.5) / math.sqrt(variance)
+  return u, min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+def change_point(values, min_size=2):
+  """The most likely single shift in level in a series of values, as
+     (index of the first value after the shift, p value), taking the split
+     whose two sides differ most by the Mann-Whitney test. (None, 1.0) if
+     the series is too short to split into sides of min_size. The best of
+     many splits is bound to look significant, so its p value is multiplied
+     by the number of splits tried (Bonferroni)."""
+  best = (None, 1.0)
+  splits = range(min_size, len(values) - min_size + 1)
+  for i in splits:
+    p = mann_whitney(values[:i], values[i:])[1]
+    if p < best[1]:
+      best = (i, p)
+  if best[0] is None:
+    return best
+  return best[0], min(1.0, best[1] * len(splits))
+
+def _beta_fraction(a, b, x):
+  # The continued fraction of the incomplete beta function, by Lentz's
+  # method (Numerical Recipes, 6.4).
+  tiny = 1e-300
+  c = 1.0
+  d = 1.0 - (a + b) * x / (a + 1)
+  d = 1.0 / (d if abs(d) > tiny else tiny)
+  result = d
+  for m in range(1, 300):
+    for num in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+      d = 1.0 + num * d
+      d = 1.0 / (d if abs(d) > tiny else tiny)
+      c = 1.0 + num / c
+      c = c if abs(c) > tiny else tiny
+      result *= c * d
+    if abs(c * d - 1) < 1e-12:
+      break
+  return result
+
+def incomplete_beta(a, b, x):
+  """The regularized incomplete beta function I_x(a, b)."""
+  if x <= 0:
+    return 0.0
+  if x >= 1:
+    return 1.0
+  front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                   a * math.log(x) + b * math.log(1 - x))
+  if x < (a + 1) / (a + b + 2):
+    return front * _beta_fraction(a, b, x) / a
+  return 1 - front * _beta_fraction(b, a, 1 - x) / b
+
+def t_p_value(t, df):
+  """The two sided p value of t under Student's t distribution with df
+     degrees of freedom."""
+  return incomplete_beta(df / 2.0, 0.5, df / (df + float(t) * t))
+
+def prediction_test(values, value):
+  """Whether value comes from the same normal distribution as values, the
+     test behind a prediction interval: the t statistic of value against
+     the mean of values, allowing for the error of the mean as well as the
+     spread. Returns (t, two sided p value); needs at least two values."""
+  n = len(values)
+  if n < 2:
+    raise ValueError("prediction_test needs at least two values")
+  mean = sum(values) / float(n)
+  sd = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+  if sd == 0:
+    return (0.0, 1.0) if value == mean else (float("inf"), 0.0)
+  t = (value - mean) / (sd * math.sqrt(1 + 1.0 / n))
+  return t, t_p_value(t, n - 1)
+
+def holm(p_values):
+  """Holm's adjustment of a family of p values, so that rejecting those
+     below alpha rejects any true null with a chance of at most alpha over
+     the whole family. None (untested) stays None."""
+  tested = sorted((p, i) for i, p in enumerate(p_values) if p is not None)
+  adjusted = list(p_values)
+  running = 0.0
+  for rank, (p, i) in enumerate(tested):
+    running = max(running, min(1.0, p * (len(tested) - rank)))
+    adjusted[i] = running
+  return adjusted